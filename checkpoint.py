@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import pickle
+import hashlib
+import contextlib
+import compression
+
+
+'''
+Checkpoints of long chunked stages.
+A stage reading a source table in chunks writes the outputs of every chunk atomically (see atomic_open),
+then records the chunk in the journal of the stage (<output directory>/<table>.journal),
+with its partial aggregates if it has any (e.g. the frequencies counted by a dictionary),
+both in the same atomically replaced file, so they never disagree.
+When the stage is run again after a failure, with the same inputs and settings,
+the chunks already done are skipped (they are still parsed, so chunk boundaries do not move)
+and the stage resumes from the first incomplete chunk.
+The journal is removed once the stage completes, so a later run starts over.
+A stage starting over first removes the outputs of its table left by an earlier run,
+whose chunks (and so files) may differ, e.g. with another memory budget.
+'''
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w', compress=False, **kwargs):
+    '''
+    Open a file to be written atomically: it is written into <path>.tmp,
+    renamed to path once closed without error, and removed on an error,
+    so a killed run never leaves a partial file behind.
+
+    Parameters:
+    ----
+        path:
+            filepath of the file
+        mode, kwargs:
+            as in open()
+        compress:
+            whether the file is a tuple file, compressed as configured (see compression.open_file)
+
+    Returns:
+    ----
+        the file object (as a context manager)
+    '''
+
+    tmp_path = path + '.tmp'
+    f = compression.open_file(tmp_path, mode, **kwargs) if compress else open(tmp_path, mode, **kwargs)
+    try:
+        yield f
+    except BaseException:
+        f.close()
+        os.remove(tmp_path)
+        raise
+    f.close()
+    os.replace(tmp_path, path)
+
+
+class Journal:
+    '''
+    Journal of the chunks completed by a stage.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset processed (its selection of patients and memory budget are part of the signature)
+        path:
+            filepath of the journal
+        inputs:
+            filepaths the outputs depend on (source table, dictionaries), compared by size and modification time
+        params:
+            other settings the chunks depend on (e.g. the chunk size), JSON serializable
+        outputs:
+            list of (directory, table) of the tuple files written by the stage: <table>[chunk].tri
+            (and string stores <table>[chunk]_strings.json) left by an earlier run are removed
+            unless the stage resumes, so that they are not merged with the new ones
+
+    A journal left by a run with another signature is discarded.
+    With adapter.checkpoint off (settings.CHECKPOINT), nothing is recorded nor resumed.
+    '''
+
+    def __init__(self, adapter, path, inputs, params=None, outputs=None):
+        self.path = path
+        # partial aggregates kept in a separate file by earlier versions
+        self.state_path = path + '.state'
+        self.enabled = adapter.checkpoint
+        signature = {'inputs': {p: _file_signature(p) for p in inputs}, 'params': params,
+                     'memory_budget': adapter.memory_budget, 'selection': _selection(adapter)}
+        # normalized as JSON (tuples become lists), so equal settings compare equal
+        self.signature = json.loads(json.dumps(signature))
+        self.done = []
+        self.state = None
+
+        if self.enabled and os.path.exists(path):
+            self._load()
+        if len(self.done) == 0:
+            for directory, table in outputs or []:
+                _remove_outputs(directory, table)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                journal = pickle.load(f)
+        except Exception:
+            # a journal of an earlier version, or a corrupted one
+            journal = {'signature': None}
+        if journal['signature'] == self.signature:
+            self.done = journal['chunks']
+            self.state = journal['state']
+            print('resuming from {}: chunks {} already done'.format(self.path, self.done))
+        else:
+            print('inputs or settings changed since {} was written, starting over'.format(self.path))
+            self.clear()
+
+    def chunks(self, reader):
+        '''
+        enumerate the chunks of a reader as (number, chunk), skipping the chunks already done
+        '''
+
+        done = set(self.done)
+        for i, chunk in enumerate(reader):
+            if i in done:
+                print('chunk {} already done'.format(i))
+                continue
+            yield i, chunk
+
+    def load_state(self, default):
+        '''
+        the partial aggregates saved with the last chunk done, default if no chunk was done
+        '''
+
+        if len(self.done) == 0:
+            return default
+        return self.state
+
+    def commit(self, i, state=None):
+        '''
+        record chunk i as done (after its outputs were written), with the partial aggregates after it,
+        in a single atomic write of the journal
+        '''
+
+        if not self.enabled:
+            return
+        self.done.append(i)
+        self.state = state
+        with atomic_open(self.path, 'wb') as f:
+            pickle.dump({'signature': self.signature, 'chunks': self.done, 'state': state}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+    def finish(self):
+        '''
+        the stage completed: remove the journal
+        '''
+
+        self.clear()
+
+    def clear(self):
+        for p in [self.path, self.state_path]:
+            if os.path.exists(p):
+                os.remove(p)
+        self.done = []
+        self.state = None
+
+
+def _remove_outputs(directory, table):
+    '''
+    remove the tuple files of a table (of any chunk) from a directory
+    '''
+
+    if not os.path.isdir(directory):
+        return
+    pattern = re.compile(re.escape(table) + r'\d*(\.tri|\.tri\.tmp|_strings\.json)')
+    for name in os.listdir(directory):
+        if pattern.fullmatch(name):
+            os.remove(os.path.join(directory, name))
+
+
+def _file_signature(path):
+    '''
+    size and modification time of a file (of the compressed version of a source table read instead), None if it does not exist
+    '''
+
+    path = compression.source_path(path)
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _selection(adapter):
+    '''
+    the patients processed by the adapter (see DatasetAdapter.select)
+    '''
+
+    sample_ids = adapter.sample_ids
+    if isinstance(sample_ids, str):
+        sample_ids = [sample_ids] + [str(v) for v in _file_signature(sample_ids) or []]
+    elif sample_ids is not None:
+        ids = '\n'.join(sorted(str(i) for i in sample_ids))
+        sample_ids = hashlib.md5(ids.encode('utf8')).hexdigest()
+    return {'shard': adapter.shard, 'n_shards': adapter.n_shards, 'sample_rate': adapter.sample_rate,
+            'sample_ids': sample_ids}
@@ -0,0 +1,365 @@
+import io
+import os
+import bz2
+import gzip
+import lzma
+import queue
+import shutil
+import tempfile
+import threading
+import subprocess
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from settings import COMPRESSION, COMPRESSION_LEVEL, COMPRESSION_THREADS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+'''
+Transparent compression of the tuple files (.tri files, tuples.csv, string_tuples.csv and the files derived from them).
+Files are written through open_file(), compressed with the codec of settings.COMPRESSION,
+and keep their names: readers opening them with open_file() detect the codec from the first bytes,
+so compressed and plain files can be mixed (e.g. .tri files of an earlier run).
+Data is compressed in independent blocks by a pool of threads (the codecs release the GIL),
+each block a complete gzip member / bz2 stream / xz stream / zstd or lz4 frame,
+so the file is a valid concatenation that the usual tools (zcat, bzcat, xzcat, zstdcat, lz4cat) read too.
+Source tables can be read compressed as well (e.g. the .csv.gz files MIMIC-IV is distributed as, see open_source),
+decompressed by another thread or process while they are parsed.
+'''
+
+
+# bytes of uncompressed data per block
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# first bytes of the files of every codec
+MAGIC = {
+    'gzip': b'\x1f\x8b',
+    'bz2': b'BZh',
+    'lzma': b'\xfd7zXZ\x00',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'lz4': b'\x04\x22\x4d\x18',
+}
+
+
+def _compressor(codec, level):
+    '''
+    function compressing a block into a complete member/stream/frame of the codec
+    '''
+
+    if codec == 'gzip':
+        level = 6 if level is None else level
+        return lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+    if codec == 'bz2':
+        level = 9 if level is None else level
+        return lambda data: bz2.compress(data, compresslevel=level)
+    if codec == 'lzma':
+        return lambda data: lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+    if codec == 'zstd':
+        level = 3 if level is None else level
+        # a compressor per block: compressors are not shared between threads
+        return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == 'lz4':
+        level = 0 if level is None else level
+        return lambda data: lz4.frame.compress(data, compression_level=level)
+    raise ValueError('unknown codec: {}'.format(codec))
+
+
+def available(codec):
+    '''
+    whether a codec can be used (zstd and lz4 need the zstandard and lz4 packages)
+    '''
+
+    if codec == 'zstd':
+        return zstandard is not None
+    if codec == 'lz4':
+        return lz4 is not None
+    return codec in MAGIC
+
+
+def detect(path):
+    '''
+    the codec of a file from its first bytes, None for a plain file
+    '''
+
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for codec, magic in MAGIC.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+class BlockWriter(io.RawIOBase):
+    '''
+    Binary file compressing the data written in blocks, in parallel:
+    blocks are compressed by a pool of threads and written in their order,
+    with a bounded number of blocks in flight.
+
+    Parameters:
+    ----
+        path:
+            filepath of the output file
+        codec, level:
+            the codec and its level (None for its default)
+        threads:
+            number of threads compressing blocks
+        block_size:
+            bytes of uncompressed data per block
+    '''
+
+    def __init__(self, path, codec, level=None, threads=None, block_size=BLOCK_SIZE):
+        self.file = open(path, 'wb')
+        self.compress = _compressor(codec, level)
+        self.threads = threads or multiprocessing.cpu_count()
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.pool = ThreadPoolExecutor(self.threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(self.compress, block))
+        # keep at most two blocks per thread in memory
+        while len(self.pending) > 2 * self.threads:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if len(self.buffer) > 0:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while len(self.pending) > 0:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown()
+            self.file.close()
+            super().close()
+
+
+def _reader(path, codec):
+    '''
+    binary file decompressing a file of the codec (all its members, streams or frames)
+    '''
+
+    if codec == 'gzip':
+        return gzip.open(path, 'rb')
+    if codec == 'bz2':
+        return bz2.open(path, 'rb')
+    if codec == 'lzma':
+        return lzma.open(path, 'rb')
+    if codec == 'zstd':
+        assert zstandard is not None, 'the zstandard package is needed to read ' + path
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader, BLOCK_SIZE)
+    assert codec == 'lz4'
+    assert lz4 is not None, 'the lz4 package is needed to read ' + path
+    return lz4.frame.open(path, 'rb')
+
+
+def open_file(path, mode='r', encoding='utf8', newline=None, codec=COMPRESSION):
+    '''
+    Open a tuple file, compressed or not.
+
+    Parameters:
+    ----
+        path:
+            filepath of the file
+        mode:
+            'r' or 'rb' to read (the codec is detected), 'w' or 'wb' to write (with the given codec)
+        encoding, newline:
+            as in open(), in text mode
+        codec:
+            codec of the written file ('gzip', 'bz2', 'lzma', 'zstd' or 'lz4'), None for a plain file.
+            settings.COMPRESSION by default; a codec not installed falls back to gzip
+
+    Returns:
+    ----
+        the file object
+    '''
+
+    if mode in ('r', 'rb'):
+        read_codec = detect(path)
+        if read_codec is None:
+            return open(path, mode, encoding=encoding, newline=newline) if mode == 'r' else open(path, mode)
+        f = _reader(path, read_codec)
+    elif mode in ('w', 'wb'):
+        if codec is not None and not available(codec):
+            print('{} is not installed, {} is written with gzip'.format(codec, path))
+            codec = 'gzip'
+        if codec is None:
+            return open(path, mode, encoding=encoding, newline=newline) if mode == 'w' else open(path, mode)
+        f = io.BufferedWriter(BlockWriter(path, codec, COMPRESSION_LEVEL, COMPRESSION_THREADS), BLOCK_SIZE)
+    else:
+        raise ValueError('unsupported mode: {}'.format(mode))
+
+    if mode.endswith('b'):
+        return f
+    return io.TextIOWrapper(f, encoding=encoding, newline=newline)
+
+
+# extensions of the compressed versions of a source table (e.g. labevents.csv.gz)
+SOURCE_EXTENSIONS = ['.gz', '.bz2', '.xz', '.zst', '.lz4']
+
+# external gzip decompressors, faster than zlib (igzip of ISA-L is vectorized, pigz decompresses with helper threads),
+# in order of preference; gzip sources are decompressed by a thread of zlib without them
+GZIP_TOOLS = ['igzip', 'pigz']
+
+# decompressed blocks read ahead of the parser by the decompression thread
+READ_AHEAD = 4
+
+
+def source_path(path):
+    '''
+    The file holding a source table: the path itself if it exists, else a compressed version of it
+    (path + '.gz', ...), also for the extracted layout <dir>/<table>.csv/<table>.csv
+    of a table distributed as <dir>/<table>.csv.gz. The path itself if none exists.
+    '''
+
+    if os.path.isfile(path):
+        return path
+    candidates = [path + ext for ext in SOURCE_EXTENSIONS]
+    parent = os.path.dirname(path)
+    if os.path.basename(parent) == os.path.basename(path):
+        candidates += [parent + ext for ext in SOURCE_EXTENSIONS]
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+    return path
+
+
+def open_source(path):
+    '''
+    Open a compressed source table (the codec is detected) as a binary stream of its decompressed data.
+    Gzip files are decompressed by igzip or pigz in another process if one is installed (see GZIP_TOOLS),
+    other files by a thread reading blocks ahead, so decompression runs alongside the parser.
+
+    Parameters:
+    ----
+        path:
+            filepath of the table
+
+    Returns:
+    ----
+        the binary file object, None if the file is not compressed
+    '''
+
+    codec = detect(path)
+    if codec is None:
+        return None
+    if codec == 'gzip':
+        for tool in GZIP_TOOLS:
+            if shutil.which(tool) is not None:
+                return io.BufferedReader(_ProcessReader([tool, '-dc', path]), BLOCK_SIZE)
+    return io.BufferedReader(_ThreadReader(_reader(path, codec)), BLOCK_SIZE)
+
+
+class _ThreadReader(io.RawIOBase):
+    '''
+    Binary file of the data of another file object, read ahead in blocks by a thread
+    (the decompressors release the GIL, so the blocks are decompressed while the data before them is parsed).
+    '''
+
+    def __init__(self, f, block_size=BLOCK_SIZE, read_ahead=READ_AHEAD):
+        self.blocks = queue.Queue(read_ahead)
+        self.block = memoryview(b'')
+        self.eof = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(f, block_size), daemon=True)
+        self.thread.start()
+
+    def _run(self, f, block_size):
+        try:
+            with f:
+                while not self.stopping.is_set():
+                    block = f.read(block_size)
+                    self.blocks.put(block)
+                    if len(block) == 0:
+                        break
+        except BaseException as e:
+            self.blocks.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self.block) == 0:
+            if self.eof:
+                return 0
+            block = self.blocks.get()
+            if isinstance(block, BaseException):
+                self.eof = True
+                raise block
+            if len(block) == 0:
+                self.eof = True
+                return 0
+            self.block = memoryview(block)
+        n = min(len(b), len(self.block))
+        b[:n] = self.block[:n]
+        self.block = self.block[n:]
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        # unblock the thread if it waits for room in the queue
+        self.stopping.set()
+        while self.thread.is_alive():
+            try:
+                self.blocks.get_nowait()
+            except queue.Empty:
+                self.thread.join(0.01)
+        super().close()
+
+
+class _ProcessReader(io.RawIOBase):
+    '''
+    Binary file of the output of a decompressing command (e.g. pigz -dc <path>).
+    Its messages go to a temporary file (a pipe read only at the end would block a command writing many),
+    reported with its return code if it fails.
+    '''
+
+    def __init__(self, command):
+        self.command = command
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=self.stderr)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.process.stdout.readinto(b)
+        if n == 0 and self.process.wait() != 0:
+            self.stderr.seek(0)
+            raise IOError('{} failed with return code {}: {}'.format(' '.join(self.command), self.process.returncode,
+                          self.stderr.read().decode(errors='replace').strip()))
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+        self.stderr.close()
+        super().close()
@@ -0,0 +1,440 @@
+import sys
+import os
+import numpy as np
+import pandas as pd
+import rolluptool
+import compression
+from settings import MIMIC_DIR, EICU_DIR, RESULT_ROOT_DIR, TUPLE_DIR, STRING_TUPLE_DIR, IDX_DIR
+from settings import SAMPLE_RATE, SAMPLE_IDS, MEMORY_BUDGET, AGGREGATE_TABLES
+from settings import DEDUP_EXACT, DEDUP_EQUIVALENT_CODES, DEDUP_TOLERANCE, STABLE_INDEX, CHECKPOINT
+
+
+'''
+Dataset adapters.
+An adapter describes a source dataset (where its tables are, how patients
+and times are identified, how codes are rolled up) so that the shared
+engine in pipeline.py can process MIMIC-IV and eICU in the same way.
+'''
+
+
+class TableSpec:
+    '''
+    Description of a source table in which every row is a single code.
+
+    Parameters:
+    ----
+        path:
+            filepath of the table, relative to the directory of the dataset
+        code_col:
+            the column containing the code
+        code_type:
+            code type of the table in the dictionary
+        time_col:
+            the column containing the time of the code
+        admission_col:
+            the column containing the admission ID (None if not available)
+        value_col:
+            the column output as the value of tuples (None if not available)
+        rollup:
+            function returning the roll-up dictionary of the code (None if not rolled up)
+        code_filter:
+            function returning a mask of valid codes before rolling up,
+            applied when generating the dictionary (None to keep all codes)
+        chunksize:
+            number of rows per chunk when generating tuples (None to load the whole table)
+    '''
+
+    def __init__(self, path, code_col, code_type, time_col, admission_col=None,
+                 value_col=None, rollup=None, code_filter=None, chunksize=None):
+        self.path = path
+        self.code_col = code_col
+        self.code_type = code_type
+        self.time_col = time_col
+        self.admission_col = admission_col
+        self.value_col = value_col
+        self.rollup = rollup
+        self.code_filter = code_filter
+        self.chunksize = chunksize
+
+
+def _valid_ndc(code):
+    '''
+    NDC codes which are neither empty nor "0" and have 11 digits
+    '''
+
+    return (~code.isna()) & (code != '0') & (code.str.len() == 11)
+
+
+def patient_shard(pids, n_shards):
+    '''
+    Shard of each patient, a deterministic hash of the ID
+    (the same on every run and every machine)
+    '''
+
+    pids = np.asarray(pids).astype(str).astype(object)
+    return (pd.util.hash_array(pids) % n_shards).astype(np.int64)
+
+
+def patient_sample(pids, rate):
+    '''
+    Mask of the patients in a deterministic sample of the given rate.
+    The hash is keyed differently from patient_shard(), so a sample is spread over all shards,
+    and a smaller sample is always a subset of a larger one.
+    '''
+
+    if rate >= 1:
+        return np.ones(len(pids), dtype=bool)
+    pids = np.asarray(pids).astype(str).astype(object)
+    return pd.util.hash_array(pids, hash_key='patient-sample-1') < np.uint64(int(rate * 2**64))
+
+
+def load_sample_ids(sample_ids):
+    '''
+    Set of patients' ID in SAMPLE_IDS (a list of IDs, or the filepath of a file with an ID per line)
+    '''
+
+    if isinstance(sample_ids, str):
+        with open(sample_ids, 'r', encoding='utf8') as f:
+            sample_ids = [l.strip() for l in f]
+    return set(str(i) for i in sample_ids if str(i) != '')
+
+
+class DatasetAdapter:
+    '''
+    Description of a source dataset.
+
+    Attributes:
+    ----
+        name:
+            name of the dataset
+        src_dir:
+            directory of the original files
+        patient_path:
+            filepath of the patient table, relative to src_dir
+        patient_key:
+            the column identifying a patient in every table
+        time_kind:
+            'datetime' if times are timestamps, 'offset' if they are integer offsets
+        time_unit:
+            seconds per unit of the times in tuples (seconds since the epoch for timestamps)
+        code_key:
+            how a code is referred to in tuples,
+            'type_code' for "<code_type>_<code>" and 'index' for the index in code_dict.csv
+        empty_value:
+            value of tuples generated from tables without value
+        comma_decimal:
+            whether commas in values (escaped as '/') are decimal separators
+        tables:
+            TableSpec of the tables containing plain codes
+        schemas:
+            compact dtypes of the columns of source tables, see dtypes()
+        shard, n_shards:
+            when shard is not None, only the patients hashed into this shard
+            (out of n_shards) are processed, see set_shard()
+        sample_rate, sample_ids:
+            development mode, when not None only a deterministic sample of patients is processed
+            (see settings.SAMPLE_RATE and settings.SAMPLE_IDS)
+        memory_budget:
+            memory budget (bytes) of a chunk of a source table being processed,
+            None to use the fixed chunk sizes of each stage (see pipeline.ChunkSizer)
+        aggregate_tables:
+            time-bucketed aggregation of numeric tuples per source table when merging
+            (see settings.AGGREGATE_TABLES and pipeline.load_aggregation)
+        dedup_exact, dedup_equivalent_codes, dedup_tolerance:
+            deduplication of tuples when merging (see settings.DEDUP_EXACT and pipeline._dedup_patient)
+        stable_index:
+            whether the indices of code_dict.csv are kept across runs (see pipeline.register_codes)
+        checkpoint:
+            whether chunked stages record the chunks done and resume from them (see checkpoint.Journal)
+    '''
+
+    name = None
+    src_dir = None
+    patient_path = None
+    patient_key = None
+    time_kind = 'datetime'
+    time_unit = 1
+    code_key = 'type_code'
+    empty_value = ''
+    comma_decimal = False
+    tables = {}
+    schemas = {}
+
+    shard = None
+    n_shards = 1
+    shard_sources = {}
+
+    # patients' ID cached by patient_index(), with the selection of patients they were read for
+    _patients = None
+
+    sample_rate = SAMPLE_RATE
+    sample_ids = SAMPLE_IDS
+
+    memory_budget = MEMORY_BUDGET
+    aggregate_tables = AGGREGATE_TABLES
+    dedup_exact = DEDUP_EXACT
+    dedup_equivalent_codes = DEDUP_EQUIVALENT_CODES
+    dedup_tolerance = DEDUP_TOLERANCE
+    stable_index = STABLE_INDEX
+    checkpoint = CHECKPOINT
+
+    result_dir = RESULT_ROOT_DIR
+    tuple_dir = TUPLE_DIR
+    string_tuple_dir = STRING_TUPLE_DIR
+    idx_dir = IDX_DIR
+
+    def path(self, relpath):
+        '''
+        filepath of a source file of the dataset (its compressed version if only that exists, see compression.source_path)
+        '''
+
+        return compression.source_path(self.src_dir + relpath)
+
+    def load_patients(self):
+        '''
+        load all patients' ID in the order used by every tuple file.
+        '''
+
+        return list(self.patient_index())
+
+    def patient_index(self, integer=False):
+        '''
+        patients' ID in the order used by every tuple file, as a pandas.Index (of int64 if integer).
+        The patient table is read once, and again only if it or the selection of patients (sample, shard) changes.
+        '''
+
+        if self.sample_ids is not None and not isinstance(self.sample_ids, set):
+            self.sample_ids = load_sample_ids(self.sample_ids)
+        path = self.path(self.patient_path)
+        key = (path, os.stat(path).st_mtime_ns if os.path.exists(path) else None,
+               self.shard, self.n_shards, self.sample_rate, id(self.sample_ids))
+        if self._patients is None or self._patients['key'] != key:
+            self._patients = {'key': key, 'index': pd.Index(self._read_patients(), dtype=object), 'integer': None}
+
+        if not integer:
+            return self._patients['index']
+        if self._patients['integer'] is None:
+            self._patients['integer'] = pd.Index(self._patients['index'].astype('int64'))
+        return self._patients['integer']
+
+    def _read_patients(self):
+        '''
+        read all patients' ID from the patient table, in the order used by every tuple file
+        '''
+
+        patients = pd.read_csv(self.path(self.patient_path), usecols=[self.patient_key], dtype='str')
+        patients = patients.loc[self.select(patients[self.patient_key]), self.patient_key]
+        return list(dict.fromkeys(patients))
+
+    def select(self, pids, shard=True):
+        '''
+        mask of the patients processed by the adapter
+
+        Parameters:
+        ----
+            pids:
+                patients' ID
+            shard:
+                whether to keep only the patients of the shard
+                (False for a table already partitioned by shard, see sharding.partition_sources)
+
+        Returns:
+        ----
+            numpy boolean array
+        '''
+
+        mask = np.ones(len(pids), dtype=bool)
+        if self.sample_ids is not None:
+            if not isinstance(self.sample_ids, set):
+                self.sample_ids = load_sample_ids(self.sample_ids)
+            mask &= np.asarray(pd.Series(pids).astype(str).isin(self.sample_ids))
+        if self.sample_rate is not None:
+            mask &= patient_sample(pids, self.sample_rate)
+        if shard and self.shard is not None:
+            mask &= patient_shard(pids, self.n_shards) == self.shard
+        return mask
+
+    @property
+    def selecting(self):
+        '''
+        whether only a part of the patients is processed (a sample or a shard)
+        '''
+
+        return self.shard is not None or self.sampling
+
+    @property
+    def sampling(self):
+        '''
+        whether only a sample of the patients is processed
+        '''
+
+        return self.sample_rate is not None or self.sample_ids is not None
+
+    def dtypes(self, tablename, setting):
+        '''
+        dtypes to read a source table with:
+        the dtypes in setting, replaced by the compact dtypes registered in schemas
+        (integer IDs, categorical low-cardinality text, float values).
+
+        Parameters:
+        ----
+            tablename:
+                name of the table in schemas
+            setting:
+                dict of columns to their default dtypes
+
+        Returns:
+        ----
+            dict of columns to dtypes
+        '''
+
+        schema = self.schemas.get(tablename, {})
+        return {col: schema.get(col, dtype) for col, dtype in setting.items()}
+
+    def set_shard(self, shard, n_shards, sources=None):
+        '''
+        Restrict the adapter to the patients of a shard.
+        Tuples of the shard are written under result_dir/shards/<shard>/.
+        sources maps the source tables to their rows of the shard (see sharding.partition_sources),
+        which are read instead of the whole tables.
+        '''
+
+        self.shard = shard
+        self.n_shards = n_shards
+        self.shard_sources = {} if sources is None else dict(sources)
+        self.shard_dir = self.result_dir + 'shards/{}/'.format(shard)
+        self.tuple_dir = self.shard_dir + 'tuple/'
+        self.string_tuple_dir = self.shard_dir + 'string_tuple/'
+        self.make_dirs()
+
+    def set_delta(self, patient_ids):
+        '''
+        Restrict the adapter to new or changed patients (see delta.run_delta).
+        Tuples of these patients are written under result_dir/delta/.
+        '''
+
+        self.sample_ids = set(str(i) for i in patient_ids)
+        self.shard_dir = self.result_dir + 'delta/'
+        self.tuple_dir = self.shard_dir + 'tuple/'
+        self.string_tuple_dir = self.shard_dir + 'string_tuple/'
+        self.make_dirs()
+
+    def code_ids(self, dic):
+        '''
+        IDs of codes in tuples for each entry of code_dict.csv
+
+        Parameters:
+        ----
+            dic:
+                code_dict.csv loaded with dtype str and the column "index"
+
+        Returns:
+        ----
+            pandas.Series of the IDs
+        '''
+
+        if self.code_key == 'index':
+            return dic['index'].astype(str)
+        return dic['code_type'] + '_' + dic['code']
+
+    def make_dirs(self):
+        '''
+        make sure all the output directories exist
+        '''
+
+        for d in [self.result_dir, self.tuple_dir, self.string_tuple_dir, self.idx_dir]:
+            os.makedirs(d, exist_ok=True)
+
+
+# IDs of patients, admissions and stays in MIMIC-IV (nullable where rows may have no admission)
+_MIMIC_IDS = {'subject_id': 'int64', 'hadm_id': 'Int64', 'stay_id': 'Int64'}
+
+
+class MIMICAdapter(DatasetAdapter):
+    '''
+    MIMIC-IV v1.0 (with MIMIC-IV-ED)
+    '''
+
+    name = 'mimic'
+    src_dir = MIMIC_DIR
+    patient_path = 'hosp/patients.csv/patients.csv'
+    patient_key = 'subject_id'
+    time_kind = 'datetime'
+    code_key = 'type_code'
+    empty_value = ''
+
+    tables = {
+        'prescriptions': TableSpec('hosp/prescriptions.csv/prescriptions.csv', 'ndc', 'rxnorm', 'starttime',
+                                   admission_col='hadm_id', rollup=rolluptool.get_ndc2rxnorm, code_filter=_valid_ndc),
+        'pyxis': TableSpec('ed/pyxis.csv/pyxis_ndc.csv', 'ndc', 'rxnorm', 'charttime',
+                           admission_col='stay_id', rollup=rolluptool.get_ndc2rxnorm, code_filter=_valid_ndc),
+        'medrecon': TableSpec('ed/medrecon.csv/medrecon.csv', 'ndc', 'rxnorm', 'charttime',
+                              admission_col='stay_id', rollup=rolluptool.get_ndc2rxnorm, code_filter=_valid_ndc),
+        'transfers': TableSpec('hosp/transfers.csv/transfers.csv', 'eventtype', 'transfer', 'intime',
+                               admission_col='hadm_id', value_col='careunit', chunksize=30000000),
+        'procedureevents': TableSpec('icu/procedureevents.csv/procedureevents.csv', 'itemid', 'mimic',
+                                     'starttime', admission_col='hadm_id'),
+        'inputevents': TableSpec('icu/inputevents.csv/inputevents.csv', 'itemid', 'mimic',
+                                 'starttime', admission_col='hadm_id'),
+    }
+
+    # values output in tuples keep their original text (str) or float64,
+    # float32 would change how the values are formatted
+    schemas = {
+        'labevents': dict(_MIMIC_IDS, itemid='int32', valuenum='float64', valueuom='category'),
+        'chartevents': dict(_MIMIC_IDS, itemid='int32', valuenum='float64', valueuom='category'),
+        'outputevents': dict(_MIMIC_IDS, itemid='int32', valueuom='category'),
+        'procedureevents': dict(_MIMIC_IDS, itemid='int32'),
+        'inputevents': dict(_MIMIC_IDS, itemid='int32'),
+        'transfers': dict(_MIMIC_IDS, eventtype='category', careunit='category'),
+        'prescriptions': dict(_MIMIC_IDS),
+        'pyxis': dict(_MIMIC_IDS),
+        'medrecon': dict(_MIMIC_IDS),
+        'diagnoses_icd': dict(_MIMIC_IDS, icd_version='category'),
+        'diagnosis': dict(_MIMIC_IDS, icd_version='category'),
+        'drgcodes': dict(_MIMIC_IDS, drg_type='category'),
+        'procedures_icd': dict(_MIMIC_IDS, icd_version='int8'),
+        'hcpcsevents': dict(_MIMIC_IDS),
+    }
+
+
+class EICUAdapter(DatasetAdapter):
+    '''
+    eICU Collaborative Research Database
+    '''
+
+    name = 'eicu'
+    src_dir = EICU_DIR
+    patient_path = 'patient.csv'
+    patient_key = 'patientunitstayid'
+    time_kind = 'offset'
+    time_unit = 60    # offsets in minutes
+    code_key = 'index'
+    empty_value = 'NaN'
+    comma_decimal = True
+
+    tables = {
+        'diagnosis': TableSpec('diagnosis.csv', 'diagnosisstring', 'eicu_diagnosis', 'diagnosisoffset'),
+        'medication': TableSpec('medication.csv', 'drugname', 'eicu_medication', 'drugstartoffset'),
+    }
+
+    schemas = {
+        'lab': {'patientunitstayid': 'int64', 'labresultoffset': 'int32', 'labresult': 'float64',
+                'labmeasurenamesystem': 'category'},
+        'infusiondrug': {'patientunitstayid': 'int64', 'infusionoffset': 'int32'},
+        'diagnosis': {'patientunitstayid': 'int64', 'diagnosisoffset': 'int32'},
+        'medication': {'patientunitstayid': 'int64', 'drugstartoffset': 'int32'},
+    }
+
+    def _read_patients(self):
+        '''
+        read all patients' ID, sorted as strings.
+        '''
+
+        return sorted(DatasetAdapter._read_patients(self))
+
+
+MIMIC = MIMICAdapter()
+EICU = EICUAdapter()
+
+ADAPTERS = {MIMIC.name: MIMIC, EICU.name: EICU}
@@ -0,0 +1,326 @@
+import os
+import shutil
+import itertools
+import collections
+import multiprocessing
+import math
+import pandas as pd
+import pipeline
+import profiling
+import compression
+import valuestats
+from pipeline import V_FREQ, FREQ
+from dataset import ADAPTERS
+
+
+'''
+Delta mode: incremental update of the merged tuples for new or changed patients.
+Only the tuples of these patients are generated (the adapter restricted to them, as a shard)
+into result_dir/delta/, then spliced into tuples.csv and string_tuples.csv,
+replacing the histories of these patients where they are without merging the other ones again.
+The frequencies of the revised dictionary and the rows of patients_dict.csv are updated in place;
+the other outputs derived from the merged tuples (tuples_normalized.csv, sequences/, the statistics of values
+in the dictionary) are not, and are reported as out of date.
+'''
+
+
+TUPLE_COLS = ['patient_id', 'admission_id', 'time', 'code', 'value']
+
+# rows per chunk when comparing two versions of a source table
+DIFF_CHUNKSIZE = 5000000
+
+
+@profiling.stage
+def changed_patients(old_path, new_path, key, chunksize=DIFF_CHUNKSIZE):
+    '''
+    Patients whose rows differ between two versions of a source table (e.g. two releases), by a row-level diff:
+    the hashes of the rows (on the columns of both versions) of every patient are added up in each version,
+    patients whose sums or numbers of rows differ, or who are in a single version, have changed.
+
+    Parameters:
+    ----
+        old_path, new_path:
+            filepaths of the previous and the new version of the table
+        key:
+            the column of patients' ID
+        chunksize:
+            rows per chunk
+
+    Returns:
+    ----
+        set of the IDs of the changed patients
+    '''
+
+    columns = [list(pd.read_csv(p, nrows=0).columns) for p in [old_path, new_path]]
+    columns = [c for c in columns[0] if c in columns[1]]
+
+    versions = []
+    for path in [old_path, new_path]:
+        parts = []
+        with pd.read_csv(path, usecols=columns, dtype=str, keep_default_na=False, index_col=False,
+                         chunksize=chunksize) as reader:
+            for chunk in reader:
+                profiling.count('rows_in', len(chunk))
+                hashes = pd.util.hash_pandas_object(chunk[columns], index=False)
+                parts.append(hashes.groupby(chunk[key].values).agg(['sum', 'size']))
+        if len(parts) == 0:
+            versions.append(pd.DataFrame({'sum': [], 'size': []}))
+            continue
+        # sums of uint64 wrap around, the same way in both versions
+        versions.append(pd.concat(parts).groupby(level=0).sum())
+
+    old, new = versions
+    both = old.index.intersection(new.index)
+    changed = set(old.index.symmetric_difference(new.index))
+    differ = (old.loc[both, 'sum'].values != new.loc[both, 'sum'].values) | \
+             (old.loc[both, 'size'].values != new.loc[both, 'size'].values)
+    changed.update(both[differ])
+    print('{} patients changed between {} and {}'.format(len(changed), old_path, new_path))
+    return set(str(i) for i in changed)
+
+
+@profiling.stage
+def run_delta(adapter, jobs, patient_ids, dict_path=None, patient_func=None):
+    '''
+    Generate the tuples of new or changed patients and splice them into the merged tuples.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset to process
+        jobs:
+            list of (function, args) generating the tuples of a table, as for sharding.run_sharded()
+        patient_ids:
+            IDs of the new or changed patients (patients removed from the source lose their tuples)
+        dict_path:
+            filepath of the revised dictionary (frequencies counted on tuples.csv) to update in place,
+            None not to update it
+        patient_func:
+            function(tuple_path, out_path) generating patients_dict.csv, to update the rows of these patients
+            in result_dir/patients_dict.csv, None not to update it
+
+    Returns:
+    ----
+        No return
+    '''
+
+    patients = set(str(i) for i in patient_ids)
+    print('\nUpdating the tuples of {} patients'.format(len(patients)))
+
+    # the order of patients in the merged tuples
+    rank = {pid: i for i, pid in enumerate(adapter.load_patients())}
+
+    # a new process, so that the adapter is restricted to these patients only there
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        info = pool.apply(_run_delta, (adapter.name, jobs, sorted(patients), patient_func))
+
+    for key in ['tuples', 'string_tuples']:
+        path = adapter.result_dir + key + '.csv'
+        if not os.path.exists(path):
+            continue
+        removed, added = splice_tuples(adapter, path, info.get(key), patients, rank)
+        if key == 'tuples' and dict_path is not None and os.path.exists(dict_path):
+            update_frequencies(adapter, dict_path, removed, added)
+
+    path = adapter.result_dir + 'patients_dict.csv'
+    if patient_func is not None and os.path.exists(path):
+        splice_patients(path, info.get('patients_dict'), patients, rank)
+
+    _report_stale(adapter, dict_path)
+
+
+def _report_stale(adapter, dict_path):
+    '''
+    print the outputs derived from the merged tuples that the delta left out of date
+    '''
+
+    stale = [adapter.result_dir + p for p in ['tuples_normalized.csv', 'sequences/']
+             if os.path.exists(adapter.result_dir + p)]
+    if dict_path is not None and os.path.exists(dict_path):
+        columns = pd.read_csv(dict_path, nrows=0).columns
+        if any(c in columns for c in valuestats.STAT_COLS):
+            stale.append(dict_path + ' (statistics of values)')
+    for p in stale:
+        print('{} is out of date: generate it again from the updated tuples'.format(p))
+
+
+def _run_delta(name, jobs, patient_ids, patient_func):
+    '''
+    Generate and merge the tuples of the patients (run in a worker process)
+    '''
+
+    adapter = ADAPTERS[name]
+    shutil.rmtree(adapter.result_dir + 'delta/', ignore_errors=True)
+    adapter.set_delta(patient_ids)
+
+    if profiling.report_path is not None:
+        profiling.report_path = adapter.shard_dir + 'run_report.json'
+        profiling.profile_dir = adapter.shard_dir + 'profile/'
+
+    for func, args in jobs:
+        func(*args)
+
+    info = {}
+    for key, src_dir in [('tuples', adapter.tuple_dir), ('string_tuples', adapter.string_tuple_dir)]:
+        out_path = adapter.shard_dir + key + '.csv'
+        pipeline.merge_tuples(adapter, src_dir, TUPLE_COLS, out_path, aggregate=(key == 'tuples'),
+                              dedup=(key == 'tuples'))
+        if os.path.exists(out_path):
+            info[key] = out_path
+
+    if patient_func is not None and 'tuples' in info:
+        out_path = adapter.shard_dir + 'patients_dict.csv'
+        patient_func(info['tuples'], out_path)
+        info['patients_dict'] = out_path
+
+    return info
+
+
+@profiling.stage
+def splice_tuples(adapter, tuple_path, delta_path, patients, rank):
+    '''
+    Replace the tuples of patients in a merged file (in place) by the tuples of a delta file.
+    The merged file is streamed in its own order of patients (e.g. shard by shard after a sharded run):
+    the block of a patient already there is replaced where it is,
+    and the blocks of new patients are appended in the order of patients.
+    The delta file holds the blocks of the patients replaced only, and is loaded in memory.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the tuples
+        tuple_path:
+            filepath of the merged tuples
+        delta_path:
+            filepath of the merged tuples of the patients, None if they have no tuple
+        patients:
+            IDs of the patients replaced
+        rank:
+            dict of patients' ID to their position in the order of patients, for the new patients
+
+    Returns:
+    ----
+        (removed, added): numbers of tuples removed and added per code, as (total, with value) Counters
+    '''
+
+    print('Splicing {} into {}'.format(delta_path, tuple_path))
+    removed = (collections.Counter(), collections.Counter())
+    added = (collections.Counter(), collections.Counter())
+
+    new = {}
+    if delta_path is not None:
+        with compression.open_file(delta_path) as delta:
+            delta.readline()
+            for pid, lines in _blocks(delta):
+                _counted(adapter, (pid, lines), added)
+                new.setdefault(pid, []).extend(lines)
+
+    tmp_path = tuple_path + '.tmp'
+    with compression.open_file(tuple_path) as f, compression.open_file(tmp_path, 'w', newline='') as out:
+        out.write(f.readline())
+        for pid, lines in _blocks(f):
+            if _replaced(adapter, (pid, lines), patients, removed):
+                # the first block of the patient takes the new tuples
+                lines = new.pop(pid, [])
+            out.writelines(lines)
+        for pid in sorted(new, key=lambda p: rank.get(p, len(rank))):
+            out.writelines(new[pid])
+
+    os.replace(tmp_path, tuple_path)
+
+    profiling.count('rows_in', sum(removed[0].values()))
+    profiling.count('rows_out', sum(added[0].values()))
+    print('removed {} tuples, added {}'.format(sum(removed[0].values()), sum(added[0].values())))
+    return removed, added
+
+
+def _blocks(f):
+    '''
+    blocks of lines of the patients in a merged file (after its header): (patient's ID, lines)
+    '''
+
+    for pid, lines in itertools.groupby(f, key=lambda l: l[:l.find(',')]):
+        yield pid, list(lines)
+
+
+def _replaced(adapter, block, patients, removed):
+    '''
+    whether a block of the merged file is replaced, counting its tuples if so
+    '''
+
+    if block[0] not in patients:
+        return False
+    _counted(adapter, block, removed)
+    return True
+
+
+def _counted(adapter, block, counts):
+    '''
+    count the tuples of a block per code, in total and with a numeric value (as revise_code_dict())
+    '''
+
+    total, with_value = counts
+    for l in block[1]:
+        row = l.rstrip('\n').split(',', 4)
+        total[row[3]] += 1
+        value = row[4].replace('/', '.') if adapter.comma_decimal else row[4]
+        try:
+            if not math.isnan(float(value)):
+                with_value[row[3]] += 1
+        except ValueError:
+            pass
+    return True
+
+
+@profiling.stage
+def update_frequencies(adapter, dict_path, removed, added):
+    '''
+    Update the frequencies of a revised dictionary (counted on tuples.csv) in place,
+    from the numbers of tuples removed and added per code by splice_tuples()
+    '''
+
+    print('Updating the frequencies of', dict_path)
+    dic = valuestats.format_columns(pd.read_csv(dict_path, index_col=False))
+    ids = adapter.code_ids(pd.read_csv(dict_path, dtype=str, index_col=False))
+
+    for col, old, new in [(FREQ, removed[0], added[0]), (V_FREQ, removed[1], added[1])]:
+        change = ids.map(pd.Series(new, dtype='int64')).fillna(0) - ids.map(pd.Series(old, dtype='int64')).fillna(0)
+        dic[col] = (dic[col] + change.values).astype('int64')
+
+    tmp_path = dict_path + '.tmp'
+    dic.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, dict_path)
+    profiling.count('rows_out', len(dic))
+
+
+@profiling.stage
+def splice_patients(path, delta_path, patients, rank):
+    '''
+    Replace the rows of patients in patients_dict.csv (in place) by the rows generated for them:
+    rows of patients already there keep their position, rows of new patients are appended in the order of patients
+    '''
+
+    print('Updating the patients of', path)
+    # the header is kept as it is (it may repeat the column of patients' ID)
+    with open(path, 'r', encoding='utf8') as f:
+        header = f.readline()
+    table = pd.read_csv(path, dtype=str, keep_default_na=False, index_col=False, header=None, skiprows=1)
+    new = pd.DataFrame(columns=table.columns)
+    if delta_path is not None:
+        new = pd.read_csv(delta_path, dtype=str, keep_default_na=False, index_col=False, header=None, skiprows=1)
+
+    # position of every row: its old one, or after all the old rows by the order of patients
+    position = pd.Series(range(len(table)), index=table[0].values)
+    position = position[~position.index.duplicated()]
+    order = new[0].map(position)
+    order = order.fillna(len(table) + new[0].map(rank).fillna(len(rank)))
+    kept = table.loc[~table[0].isin(patients)]
+    table = pd.concat([kept.assign(_order=kept.index.values.astype(float)),
+                       new.assign(_order=order.values.astype(float))], ignore_index=True)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8', newline='') as out:
+        out.write(header)
+        table.sort_values('_order', kind='mergesort').drop(columns='_order').to_csv(out, index=False, header=False)
+    os.replace(tmp_path, path)
+    profiling.count('rows_out', len(table))
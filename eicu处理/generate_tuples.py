@@ -5,17 +5,21 @@ import pandas as pd
 from tqdm import tqdm
 import json
 
-# 修改为适配 eICU 的设置
-EICU_DIR = 'eicu/'  # eICU 数据文件目录
-RESULT_ROOT_DIR = 'records/'  # 结果输出目录
-TUPLE_DIR = RESULT_ROOT_DIR + 'tuple/'
-IDX_DIR = RESULT_ROOT_DIR + 'index/'
+# 使用仓库根目录下的共享流水线 (pipeline.py) 和 eICU 数据集适配器 (dataset.py)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pipeline
+import profiling
+import sharding
+import delta
+import checkpoint
+from dataset import EICU, load_sample_ids
+from settings import N_SHARDS, N_WORKERS, OUTPUT_SHARDS, DELTA_PATIENTS, DELTA_DIFF
 
 # 确保目录存在
-os.makedirs(RESULT_ROOT_DIR, exist_ok=True)
-os.makedirs(TUPLE_DIR, exist_ok=True)
-os.makedirs(IDX_DIR, exist_ok=True)
+EICU.make_dirs()
 
+
+@profiling.stage
 def generate_diagnosis_tuples(tablename='diagnosis'):
     '''
     为eICU诊断表生成元组
@@ -28,31 +32,10 @@ def generate_diagnosis_tuples(tablename='diagnosis'):
     ----
         无返回值
     '''
-    print('\ngenerating tuples of', tablename)
-
-    # 加载代码字典
-    code2idx = _load_code_dict(tablename)
-
-    # 加载诊断表
-    path = EICU_DIR + tablename + '.csv'
-    cols = ['patientunitstayid', 'diagnosisoffset', 'diagnosisstring']
-    setting = {'patientunitstayid': str, 'diagnosisoffset': int, 'diagnosisstring': str}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
-
-    # 统一列名和顺序
-    table.rename({'patientunitstayid': 'subject_id',
-                  'diagnosisstring': 'code',
-                  'diagnosisoffset': 'time'}, axis=1, inplace=True)
-    table = table.loc[:, ['subject_id', 'code', 'time']]
-
-    # 过滤不在字典中的代码
-    table = table.loc[table['code'].isin(code2idx), :]
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(code2idx.get)
-
-    # 输出元组
-    _table2tuples(table, TUPLE_DIR + tablename, has_value=False)
+    pipeline.generate_code_tuples(EICU, tablename)
 
 
+@profiling.stage
 def generate_lab_tuples(tablename='lab'):
     '''
     为eICU实验室检查表生成元组
@@ -68,49 +51,43 @@ def generate_lab_tuples(tablename='lab'):
     print('\ngenerating tuples of', tablename)
 
     # 加载代码字典
-    dic = pd.read_csv(IDX_DIR + 'code_dict.csv', dtype={'code': str, 'code_type': str, 'with_value': str})
-    dic = dic.loc[dic['source_table'] == tablename, ['index', 'code', 'code_type', 'with_value']]
-    code2idx = {row['code']: str(row['index']) for _, row in dic.iterrows()}
-    print('code dict size:', len(code2idx))
-
-    code_with_value = set(dic.loc[dic['with_value'] == '1', 'code'])
-
-    # 加载患者字典
-    origin_patients = _load_patients()
+    code2idx, code_with_value = pipeline.load_value_codes(EICU, tablename)
 
     # 分块加载lab表
-    src_path = EICU_DIR + tablename + '.csv'
+    src_path = EICU.path(tablename + '.csv')
     setting = {'patientunitstayid': str, 'labresultoffset': int, 'labname': str, 'labresult': float}
 
-    with pd.read_csv(src_path, usecols=setting.keys(), index_col=False,
-                     chunksize=30000000, dtype=setting) as reader:
-        for i, chunk in enumerate(reader):
-            patients = {i: [] for i in origin_patients}
-
-            chunk = chunk.loc[:, ['patientunitstayid', 'labresultoffset', 'labname', 'labresult']]
-            for pid, offset, labname, labresult in tqdm(chunk.itertuples(False), total=chunk.shape[0]):
-                # 过滤不在字典中的代码
-                if labname not in code2idx:
-                    continue
-
-                # 创建元组: [admission_id, time, code, value]
-                tuple = ['', str(offset), code2idx[labname], '']
-
-                if labname in code_with_value:  # 带值的代码
-                    if not pd.isna(labresult):
-                        tuple[3] = str(labresult)
-                    else:
-                        tuple[3] = '_MISSING'
-                else:
-                    tuple[3] = 'NaN'
-
-                # 添加到患者记录
-                patients[pid].append(tuple)
+    # 之前失败的运行已完成的块会被跳过 (见 checkpoint.py)
+    journal = checkpoint.Journal(EICU, EICU.tuple_dir + tablename + '.journal',
+                                 [src_path, EICU.idx_dir + 'code_dict.csv'], {'chunksize': 30000000},
+                                 [(EICU.tuple_dir, tablename)])
+
+    with pipeline.read_table(EICU, src_path, usecols=setting.keys(), index_col=False,
+                             chunksize=30000000, dtype=EICU.dtypes(tablename, setting),
+                             codes=code2idx, code_col='labname',
+                             min_chunksize=pipeline.TUPLE_MIN_CHUNKSIZE) as reader:
+        for i, chunk in journal.chunks(reader):
+            # 不在字典中的代码在读取时已被过滤 (不在患者表中的患者由 frame2tuples 过滤)
+
+            # 向量化生成 value 列: 带值的代码输出数值或 _MISSING, 其余为 NaN
+            labresult = chunk['labresult']
+            value = np.where(labresult.isna(), '_MISSING', labresult.astype(str))
+            value = np.where(chunk['labname'].isin(code_with_value), value, 'NaN')
+
+            # 元组: [patient_id, admission_id, time, code, value]
+            table = pd.DataFrame({'subject_id': chunk['patientunitstayid'].values,
+                                  'admission_id': '',
+                                  'time': chunk['labresultoffset'].astype(str).values,
+                                  'code': chunk['labname'].map(code2idx).values,
+                                  'value': value})
 
             # 输出元组
-            _value_table2tuples(patients, TUPLE_DIR + tablename + str(i))
+            pipeline.frame2tuples(EICU, table, EICU.tuple_dir + tablename + str(i))
+            journal.commit(i)
+    journal.finish()
 
 
+@profiling.stage
 def generate_medication_tuples(tablename='medication'):
     '''
     为eICU药物表生成元组
@@ -123,31 +100,10 @@ def generate_medication_tuples(tablename='medication'):
     ----
         无返回值
     '''
-    print('\ngenerating tuples of', tablename)
-
-    # 加载代码字典
-    code2idx = _load_code_dict(tablename)
-
-    # 加载药物表
-    path = EICU_DIR + tablename + '.csv'
-    cols = ['patientunitstayid', 'drugstartoffset', 'drugname']
-    setting = {'patientunitstayid': str, 'drugstartoffset': int, 'drugname': str}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
-
-    # 统一列名和顺序
-    table.rename({'patientunitstayid': 'subject_id',
-                  'drugname': 'code',
-                  'drugstartoffset': 'time'}, axis=1, inplace=True)
-    table = table.loc[:, ['subject_id', 'code', 'time']]
-
-    # 过滤不在字典中的代码
-    table = table.loc[table['code'].isin(code2idx), :]
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(code2idx.get)
-
-    # 输出元组
-    _table2tuples(table, TUPLE_DIR + tablename, has_value=False)
+    pipeline.generate_code_tuples(EICU, tablename)
 
 
+@profiling.stage
 def generate_infusiondrug_tuples(tablename='infusiondrug'):
     '''
     为eICU输液药物表生成元组
@@ -163,200 +119,104 @@ def generate_infusiondrug_tuples(tablename='infusiondrug'):
     print('\ngenerating tuples of', tablename)
 
     # 加载代码字典
-    dic = pd.read_csv(IDX_DIR + 'code_dict.csv', dtype={'code': str, 'code_type': str, 'with_value': str})
-    dic = dic.loc[dic['source_table'] == tablename, ['index', 'code', 'code_type', 'with_value']]
-    code2idx = {row['code']: str(row['index']) for _, row in dic.iterrows()}
-    print('code dict size:', len(code2idx))
-
-    code_with_value = set(dic.loc[dic['with_value'] == '1', 'code'])
-
-    # 加载患者字典
-    origin_patients = _load_patients()
+    code2idx, code_with_value = pipeline.load_value_codes(EICU, tablename)
 
     # 分块加载infusiondrug表
-    src_path = EICU_DIR + tablename + '.csv'
+    src_path = EICU.path(tablename + '.csv')
     setting = {'patientunitstayid': str, 'infusionoffset': int, 'drugname': str, 'infusionrate': str}
 
-    with pd.read_csv(src_path, usecols=setting.keys(), index_col=False,
-                     chunksize=30000000, dtype=setting) as reader:
-        for i, chunk in enumerate(reader):
-            patients = {i: [] for i in origin_patients}
-
-            chunk = chunk.loc[:, ['patientunitstayid', 'infusionoffset', 'drugname', 'infusionrate']]
-            for pid, offset, drugname, infusionrate in tqdm(chunk.itertuples(False), total=chunk.shape[0]):
-                # 过滤不在字典中的代码
-                if drugname not in code2idx:
-                    continue
-
-                # 创建元组: [admission_id, time, code, value]
-                tuple = ['', str(offset), code2idx[drugname], '']
-
-                if drugname in code_with_value and not pd.isna(infusionrate) and infusionrate.strip() != '':
-                    tuple[3] = infusionrate.replace(',', '/')
-                else:
-                    tuple[3] = 'NaN'
-
-                # 添加到患者记录
-                patients[pid].append(tuple)
+    # 之前失败的运行已完成的块会被跳过 (见 checkpoint.py)
+    journal = checkpoint.Journal(EICU, EICU.tuple_dir + tablename + '.journal',
+                                 [src_path, EICU.idx_dir + 'code_dict.csv'], {'chunksize': 30000000},
+                                 [(EICU.tuple_dir, tablename)])
+
+    with pipeline.read_table(EICU, src_path, usecols=setting.keys(), index_col=False,
+                             chunksize=30000000, dtype=EICU.dtypes(tablename, setting),
+                             codes=code2idx, code_col='drugname',
+                             min_chunksize=pipeline.TUPLE_MIN_CHUNKSIZE) as reader:
+        for i, chunk in journal.chunks(reader):
+            # 不在字典中的代码在读取时已被过滤 (不在患者表中的患者由 frame2tuples 过滤)
+
+            # 向量化生成 value 列: 带值且输液速率非空时输出速率, 其余为 NaN
+            rate = chunk['infusionrate']
+            has_rate = chunk['drugname'].isin(code_with_value) & rate.notna() & (rate.str.strip() != '')
+            value = np.where(has_rate, rate.str.replace(',', '/', regex=False), 'NaN')
+
+            # 元组: [patient_id, admission_id, time, code, value]
+            table = pd.DataFrame({'subject_id': chunk['patientunitstayid'].values,
+                                  'admission_id': '',
+                                  'time': chunk['infusionoffset'].astype(str).values,
+                                  'code': chunk['drugname'].map(code2idx).values,
+                                  'value': value})
 
             # 输出元组
-            _value_table2tuples(patients, TUPLE_DIR + tablename + str(i))
+            pipeline.frame2tuples(EICU, table, EICU.tuple_dir + tablename + str(i))
+            journal.commit(i)
+    journal.finish()
 
 
-def _load_code_dict(tablename):
-    '''
-    加载代码字典，使用 index 列作为 code 的值
-    '''
-    dic = pd.read_csv(IDX_DIR + 'code_dict.csv', dtype={'code': str, 'code_type': str, 'with_value': str})
-    dic = dic.loc[dic['source_table'] == tablename, ['index', 'code', 'code_type', 'with_value']]
-    code2idx = {row['code']: str(row['index']) for _, row in dic.iterrows()}
-    print('code dict size:', len(code2idx))
-    return code2idx
+# 所有表, 用于分片执行
+TABLE_JOBS = [
+    (generate_diagnosis_tuples, ('diagnosis',)),
+    (generate_lab_tuples, ('lab',)),
+    (generate_medication_tuples, ('medication',)),
+    (generate_infusiondrug_tuples, ('infusiondrug',)),
+]
 
+# TABLE_JOBS读取的源表, 在分片执行前按分片切分 (见 sharding.partition_sources)
+SHARD_SOURCES = [EICU.path(t + '.csv') for t in ['diagnosis', 'lab', 'medication', 'infusiondrug']]
 
-def _table2tuples(table, oFile, has_value=False):
-    '''
-    将pandas.DataFrame表转换为一批元组并输出
 
-    Parameters:
-    ----
-        table: 要输出为元组的表
-        oFile: 输出文件的路径
-        has_value: 是否包含 value 列（对于 diagnosis 和 medication 表，设为 False）
+def main():
+    # 增量模式: 只生成新增或变更患者的元组, 并拼接进已有的输出
+    if DELTA_PATIENTS is not None or len(DELTA_DIFF) > 0:
+        run_delta()
+        split_output()
+        return
 
-    Returns:
-    ----
-        无返回值
-    '''
-    patients = _load_patients()
+    # 分片执行: 每个进程生成并合并自己分片内患者的元组
+    if N_SHARDS > 1:
+        sharding.run_sharded(EICU, TABLE_JOBS, N_SHARDS, N_WORKERS, sources=SHARD_SOURCES)
+        split_output()
+        return
 
-    for p, c, t in tqdm(table.itertuples(False), total=table.shape[0]):
-        if p in patients:
-            if has_value:
-                patients[p].append(('', str(t), c, ''))  # value 会在调用时处理
-            else:
-                patients[p].append(('', str(t), c, 'NaN'))  # 非 lab 表，value 为 NaN
+    # 为每个eICU表生成元组
+    generate_diagnosis_tuples('diagnosis')
+    generate_lab_tuples('lab')
+    generate_medication_tuples('medication')
+    generate_infusiondrug_tuples('infusiondrug')
 
-    with open(oFile + '.tri', 'w', encoding='utf8') as f:
-        for id, info in patients.items():
-            if len(info) > 0:  # 只写入有记录的患者
-                f.write(str(id) + '\n')
-                for l in info:
-                    f.write(','.join(l) + '\n')
-                f.write('\n')
+    # 合并所有表的元组
+    cols = ['patient_id', 'admission_id', 'time', 'code', 'value']
+    pipeline.merge_tuples(EICU, EICU.tuple_dir, cols, EICU.result_dir + 'tuples.csv', aggregate=True, dedup=True)
+    split_output()
 
 
-def _value_table2tuples(patients, oFile):
+def run_delta():
     '''
-    输出带值的表的元组
-
-    Parameters:
-    ----
-        patients: 要输出的元组
-        oFile: 输出文件的路径
-
-    Returns:
-    ----
-        无返回值
+    更新 DELTA_PATIENTS 中的患者以及 DELTA_DIFF 各表中行有变化的患者的元组、患者字典和修订后字典的频率
     '''
-    with open(oFile + ".tri", 'w', encoding='utf8') as f:
-        for id, info in patients.items():
-            if len(info) > 0:  # 只写入有记录的患者
-                f.write(str(id) + '\n')
-                for l in info:
-                    l[3] = str(l[3]).replace(',', '/')
-                    f.write(','.join(l) + '\n')
-                f.write('\n')
 
+    # 仅增量模式需要后处理 (患者字典), 在此导入
+    import postprocess
 
-def _load_patients():
-    '''
-    加载所有患者ID
-    '''
-    patients = pd.read_csv(EICU_DIR + 'patient.csv', usecols=['patientunitstayid'], dtype='str')
-    patients = {i: [] for i in patients['patientunitstayid']}
-    return patients
-
+    patient_ids = set()
+    if DELTA_PATIENTS is not None:
+        patient_ids |= load_sample_ids(DELTA_PATIENTS)
+    for old_path, new_path in DELTA_DIFF:
+        patient_ids |= delta.changed_patients(old_path, new_path, 'patientunitstayid')
 
-def merge_tuples_simple(src_dir, cols, out_path):
-    '''
-    使用更简单的方法合并所有表的元组
+    delta.run_delta(EICU, TABLE_JOBS, patient_ids, EICU.result_dir + 'code_dict_revised.csv',
+                    postprocess.generate_patient_dict)
 
-    Parameters:
-    ----
-        src_dir: 元组的源目录
-        cols: 输出文件的列名
-        out_path: 输出合并元组的文件路径
 
-    Returns:
-    ----
-        无返回值
+def split_output():
+    '''
+    按事件数将 tuples.csv 均衡地拆分为多个分片, 供分布式训练使用 (设置 OUTPUT_SHARDS 时)
     '''
-    print("\nMerging tuples in {}".format(src_dir))
-
-    # 检查目录中是否有.tri文件
-    tri_files = [i for i in os.listdir(src_dir) if '.tri' in i]
-    if not tri_files:
-        print(f"No .tri files found in {src_dir}")
-        return
-
-    # 创建患者字典，用于存储所有患者的所有元组
-    all_patients = {}
-
-    # 从每个.tri文件中读取元组
-    for tri_file in tri_files:
-        print(f"Processing {tri_file}...")
-
-        with open(src_dir + tri_file, 'r', encoding='utf8') as f:
-            current_patient = None
-            for line in f:
-                line = line.strip()
-
-                if not line:  # 空行表示一个患者的记录结束
-                    current_patient = None
-                    continue
-
-                if current_patient is None:  # 当前行是患者ID
-                    current_patient = line
-                    if current_patient not in all_patients:
-                        all_patients[current_patient] = []
-                else:  # 当前行是一条元组记录
-                    tuple_data = line.split(',')
-                    all_patients[current_patient].append(tuple_data)
-
-    # 按患者ID顺序写入输出文件
-    with open(out_path, 'w', encoding='utf8') as f:
-        # 写入表头
-        f.write(','.join(cols) + '\n')
-
-        # 对患者ID进行排序，确保顺序一致
-        for patient_id in sorted(all_patients.keys()):
-            tuples = all_patients[patient_id]
-
-            # 如果患者没有元组，则跳过
-            if not tuples:
-                continue
-
-            # 按时间排序
-            tuples.sort(key=lambda x: int(x[1]))  # 确保时间是数值型排序
-
-            # 写入每条元组记录
-            for tuple_data in tuples:
-                f.write(patient_id + ',' + ','.join(tuple_data) + '\n')
-
-    print(f"Merged {len(all_patients)} patients' data to {out_path}")
-
-
-def main():
-    # 为每个eICU表生成元组
-    generate_diagnosis_tuples('diagnosis')
-    generate_lab_tuples('lab')
-    generate_medication_tuples('medication')
-    generate_infusiondrug_tuples('infusiondrug')
 
-    # 使用简化的合并函数
-    cols = ['patient_id', 'admission_id', 'time', 'code', 'value']
-    merge_tuples_simple(TUPLE_DIR, cols, RESULT_ROOT_DIR + 'tuples.csv')
+    if OUTPUT_SHARDS is not None:
+        sharding.split_balanced(EICU.result_dir + 'tuples.csv', OUTPUT_SHARDS, EICU.result_dir + 'output_shards/')
 
 
 if __name__ == '__main__':
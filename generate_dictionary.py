@@ -5,51 +5,14 @@ import pandas as pd
 from tqdm import tqdm
 import json
 import rolluptool
-from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR, UOM_SRC
-
-
-V_FREQ = 'value_frequency'
-FREQ = 'total_frequency'
-
-idx_cols = ['code','code_type',V_FREQ,FREQ,'source_table','unit_of_measurement','with_value']
-
-
-def _output_dict(table:pd.DataFrame, tablename:str):
-    '''
-    Parameters:
-    ----
-        table:
-            The dictionary to output
-        tablename:
-            tablename of the input/output file
-            
-    Returns:
-    ----
-        No return
-    '''
-    
-    table = table.groupby(['code', 'code_type']).count()
-    print('unknown freq', int(table.loc['<unk>', FREQ]) if '<unk>' in table.index else 0)
-    if '<unk>' in table.index:
-        table.drop(['<unk>'], inplace=True)
-        
-    #table = table.loc[(table[FREQ] >= 1000)]
-    
-    table.sort_values(FREQ, inplace=True)
-    table[V_FREQ] = 0
-    table['source_table'] = tablename
-    table['unit_of_measurement'] = ''
-    table['with_value'] = 0
-    table.to_csv(IDX_DIR + tablename + '_dict.dict', columns=idx_cols[2:], index_label=['code', 'code_type'])
-
-    table.reset_index(inplace=True)
-    all_type = table['code_type'].unique()
-    for ctype in all_type:
-        temp_table = table.loc[table['code_type'] == ctype]
-        print('type', 'code_num', 'final', 'mean', 'median','max', 'min', sep='\t')
-        print(ctype, temp_table.shape[0], temp_table[FREQ].sum(), int(temp_table[FREQ].mean()), 
-            temp_table[FREQ].median(), temp_table[FREQ].max(), temp_table[FREQ].min(), sep='\t')
-        print('')
+import pipeline
+import profiling
+import valuestats
+import checkpoint
+import compression
+from pipeline import V_FREQ, FREQ, P_FREQ, idx_cols
+from dataset import MIMIC
+from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR, UOM_SRC, PRUNE_RULES
 
 
 def _procedures_icd_dict(tablename):
@@ -66,7 +29,8 @@ def _procedures_icd_dict(tablename):
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv/'+ tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'seq_num', 'chartdate', 'icd_code', 'icd_version']
     setting = {'icd_code': str, 'icd_version':int}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = pipeline.read_table(MIMIC, path, usecols=setting.keys(), dtype=MIMIC.dtypes('procedures_icd', setting),
+                                index_col=False)
     table.rename({'icd_code':'code', 'icd_version':'code_type'}, axis=1, inplace=True)
     print('number of code before rolling up:', 
           table[['code', 'code_type']].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -93,7 +57,8 @@ def _hcpcsevents_dict(tablename):
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv/'+ tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'chartdate', 'hcpcs_cd', 'seq_num', 'short_description']
     setting = {'hcpcs_cd': str}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = pipeline.read_table(MIMIC, path, usecols=setting.keys(), dtype=MIMIC.dtypes('hcpcsevents', setting),
+                                index_col=False)
     table.rename({'hcpcs_cd':'code'}, axis=1, inplace=True)
     print('number of code before rolling up:', 
           table['code'].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -106,6 +71,7 @@ def _hcpcsevents_dict(tablename):
     return table
 
 
+@profiling.stage
 def generate_ccs_dict(tablename):
     '''
     Generate dictionary for hcpcsevents and procedures_icd (CCS Codes)
@@ -125,7 +91,7 @@ def generate_ccs_dict(tablename):
     t2 = _procedures_icd_dict('procedures_icd')
     
     t1 = t1.append(t2)
-    _output_dict(t1, tablename)
+    pipeline.output_dict(MIMIC, t1, tablename)
 
 
 # def generate_drgcodes_dict(tablename):
@@ -155,7 +121,8 @@ def generate_ccs_dict(tablename):
 #     table.loc[:, 'total_frequency'] = 1
 #     table.loc[:, 'code_type'] = 'drg'
 #
-#     _output_dict(table, tablename)
+#     pipeline.output_dict(MIMIC, table, tablename)
+@profiling.stage
 def generate_drgcodes_dict(tablename):
     '''
     Generate dictionary for drgcodes.csv (DRG Codes)
@@ -176,7 +143,8 @@ def generate_drgcodes_dict(tablename):
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv/' + tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'drg_type', 'drg_code', 'description', 'drg_severity', 'drg_mortality']
     setting = {'drg_code': 'str', 'drg_type': 'str'}  # 添加 drg_type
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = pipeline.read_table(MIMIC, path, usecols=setting.keys(), dtype=MIMIC.dtypes(tablename, setting),
+                                index_col=False)
 
     # 创建组合代码
     table['code'] = table.apply(lambda x: f"{x['drg_type']}_{x['drg_code']}", axis=1)
@@ -194,9 +162,10 @@ def generate_drgcodes_dict(tablename):
         'code_type': 'first'
     }).reset_index()
 
-    _output_dict(table, tablename)
+    pipeline.output_dict(MIMIC, table, tablename)
     
     
+@profiling.stage
 def generate_diagnoses_icd_dict(tablename):
     '''
     Generate a dictionary for diagnoses_icd.csv (PheCode).
@@ -219,8 +188,9 @@ def generate_diagnoses_icd_dict(tablename):
     
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv/'+ tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'seq_num', 'icd_code', 'icd_version']
-    setting = {'icd_code': str, 'icd_version':str}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    setting = {'subject_id': str, 'icd_code': str, 'icd_version':str}
+    table = pipeline.read_table(MIMIC, path, usecols=setting.keys(), dtype=MIMIC.dtypes(tablename, setting),
+                                index_col=False)
     table.rename({'icd_code':'code', 'icd_version':'code_type'}, axis=1, inplace=True)
     print('number of code before rolling up:', 
           table[['code', 'code_type']].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -229,10 +199,8 @@ def generate_diagnoses_icd_dict(tablename):
     table9 = table.loc[table['code_type'] == '9'].copy()
     table10 = table.loc[table['code_type'] == '10'].copy()
     
-    table9.loc[~table9['code'].isin(icd92phe), 'code_type'] = 'icd9'
-    table9.loc[table9['code'].isin(icd92phe), 'code_type'] = 'phecode'
-    table10.loc[~table10['code'].isin(icd102phe), 'code_type'] =  'icd10'
-    table10.loc[table10['code'].isin(icd102phe), 'code_type'] = 'phecode'
+    table9['code_type'] = np.where(table9['code'].isin(icd92phe), 'phecode', 'icd9')
+    table10['code_type'] = np.where(table10['code'].isin(icd102phe), 'phecode', 'icd10')
     
     table9.loc[:, 'code'] = table9.loc[:, 'code'].apply(
         lambda x:(icd92phe[x] if x in icd92phe else x))
@@ -243,9 +211,10 @@ def generate_diagnoses_icd_dict(tablename):
     table = table9.append(table10)
     table.loc[:, 'total_frequency'] = 1
     
-    _output_dict(table, tablename)
+    pipeline.output_dict(MIMIC, table, tablename)
 
 
+@profiling.stage
 def generate_diagnoses_ed_icd_dict(tablename):
     '''
     Generate a dictionary for diagnosis.csv (PheCode).
@@ -268,8 +237,9 @@ def generate_diagnoses_ed_icd_dict(tablename):
 
     path = MIMIC_DIR + 'ed/' + tablename + '.csv/' + tablename + '.csv'
     cols = ['subject_id', 'stay_id', 'seq_num', 'icd_code', 'icd_version',"icd_title"]
-    setting = {'icd_code': str, 'icd_version': str}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    setting = {'subject_id': str, 'icd_code': str, 'icd_version': str}
+    table = pipeline.read_table(MIMIC, path, usecols=setting.keys(), dtype=MIMIC.dtypes(tablename, setting),
+                                index_col=False)
     table.rename({'icd_code': 'code', 'icd_version': 'code_type'}, axis=1, inplace=True)
     print('number of code before rolling up:',
           table[['code', 'code_type']].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -278,10 +248,8 @@ def generate_diagnoses_ed_icd_dict(tablename):
     table9 = table.loc[table['code_type'] == '9'].copy()
     table10 = table.loc[table['code_type'] == '10'].copy()
 
-    table9.loc[~table9['code'].isin(icd92phe), 'code_type'] = 'icd9'
-    table9.loc[table9['code'].isin(icd92phe), 'code_type'] = 'phecode'
-    table10.loc[~table10['code'].isin(icd102phe), 'code_type'] = 'icd10'
-    table10.loc[table10['code'].isin(icd102phe), 'code_type'] = 'phecode'
+    table9['code_type'] = np.where(table9['code'].isin(icd92phe), 'phecode', 'icd9')
+    table10['code_type'] = np.where(table10['code'].isin(icd102phe), 'phecode', 'icd10')
 
     table9.loc[:, 'code'] = table9.loc[:, 'code'].apply(
         lambda x: (icd92phe[x] if x in icd92phe else x))
@@ -292,9 +260,10 @@ def generate_diagnoses_ed_icd_dict(tablename):
     table = table9.append(table10)
     table.loc[:, 'total_frequency'] = 1
 
-    _output_dict(table, tablename)
+    pipeline.output_dict(MIMIC, table, tablename)
 
 
+@profiling.stage
 def generate_prescriptions_dict(tablename):
     '''
     Generate a dictionary for Rxnorm (prescriptions.csv).
@@ -310,34 +279,10 @@ def generate_prescriptions_dict(tablename):
         No return
     '''
     
-    print('\ngenerating dict of', tablename)
-    
-    ndc2rxnorm = rolluptool.get_ndc2rxnorm()
-    
-    path = MIMIC_DIR + 'hosp/prescriptions.csv/prescriptions.csv'
-    cols = ['subject_id', 'hadm_id', 'pharmacy_id', 'starttime', 'stoptime', 'drug_type', 'drug', 'gsn', 'ndc', 'prod_strength', 'form_rx', 'dose_val_rx', 'dose_unit_rx', 'form_val_disp', 'form_unit_disp', 'doses_per_24_hrs', 'route']
-    
-    setting = {'ndc':str}
-    table = pd.read_csv(path, usecols=setting.keys(),
-            dtype=setting, index_col=False)
-   
-    table.rename({'ndc':'code'}, axis=1, inplace=True)
-    condition = (~table['code'].isna()) & (table['code'] != '0') & \
-         (table['code'].str.len() == 11) & (table['code'].isin(ndc2rxnorm))
-
-    table = table[condition]
-    print('freq before rolling up:', table.shape)
-    print('number of code before rolling up:', 
-           table['code'].drop_duplicates(keep='first', inplace=False).shape[0])
-    
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(
-        lambda x:ndc2rxnorm.get(x, '<unk>')) 
-    
-    table.loc[:, 'total_frequency'] = 1
-    table.loc[:, 'code_type'] = 'rxnorm'
-    _output_dict(table, tablename)
+    pipeline.generate_code_dict(MIMIC, tablename)
 
 
+@profiling.stage
 def generate_medrecon_dict(tablename):
     '''
     Generate a dictionary for Rxnorm (medrecon.csv).
@@ -353,35 +298,10 @@ def generate_medrecon_dict(tablename):
         No return
     '''
 
-    print('\ngenerating dict of', tablename)
-
-    ndc2rxnorm = rolluptool.get_ndc2rxnorm()
-
-    path = MIMIC_DIR + 'ed/medrecon.csv/medrecon.csv'
-    cols = ['subject_id', 'stay_id', 'charttime', 'name', 'gsn', 'ndc', 'etc_rn', 'etccode', 'etcdescription']
-
-    setting = {'ndc': str}
-    table = pd.read_csv(path, usecols=setting.keys(),
-                        dtype=setting, index_col=False)
-    table.rename({'ndc': 'code'}, axis=1, inplace=True)
-    condition = (~table['code'].isna()) & (table['code'] != '0') & \
-                (table['code'].str.len() == 11) & (table['code'].isin(ndc2rxnorm))
-
-    table = table[condition]
-    print('freq before rolling up:', table.shape)
-    print('number of code before rolling up:',
-          table['code'].drop_duplicates(keep='first', inplace=False).shape[0])
-
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(
-        lambda x: ndc2rxnorm.get(x, '<unk>'))
-
-    table.loc[:, 'total_frequency'] = 1
-    table.loc[:, 'code_type'] = 'rxnorm'
-    _output_dict(table, tablename)
-
-
+    pipeline.generate_code_dict(MIMIC, tablename)
 
 
+@profiling.stage
 def generate_pyxis_dict(tablename):
     '''
     Generate a dictionary for Rxnorm (medrecon.csv).
@@ -397,33 +317,10 @@ def generate_pyxis_dict(tablename):
         No return
     '''
 
-    print('\ngenerating dict of', tablename)
-
-    ndc2rxnorm = rolluptool.get_ndc2rxnorm()
-
-    path = MIMIC_DIR + 'ed/pyxis.csv/pyxis_ndc.csv'
-    cols = ['subject_id', 'stay_id', 'charttime', 'med_rn',"name", 'gsn_rn', 'gsn', 'ndc']
+    pipeline.generate_code_dict(MIMIC, tablename)
 
-    setting = {'ndc': str}
-    table = pd.read_csv(path, usecols=setting.keys(),
-                        dtype=setting, index_col=False)
 
-    table.rename({'ndc': 'code'}, axis=1, inplace=True)
-    print(table['code'])
-    condition = (~table['code'].isna()) & (table['code'] != '0') & \
-                (table['code'].str.len() == 11) & (table['code'].isin(ndc2rxnorm))
-
-    table = table[condition]
-    print('freq before rolling up:', table.shape)
-    print('number of code before rolling up:',
-          table['code'].drop_duplicates(keep='first', inplace=False).shape[0])
-
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(
-        lambda x: ndc2rxnorm.get(x, '<unk>'))
-
-    table.loc[:, 'total_frequency'] = 1
-    table.loc[:, 'code_type'] = 'rxnorm'
-    _output_dict(table, tablename)
+@profiling.stage
 def generate_transfers_dict(tablename):
     '''
     Generate a dictionary for transfers.csv
@@ -438,20 +335,10 @@ def generate_transfers_dict(tablename):
         No return
     '''
     
-    print('\ngenerating dict of', tablename)
-    
-    path = MIMIC_DIR + 'hosp/' + tablename + '.csv/'+ tablename + '.csv'
-    
-    setting = {'eventtype':str, 'hadm_id':str}
-    table = pd.read_csv(path, usecols=setting.keys(),
-            dtype=setting, index_col=False)
-    table.rename({'eventtype':'code'}, axis=1, inplace=True)
-    
-    table.loc[:, 'total_frequency'] = 1
-    table.loc[:, 'code_type'] = 'transfer'
-    _output_dict(table, tablename)
+    pipeline.generate_code_dict(MIMIC, tablename)
 
 
+@profiling.stage
 def generate_no_value_dict(tablename):
     '''
     Generate a dictionary for procedureevents.csv and inputevents.csv respectively
@@ -466,20 +353,52 @@ def generate_no_value_dict(tablename):
         No return
     '''
     
-    print('\ngenerating dict of', tablename)
-    
-    path = MIMIC_DIR + 'icu/{}.csv/'.format(tablename)+'{}.csv'.format(tablename)
-    
-    setting = {'itemid':str}
-    table = pd.read_csv(path, usecols=setting.keys(),
-            dtype=setting, index_col=False)
-    table.rename({'itemid':'code'}, axis=1, inplace=True)
-    
-    table.loc[:, 'total_frequency'] = 1
-    table.loc[:, 'code_type'] = 'mimic'
-    _output_dict(table, tablename)
+    pipeline.generate_code_dict(MIMIC, tablename)
+
+
+def _converted_values(chunk, value_col, uom_dict):
+    '''
+    Values of a chunk converted to the main unit of their codes, computed column-wise
+    (the values kept as final_value by generate_value_dict)
+
+    Parameters:
+    ----
+        chunk:
+            rows with the columns itemid, value_col and valueuom
+        value_col:
+            the column containing value of code
+        uom_dict:
+            dict of codes to their units of measurement ('<main>' and the factor of every unit)
+
+    Returns:
+    ----
+        codes and converted values (numpy arrays)
+    '''
 
+    # factor of every (code, unit), 1 for the main unit
+    factors = [(k, u, f) for k, v in uom_dict.items() if '<main>' in v for u, f in v.items() if u != '<main>']
+    factors += [(k, v['<main>'], 1) for k, v in uom_dict.items() if '<main>' in v]
+    factors = pd.DataFrame(factors, columns=['itemid', 'unit', 'factor']) \
+                .drop_duplicates(['itemid', 'unit'], keep='last')
+    factors['itemid'] = factors['itemid'].astype(np.int64)
+    factors['factor'] = factors['factor'].astype(np.float64)
 
+    # units are normalized once per distinct unit
+    uom, uniques = pd.factorize(chunk['valueuom'])
+    units = np.array([pipeline.normalize_unit(u) for u in uniques] + [pipeline.normalize_unit(np.nan)], dtype=object)
+    itemid = chunk['itemid'].to_numpy(dtype=np.int64)
+    factor = pd.DataFrame({'itemid': itemid, 'unit': units[uom]}) \
+                .merge(factors, how='left', on=['itemid', 'unit'])['factor'].to_numpy()
+    value = chunk[value_col].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    # zero values are kept whatever their unit, other values need a valid factor
+    has_main = np.isin(itemid, factors['itemid'].to_numpy())
+    keep = has_main & ~np.isnan(value) & ((value == 0) | (~np.isnan(factor) & (factor != 0)))
+    converted = np.where(value == 0, 0, value * factor)
+    return itemid[keep], converted[keep]
+
+
+@profiling.stage
 def generate_value_dict(tablename='outputevents', filedir='icu', value_col='valuenum'):
     '''
     Generate a dictionary for labevents, chartevents, and outputevents respectively
@@ -506,6 +425,12 @@ def generate_value_dict(tablename='outputevents', filedir='icu', value_col='valu
     # if a lab code always occurs with the same value, 
     # we regard it as a code without value
     value_record = {}
+
+    # statistics of the converted values of codes (see valuestats.py)
+    stats = {}
+
+    # distinct patients of codes
+    patients = pipeline.PatientCounter()
     
     # a dictionary to normalize units
     with open(UOM_SRC + '{}_uom_dict.json'.format(tablename), 'r', encoding='utf8') as f:
@@ -514,10 +439,19 @@ def generate_value_dict(tablename='outputevents', filedir='icu', value_col='valu
     
     # load the source table
     src_path = MIMIC_DIR + '{}/{}.csv/'.format(filedir, tablename)+"{}.csv".format( tablename)
-    setting = {'itemid':int, value_col:float, 'valueuom':str}
-    with pd.read_csv(src_path, usecols=setting.keys(), index_col=False,
-            chunksize=30000000) as reader:
-        for i, chunk in enumerate(reader):
+    setting = {'itemid':int, value_col:float, 'valueuom':str, 'subject_id':int}
+
+    # chunks done by a previous run that failed are skipped, with the counts saved after them (see checkpoint.py)
+    journal = checkpoint.Journal(MIMIC, MIMIC.idx_dir + tablename + '.journal',
+            [src_path, UOM_SRC + '{}_uom_dict.json'.format(tablename)], {'chunksize': 30000000, 'value_col': value_col})
+    freq_record, value_record, stats, patients = journal.load_state((freq_record, value_record, stats, patients))
+    with pipeline.read_table(MIMIC, src_path, usecols=setting.keys(), index_col=False,
+            chunksize=30000000, dtype=MIMIC.dtypes(tablename, setting)) as reader:
+        for i, chunk in journal.chunks(reader):
+            known = chunk['itemid'].isin(uom_dict.keys())
+            patients.update(chunk.loc[known, 'itemid'], chunk.loc[known, 'subject_id'])
+
+            chunk = chunk.loc[:, ['itemid', value_col, 'valueuom']]
             for itemid, valuenum, valueuom in tqdm(chunk.itertuples(False), total=chunk.shape[0]):
                 # 0:itemid, 1:valuenum, 2:valueuom
                 if itemid not in uom_dict:
@@ -532,7 +466,7 @@ def generate_value_dict(tablename='outputevents', filedir='icu', value_col='valu
                 freq_record[itemid]['total'] += 1
                 
                 # normalize unit of measurement
-                unit = _normalize_unit(valueuom)
+                unit = pipeline.normalize_unit(valueuom)
                 
                 if not pd.isna(valuenum):
                     if '<main>' in uom_dict[itemid]:
@@ -558,6 +492,10 @@ def generate_value_dict(tablename='outputevents', filedir='icu', value_col='valu
                         else:
                             value_record[itemid] = final_value
 
+            # statistics of the values of the chunk, vectorized per code
+            valuestats.update(stats, *_converted_values(chunk, value_col, uom_dict))
+            journal.commit(i, (freq_record, value_record, stats, patients))
+
     table = []
     for k, v in freq_record.items():
         if v['total'] >= 1:
@@ -577,31 +515,23 @@ def generate_value_dict(tablename='outputevents', filedir='icu', value_col='valu
     
     # fill in other columns of the dictionary table
     table['unit_of_measurement'] = table['code'].apply(change_uom)
-    table['unit_of_measurement'] = table['unit_of_measurement'].apply(_normalize_unit)
+    table['unit_of_measurement'] = table['unit_of_measurement'].apply(pipeline.normalize_unit)
     table.loc[table['with_value'] == 0, 'unit_of_measurement'] = ''
     table['source_table'] = tablename
     table['code_type'] = 'mimic'
+    table[P_FREQ] = table['code'].map(patients.counts())
 
-    table = table.loc[:, idx_cols]
+    # statistics of values as extra columns
+    table = valuestats.add_columns(table, stats)
+    valuestats.save_stats(stats, IDX_DIR + tablename + '_value_stats.json')
+
+    table = table.loc[:, idx_cols + [P_FREQ] + valuestats.STAT_COLS]
     table.sort_values(['with_value', FREQ], inplace=True)
     table.to_csv(IDX_DIR + tablename + '_dict.dict', index=False)
+    profiling.count('rows_out', len(table))
+    journal.finish()
 
 
-def _normalize_unit(unit):
-    '''
-    normalize unit of measurement
-    '''
-    
-    if pd.isna(unit):
-        return 'nan'
-    else:
-        unit = unit.lower().strip()
-        if unit == '' or unit == 'none' or unit == 'nan':
-            return 'nan'
-        else:
-            return unit
-        
-
 def remove_duplicate_codes():
     '''
     Remove duplicate codes between chartevents and labevents
@@ -609,7 +539,7 @@ def remove_duplicate_codes():
     
     print('Removing duplicate codes between chartevents and labevents...')
     
-    dup = pd.read_csv(MIMIC_DIR + 'icu/d_items.csv/'+"d_items.csv",
+    dup = pd.read_csv(compression.source_path(MIMIC_DIR + 'icu/d_items.csv/'+"d_items.csv"),
         usecols=['itemid', 'linksto','category'], dtype=str, index_col=None)
     
     dup = dup[(dup['linksto'] == 'chartevents') & (dup['category'] == 'Labs')]
@@ -623,56 +553,6 @@ def remove_duplicate_codes():
     dictionary.to_csv(IDX_DIR+'chartevents_dict.dict', index=False)
 
 
-def merge_dict(out_path):
-    '''
-    Merge dictionaries of all tables together.
-    
-    Parameters:
-    ----
-        out_path: filepath to output the merged dictionary
-            
-    Returns:
-    ----
-        No return
-    '''
-    
-    print('Merging all dictionaries together...')
-    
-    table = pd.DataFrame(columns=idx_cols)
-    
-    for tablename in os.listdir(IDX_DIR):
-        if '.dict' in tablename:
-            path = IDX_DIR + tablename
-            temp = pd.read_csv(path, dtype={'code':'str'}, index_col=False)
-            table = pd.concat((table, temp), ignore_index=True)
-    
-    # sort al entries
-    # table.sort_values(['with_value', 'total_frequency'], inplace=True, ignore_index=True)
-    table.sort_values(['code_type', 'with_value', 'total_frequency'], inplace=True, ignore_index=True)
-    table.index += 1
-    
-    # statistics
-    value_table = table.loc[table['with_value'] == 1]
-    print('ratio:', value_table[V_FREQ].divide(value_table[FREQ]).mean())
-    
-    print('total value:', table[V_FREQ].sum(), 'total freq', table[FREQ].sum())
-    # table.rename({V_FREQ:'value_frequency'}, inplace=True)
-    
-    print('all:')
-    print('code_num', 'final', 'mean', 'median','max', 'min', sep='\t')
-    print(table.shape[0], table[FREQ].sum(), int(table[FREQ].mean()), 
-          table[FREQ].median(), table[FREQ].max(), table[FREQ].min(), sep='\t')
-    print('-'*20)
-    
-    print('value:')
-    print('code_num', 'final', 'mean', 'median','max', 'min', sep='\t')
-    print(value_table.shape[0], value_table[V_FREQ].sum(), int(value_table[V_FREQ].mean()), 
-          value_table[V_FREQ].median(), value_table[V_FREQ].max(), value_table[V_FREQ].min(), sep='\t')
-    print('-'*20)
-    
-    # output dict
-    table.to_csv(out_path, index_label='index')
-
 def main():
     #generate a dictionary for each table
     # generate_prescriptions_dict('prescriptions')
@@ -695,7 +575,10 @@ def main():
     #remove_duplicate_codes()
 
     # merge all the dictionaries together
-    merge_dict(IDX_DIR + 'code_dict.csv')
+    pipeline.merge_dict(MIMIC, IDX_DIR + 'code_dict.csv')
+
+    # prune rare codes before generating tuples
+    pipeline.prune_dict(MIMIC, IDX_DIR + 'code_dict.csv', PRUNE_RULES)
 
 
 if __name__=='__main__':
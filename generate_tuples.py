@@ -4,8 +4,18 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import json
+import collections
 import rolluptool
-from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR, STRING_TUPLE_DIR, UOM_SRC
+import pipeline
+import strings
+import profiling
+import sharding
+import delta
+import checkpoint
+import compression
+from dataset import MIMIC, load_sample_ids
+from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR, STRING_TUPLE_DIR, UOM_SRC, N_SHARDS, N_WORKERS
+from settings import OUTPUT_SHARDS, INTERN_STRINGS, STRING_TOP_K, DELTA_PATIENTS, DELTA_DIFF
 
 
 '''
@@ -13,6 +23,7 @@ Generate tuplets from single form
 '''
 
 
+@profiling.stage
 def generate_prescriptions_table(tablename):
     '''
     Generate tuples for Rxnorm (prescriptions.csv).
@@ -28,34 +39,10 @@ def generate_prescriptions_table(tablename):
         No return
     '''
     
-    print('\ngenerating tuples of', tablename)
-    
-    # roll-up dictionary
-    ndc2rxnorm = rolluptool.get_ndc2rxnorm()
-    
-    # index dictionary
-    code2idx = _load_code_dict(tablename)
-    
-    # load the table
-    path = MIMIC_DIR + 'hosp/{}.csv/'.format(tablename)+ '{}.csv'.format(tablename)
-    cols = ['subject_id', 'hadm_id', 'pharmacy_id', 'starttime', 'stoptime', 'drug_type', 'drug', 'gsn', 'ndc', 'prod_strength', 'form_rx', 'dose_val_rx', 'dose_unit_rx', 'form_val_disp', 'form_unit_disp', 'doses_per_24_hrs', 'route']
-    
-    setting = {'subject_id':'str', 'hadm_id':str, 'ndc':'str', 'starttime':'str'}
-    table = pd.read_csv(path, usecols=setting.keys(),
-            parse_dates=['starttime'], infer_datetime_format=True,
-            dtype='str', index_col=False)
-    
-    # unify the names and order of columns
-    table.rename({'ndc':'code', 'starttime':'time'}, axis=1, inplace=True)
-    table = table.loc[:, ['subject_id', 'hadm_id', 'code', 'time']]
-    
-    # convert all codes to indexes and delete unwanted codes
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(lambda x:ndc2rxnorm.get(x, '<unk>')) 
-    table = table.loc[table['code'].isin(code2idx), :]
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(code2idx.get)
-    
-    # output
-    _table2tuples(table, TUPLE_DIR + tablename)
+    pipeline.generate_code_tuples(MIMIC, tablename)
+
+
+@profiling.stage
 def generate_pyxis_table(tablename):
     '''
     Generate tuples for Rxnorm (pyxis_ndc.csv).
@@ -70,36 +57,11 @@ def generate_pyxis_table(tablename):
     ----
         No return
     '''
+    
+    pipeline.generate_code_tuples(MIMIC, tablename)
 
-    print('\ngenerating tuples of', tablename)
-
-    # roll-up dictionary
-    ndc2rxnorm = rolluptool.get_ndc2rxnorm()
-
-    # index dictionary
-    code2idx = _load_code_dict(tablename)
-
-    # load the table
-    path = MIMIC_DIR + 'ed/pyxis.csv/pyxis_ndc.csv'
-    cols = ['subject_id', 'stay_id', 'charttime', 'med_rn',"name", 'gsn_rn', 'gsn', 'ndc']
-
-    setting = {'subject_id': 'str', 'stay_id': str, 'ndc': 'str', 'charttime': 'str'}
-    table = pd.read_csv(path, usecols=setting.keys(),
-                        parse_dates=['charttime'], infer_datetime_format=True,
-                        dtype='str', index_col=False)
-
-    # unify the names and order of columns
-    table.rename({'ndc': 'code', 'charttime': 'time'}, axis=1, inplace=True)
-    table = table.loc[:, ['subject_id', 'stay_id', 'code', 'time']]
-
-    # convert all codes to indexes and delete unwanted codes
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(lambda x: ndc2rxnorm.get(x, '<unk>'))
-    table = table.loc[table['code'].isin(code2idx), :]
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(code2idx.get)
-
-    # output
-    _table2tuples(table, TUPLE_DIR + tablename)
 
+@profiling.stage
 def generate_medrecon_table(tablename):
     '''
     Generate tuples for Rxnorm (medrecon.csv).
@@ -114,37 +76,11 @@ def generate_medrecon_table(tablename):
     ----
         No return
     '''
-
-    print('\ngenerating tuples of', tablename)
-
-    # roll-up dictionary
-    ndc2rxnorm = rolluptool.get_ndc2rxnorm()
-
-    # index dictionary
-    code2idx = _load_code_dict(tablename)
-
-    # load the table
-    path = MIMIC_DIR + 'ed/{}.csv/'.format(tablename) + '{}.csv'.format(tablename)
-    cols = ['subject_id', 'stay_id', 'charttime', 'name', 'gsn', 'ndc', 'etc_rn', 'etccode', 'etcdescription']
-
-    setting = {'subject_id': 'str', 'stay_id': str, 'ndc': 'str', 'charttime': 'str'}
-    table = pd.read_csv(path, usecols=setting.keys(),
-                        parse_dates=['charttime'], infer_datetime_format=True,
-                        dtype='str', index_col=False)
-
-    # unify the names and order of columns
-    table.rename({'ndc': 'code', 'charttime': 'time'}, axis=1, inplace=True)
-    table = table.loc[:, ['subject_id', 'stay_id', 'code', 'time']]
-
-    # convert all codes to indexes and delete unwanted codes
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(lambda x: ndc2rxnorm.get(x, '<unk>'))
-    table = table.loc[table['code'].isin(code2idx), :]
-    table.loc[:, 'code'] = table.loc[:, 'code'].apply(code2idx.get)
-
-    # output
-    _table2tuples(table, TUPLE_DIR + tablename)
+    
+    pipeline.generate_code_tuples(MIMIC, tablename)
 
 
+@profiling.stage
 def generate_diagnoses_icd_table(tablename):
     '''
     Generate tuples for diagnoses_icd.csv (PheCode code).
@@ -167,13 +103,14 @@ def generate_diagnoses_icd_table(tablename):
     icd92phe = rolluptool.get_icd92phe()
     
     # index dictionary
-    code2idx = _load_code_dict(tablename)
+    code2idx = pipeline.load_code_dict(MIMIC, tablename)
     
     # load the table
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv/'+ tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'seq_num', 'icd_code', 'icd_version']
     setting = {'subject_id': 'str', 'hadm_id':int, 'icd_code': 'str', 'icd_version':'str'}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = pipeline.read_table(MIMIC, path, usecols=setting.keys(), dtype=MIMIC.dtypes(tablename, setting),
+                                index_col=False)
     table.rename({'icd_code':'code', 'icd_version':'code_type'}, axis=1, inplace=True)
     print('number of code before rolling up:', 
           table[['code', 'code_type']].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -182,10 +119,8 @@ def generate_diagnoses_icd_table(tablename):
     table9 = table.loc[table['code_type'] == '9', :].copy()
     table10 = table.loc[table['code_type'] == '10', :].copy()
     
-    table9.loc[~table9['code'].isin(icd92phe), ['code_type']] = 'icd9'
-    table9.loc[table9['code'].isin(icd92phe), ['code_type']] = 'phecode'
-    table10.loc[~table10['code'].isin(icd102phe), ['code_type']] = 'icd10'
-    table10.loc[table10['code'].isin(icd102phe), ['code_type']] = 'phecode'
+    table9['code_type'] = np.where(table9['code'].isin(icd92phe), 'phecode', 'icd9')
+    table10['code_type'] = np.where(table10['code'].isin(icd102phe), 'phecode', 'icd10')
     
     table9.loc[:, ['code']] = table9.loc[:, 'code'].apply(
         lambda x:(icd92phe[x] if x in icd92phe else x))
@@ -196,23 +131,25 @@ def generate_diagnoses_icd_table(tablename):
     del table9
     del table10
     
-    table = table.loc[table['code'].isin(code2idx), :]
+    keep = table['code'].isin(code2idx)
+    profiling.count_drops(tablename, 'not_in_dictionary', table.loc[~keep, 'code'])
+    table = table.loc[keep, :]
     table.loc[:, 'code'] = table.loc[:, 'code'].apply(code2idx.get)
     
     # add timestamp for each tuple
-    admissions = pd.read_csv(MIMIC_DIR + 'hosp/admissions.csv/admissions.csv', usecols=['hadm_id','dischtime'],
-                parse_dates=['dischtime'], infer_datetime_format=True, index_col='hadm_id')
+    admissions = pd.read_csv(compression.source_path(MIMIC_DIR + 'hosp/admissions.csv/admissions.csv'), usecols=['hadm_id','dischtime'],
+                dtype={'dischtime':str}, index_col='hadm_id')
     
     table = table.join(admissions, on=['hadm_id']).loc[:,['subject_id', 'hadm_id', 'code', 'dischtime']]
-    print('Time NA:')
-    print(table.loc[table['dischtime'].isna()])
+    profiling.count_drops(tablename, 'time_missing', table.loc[table['dischtime'].isna(), 'code'])
     table['hadm_id'] = table['hadm_id'].astype(str)
     table.dropna(inplace=True)
 
     # output the tuples
-    _table2tuples(table, TUPLE_DIR + tablename)
+    pipeline.table2tuples(MIMIC, table, MIMIC.tuple_dir + tablename)
 
 
+@profiling.stage
 def generate_diagnoses_ed_icd_table(tablename):
     '''
     Generate tuples for diagnoses_icd.csv (PheCode code).
@@ -235,13 +172,14 @@ def generate_diagnoses_ed_icd_table(tablename):
     icd92phe = rolluptool.get_icd92phe()
 
     # index dictionary
-    code2idx = _load_code_dict(tablename)
+    code2idx = pipeline.load_code_dict(MIMIC, tablename)
 
     # load the table
     path = MIMIC_DIR + 'ed/' + tablename + '.csv/' + tablename + '.csv'
     cols = ['subject_id', 'stay_id', 'seq_num', 'icd_code', 'icd_version', "icd_title"]
     setting = {'subject_id': 'str', 'stay_id': int, 'icd_code': 'str', 'icd_version': 'str'}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = pipeline.read_table(MIMIC, path, usecols=setting.keys(), dtype=MIMIC.dtypes(tablename, setting),
+                                index_col=False)
     table.rename({'icd_code': 'code', 'icd_version': 'code_type'}, axis=1, inplace=True)
     print('number of code before rolling up:',
           table[['code', 'code_type']].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -250,10 +188,8 @@ def generate_diagnoses_ed_icd_table(tablename):
     table9 = table.loc[table['code_type'] == '9', :].copy()
     table10 = table.loc[table['code_type'] == '10', :].copy()
 
-    table9.loc[~table9['code'].isin(icd92phe), ['code_type']] = 'icd9'
-    table9.loc[table9['code'].isin(icd92phe), ['code_type']] = 'phecode'
-    table10.loc[~table10['code'].isin(icd102phe), ['code_type']] = 'icd10'
-    table10.loc[table10['code'].isin(icd102phe), ['code_type']] = 'phecode'
+    table9['code_type'] = np.where(table9['code'].isin(icd92phe), 'phecode', 'icd9')
+    table10['code_type'] = np.where(table10['code'].isin(icd102phe), 'phecode', 'icd10')
 
     table9.loc[:, ['code']] = table9.loc[:, 'code'].apply(
         lambda x: (icd92phe[x] if x in icd92phe else x))
@@ -264,21 +200,22 @@ def generate_diagnoses_ed_icd_table(tablename):
     del table9
     del table10
 
-    table = table.loc[table['code'].isin(code2idx), :]
+    keep = table['code'].isin(code2idx)
+    profiling.count_drops(tablename, 'not_in_dictionary', table.loc[~keep, 'code'])
+    table = table.loc[keep, :]
     table.loc[:, 'code'] = table.loc[:, 'code'].apply(code2idx.get)
 
     # add timestamp for each tuple
-    admissions = pd.read_csv(MIMIC_DIR + 'ed/edstays.csv/edstays.csv', usecols=['stay_id', 'outtime'],
-                             parse_dates=['outtime'], infer_datetime_format=True, index_col='stay_id')
+    admissions = pd.read_csv(compression.source_path(MIMIC_DIR + 'ed/edstays.csv/edstays.csv'), usecols=['stay_id', 'outtime'],
+                             dtype={'outtime':str}, index_col='stay_id')
 
     table = table.join(admissions, on=['stay_id']).loc[:, ['subject_id', 'stay_id', 'code', 'outtime']]
-    print('Time NA:')
-    print(table.loc[table['outtime'].isna()])
+    profiling.count_drops(tablename, 'time_missing', table.loc[table['outtime'].isna(), 'code'])
     table['stay_id'] = table['stay_id'].astype(str)
     table.dropna(inplace=True)
 
     # output the tuples
-    _table2tuples(table, TUPLE_DIR + tablename)
+    pipeline.table2tuples(MIMIC, table, MIMIC.tuple_dir + tablename)
 
 
 # def generate_drgcodes_table(tablename):
@@ -299,7 +236,7 @@ def generate_diagnoses_ed_icd_table(tablename):
 #     print('\ngenerating tuples of', tablename)
 #
 #     # index dictionary
-#     code2idx = _load_code_dict(tablename)
+#     code2idx = pipeline.load_code_dict(MIMIC, tablename)
 #
 #     # table
 #     path = MIMIC_DIR + 'hosp/' + tablename + '.csv/'+ tablename + '.csv'
@@ -328,7 +265,8 @@ def generate_diagnoses_ed_icd_table(tablename):
 #     table.dropna(inplace=True)
 #
 #     # output
-#     _table2tuples(table, TUPLE_DIR + tablename)
+#     pipeline.table2tuples(MIMIC, table, MIMIC.tuple_dir + tablename)
+@profiling.stage
 def generate_drgcodes_table(tablename):
     '''
     Generate tuples for drgcodes.csv (DRG Codes)
@@ -347,13 +285,14 @@ def generate_drgcodes_table(tablename):
     print('\ngenerating tuples of', tablename)
 
     # index dictionary
-    code2idx = _load_code_dict(tablename)
+    code2idx = pipeline.load_code_dict(MIMIC, tablename)
 
     # load table
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv/' + tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'drg_type', 'drg_code', 'description', 'drg_severity', 'drg_mortality']
     setting = {'subject_id': 'str', 'hadm_id': int, 'drg_code': 'str', 'drg_type': 'str'}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = pipeline.read_table(MIMIC, path, usecols=setting.keys(), dtype=MIMIC.dtypes(tablename, setting),
+                                index_col=False)
 
     # 修改:将 drg_type 和 drg_code 组合成新的唯一标识
     table['combined_code'] = table.apply(lambda x: f"{x['drg_type']}_{x['drg_code']}", axis=1)
@@ -361,30 +300,29 @@ def generate_drgcodes_table(tablename):
           table['combined_code'].drop_duplicates(keep='first', inplace=False).shape[0])
 
     # 使用组合后的代码进行过滤和转换
-    table = table.loc[table['combined_code'].isin(code2idx), :]
+    keep = table['combined_code'].isin(code2idx)
+    profiling.count_drops(tablename, 'not_in_dictionary', table.loc[~keep, 'combined_code'])
+    table = table.loc[keep, :]
     table.loc[:, 'combined_code'] = table.loc[:, 'combined_code'].apply(code2idx.get)
 
     # add timestamp
-    admissions = pd.read_csv(MIMIC_DIR + 'hosp/admissions.csv/admissions.csv',
+    admissions = pd.read_csv(compression.source_path(MIMIC_DIR + 'hosp/admissions.csv/admissions.csv'),
                              usecols=['hadm_id', 'dischtime'],
-                             parse_dates=['dischtime'],
-                             infer_datetime_format=True,
+                             dtype={'dischtime':str},
                              index_col='hadm_id')
 
     table = table.join(admissions, on=['hadm_id']).loc[:, ['subject_id', 'hadm_id', 'combined_code', 'dischtime']]
-    temp = table.loc[table['dischtime'].isna()]
-    if temp.shape[0] != 0:
-        print('Time NA:')
-        print(temp)
+    profiling.count_drops(tablename, 'time_missing', table.loc[table['dischtime'].isna(), 'combined_code'])
     table['hadm_id'] = table['hadm_id'].astype(str)
     table.dropna(inplace=True)
 
     table.rename(columns={'combined_code': 'code'}, inplace=True)
 
     # output
-    _table2tuples(table, TUPLE_DIR + tablename)
+    pipeline.table2tuples(MIMIC, table, MIMIC.tuple_dir + tablename)
 
 
+@profiling.stage
 def generate_ccs_table(tablename):
     '''
     Generate tuples for hcpcsevents.csv and procedures_icd.csv (CCS Codes)
@@ -408,21 +346,23 @@ def generate_ccs_table(tablename):
     icd9cm2ccs = rolluptool.get_icd9cm2ccs()
     cpt2ccs = rolluptool.get_cpt2ccs()
     
-    code2idx = _load_code_dict(tablename)
+    code2idx = pipeline.load_code_dict(MIMIC, tablename)
     
     # table ICD
     path = MIMIC_DIR + 'hosp/procedures_icd.csv/'+ 'procedures_icd.csv'
     cols = ['subject_id', 'hadm_id', 'seq_num', 'chartdate', 'icd_code', 'icd_version']
     time = 'chartdate'
     setting = {'subject_id':'str', 'hadm_id':str, 'icd_code': str, 'icd_version':int, time:'str'}
-    table = pd.read_csv(path, usecols=setting.keys(), parse_dates=[time],infer_datetime_format=True,
-        dtype=setting, index_col=False)
+    table = pipeline.read_table(MIMIC, path, usecols=setting.keys(),
+        dtype=MIMIC.dtypes('procedures_icd', setting), index_col=False)
     table.rename({'icd_code':'code', 'icd_version':'code_type', time:'time'},
         axis=1, inplace=True)
     
     # convert all ICD codes to indexes and delete unwanted codes
+    src_code = table['code'].copy()
     table.loc[:, 'code'] = table.loc[:, ['code', 'code_type']].apply(
         lambda x:icd9cm2ccs.get(x[0], '<unk>') if x[1] == 9 else icd10pcs2css.get(x[0], '<unk>'), axis=1)
+    _count_ccs_drops('procedures_icd', src_code, table['code'], code2idx)
     table = table.loc[table['code'].isin(code2idx), ['subject_id', 'hadm_id', 'code', 'time']]
     table.loc[:, 'code'] = table.loc[:, 'code'].apply(
         lambda x:code2idx[x])
@@ -432,13 +372,15 @@ def generate_ccs_table(tablename):
     cols = ['subject_id', 'hadm_id', 'chartdate', 'hcpcs_cd', 'seq_num', 'short_description']
     time = 'chartdate'
     setting = {'subject_id':'str', 'hadm_id':str, 'hcpcs_cd': 'str', time:'str'}
-    table1 = pd.read_csv(path, usecols=setting.keys(), parse_dates=[time],infer_datetime_format=True,
-        dtype=setting, index_col=False)
+    table1 = pipeline.read_table(MIMIC, path, usecols=setting.keys(),
+        dtype=MIMIC.dtypes('hcpcsevents', setting), index_col=False)
     table1.rename({'hcpcs_cd':'code', time:'time'}, axis=1, inplace=True)
     
     # convert all CPT codes to indexes and delete unwanted codes
+    src_code = table1['code'].copy()
     table1.loc[:, 'code'] = table1.loc[:, 'code'].apply(
         lambda x:cpt2ccs.get(x, '<unk>'))
+    _count_ccs_drops('hcpcsevents', src_code, table1['code'], code2idx)
     table1 = table1.loc[table1['code'].isin(code2idx), ['subject_id', 'hadm_id', 'code', 'time']]
     table1.loc[:, 'code'] = table1.loc[:, 'code'].apply(
         lambda x:code2idx[x])
@@ -448,9 +390,21 @@ def generate_ccs_table(tablename):
     del table1
     
     # output
-    _table2tuples(table, TUPLE_DIR + tablename)
+    pipeline.table2tuples(MIMIC, table, MIMIC.tuple_dir + tablename)
 
 
+def _count_ccs_drops(tablename, src_code, code, code2idx):
+    '''
+    Count the rows dropped when rolling up to CCS, by source code
+    '''
+
+    dropped = ~code.isin(code2idx)
+    unknown = code == '<unk>'
+    profiling.count_drops(tablename, 'unknown_rollup', src_code[dropped & unknown])
+    profiling.count_drops(tablename, 'not_in_dictionary', src_code[dropped & ~unknown])
+
+
+@profiling.stage
 def generate_no_value_table(tablename):
     '''
     Generate tuples for procedureevents.csv and inputevents.csv respectively
@@ -465,25 +419,10 @@ def generate_no_value_table(tablename):
         No return
     '''
     
-    print('\ngenerating tuples of', tablename)
-    
-    # index dictionary
-    code2idx = _load_code_dict(tablename)
-    
-    # load table
-    path = MIMIC_DIR + 'icu/{}.csv/'.format(tablename)+ '{}.csv'.format(tablename)
-    setting = {'subject_id':str, 'hadm_id':str, 'itemid':'str'}
-    table = pd.read_csv(path, usecols=['subject_id', 'hadm_id', 'itemid', 'starttime'], parse_dates=['starttime'],
-            dtype=setting, index_col=False)
-    
-    table = table.loc[table['itemid'].isin(code2idx), :]
-    table.loc[:, 'itemid'] = table.loc[:, 'itemid'].apply(code2idx.get)
-    
-    table = table.loc[:,['subject_id', 'hadm_id', 'itemid', 'starttime']]
-
-    _table2tuples(table, TUPLE_DIR + tablename)
+    pipeline.generate_code_tuples(MIMIC, tablename)
 
 
+@profiling.stage
 def generate_output_table(tablename='outputevents'):
     '''
     Generate tuples for outputevents
@@ -500,52 +439,68 @@ def generate_output_table(tablename='outputevents'):
     
     print('\ngenerating tuples of', tablename)
     
-    # index dictionary
-    dic = pd.read_csv(IDX_DIR + 'code_dict.csv', dtype='str', index_col=0)
-    dic = dic.loc[dic['source_table'] == tablename, ['code', 'code_type', 'with_value']]
-    code2idx = {i.code:i.code_type + '_' + i.code for i in dic.itertuples(False)}
-    print('code dict size:', len(dic))
-
-    code_with_value = set(dic.loc[dic['with_value'] == '1', 'code'])
+    # index dictionary (itemid is read as integer, see MIMIC.schemas)
+    code2idx, code_with_value = pipeline.load_value_codes(MIMIC, tablename)
+    code2idx = {int(k):v for k,v in code2idx.items()}
+    code_with_value = {int(k) for k in code_with_value}
     
-    # patients dictionary
-    origin_patients = _load_patients()
+    # patients dictionary (subject_id is read as integer)
+    origin_patients = {int(k):v for k,v in pipeline.load_patients(MIMIC).items()}
 
     # a dictionary to normalize units
     with open(UOM_SRC + '{}_uom_dict.json'.format(tablename), 'r', encoding='utf8') as f:
         uom_dict = json.load(f)
-        uom_dict = {k:v for k,v in uom_dict.items()}
+        uom_dict = {int(k):v for k,v in uom_dict.items()}
     
     # load the source table
     src_path = MIMIC_DIR + '{}/{}.csv/{}.csv'.format('icu', tablename,tablename)
-    setting = {'subject_id':str, 'hadm_id':str, 'charttime':None, 'itemid':str, 'value':str, 'valueuom':str}
-    with pd.read_csv(src_path, usecols=setting.keys(), index_col=False, parse_dates=['charttime'],
-            chunksize=30000000, dtype=setting) as reader:
-        for i, chunk in enumerate(reader):
+    setting = {'subject_id':str, 'hadm_id':str, 'charttime':str, 'itemid':str, 'value':str, 'valueuom':str}
+
+    # chunks done by a previous run that failed are skipped (see checkpoint.py)
+    journal = checkpoint.Journal(MIMIC, MIMIC.tuple_dir + tablename + '.journal',
+            [src_path, MIMIC.idx_dir + 'code_dict.csv', UOM_SRC + '{}_uom_dict.json'.format(tablename)],
+            {'chunksize': 30000000}, [(MIMIC.tuple_dir, tablename)])
+    with pipeline.read_table(MIMIC, src_path, usecols=setting.keys(), index_col=False,
+            chunksize=30000000, dtype=MIMIC.dtypes(tablename, setting),
+            codes=code2idx, code_col='itemid', min_chunksize=pipeline.TUPLE_MIN_CHUNKSIZE) as reader:
+        for i, chunk in journal.chunks(reader):
             patients = {i:[] for i in  origin_patients}
             chunk = chunk.loc[:, ['subject_id', 'hadm_id', 'charttime', 'itemid', 'value', 'valueuom']]
+            chunk['charttime'] = pipeline.format_time(MIMIC, chunk['charttime'])
             
+            drops = collections.defaultdict(collections.Counter)
             for pid, hadm, time, itemid, value, valueuom in tqdm(chunk.itertuples(False), total=chunk.shape[0]):     
                 
                 # Filter unwanted codes
                 if itemid not in code2idx:
+                    drops['not_in_dictionary'][itemid] += 1
+                    continue
+                if pid not in patients:
+                    drops['patient_not_found'][itemid] += 1
                     continue
 
                 # normalize unit of measurement
-                unit = _normalize_unit(valueuom)
+                unit = pipeline.normalize_unit(valueuom)
                 
                 # create a tuple
-                tuple = [hadm, str(time), code2idx[itemid], '']
+                tuple = ['' if pd.isna(hadm) else str(hadm), time, code2idx[itemid], '']
                 
                 if itemid in code_with_value and not pd.isna(value):
                     tuple[3] = value
                 
                 patients[pid].append(tuple)
             
+            # count the rows dropped in the chunk
+            for reason, codes in drops.items():
+                profiling.count_drops(tablename, reason, codes)
+
             # output tuples
-            _value_table2tuples(patients, TUPLE_DIR + tablename + str(i))
+            pipeline.patients2tuples(patients, MIMIC.tuple_dir + tablename + str(i), MIMIC.patient_index())
+            journal.commit(i)
+    journal.finish()
 
 
+@profiling.stage
 def generate_transfers_table(tablename='transfers'):
     '''
     Generate tuples for transfers.csv
@@ -560,40 +515,10 @@ def generate_transfers_table(tablename='transfers'):
         No return
     '''
     
-    print('\ngenerating tuples of', tablename)
-    
-    # index dictionary
-    code2idx = _load_code_dict(tablename)
-
-    # patients dictionary
-    origin_patients = _load_patients()
-    
-    # load the source table
-    src_path = MIMIC_DIR + '{}/{}.csv/{}.csv'.format('hosp', tablename, tablename)
-    setting = {'subject_id':str, 'hadm_id':str, 'intime':None, 'eventtype':str, 'careunit':str}
-    with pd.read_csv(src_path, usecols=setting.keys(), index_col=False, parse_dates=['intime'],
-            chunksize=30000000, dtype=setting) as reader:
-        for i, chunk in enumerate(reader):
-            patients = {i:[] for i in  origin_patients}
-            chunk = chunk.loc[:, ['subject_id', 'hadm_id', 'intime', 'eventtype', 'careunit']]
-            
-            for pid, hadm, time, itemid, care_unit in tqdm(chunk.itertuples(False), total=chunk.shape[0]):
+    pipeline.generate_code_tuples(MIMIC, tablename)
 
-                # create a tuple
-                tuple = ['', str(time), code2idx[itemid], '']
-                
-                if not pd.isna(hadm):
-                    tuple[0] = hadm
-
-                if not pd.isna(care_unit):
-                    tuple[3] = care_unit
-                
-                patients[pid].append(tuple)
-            
-            # output tuples
-            _value_table2tuples(patients, TUPLE_DIR + tablename + str(i))
-                    
 
+@profiling.stage
 def generate_value_table(tablename='labevents', filedir='icu', value_col='valuenum'):
     '''
     Generate tuples for labevents and chartevents respectively.
@@ -618,52 +543,64 @@ def generate_value_table(tablename='labevents', filedir='icu', value_col='valuen
     assert (filedir in ['hosp', 'icu'])
     assert (value_col in ['value', 'valuenum'])
     
-    # index dictionary
-    dic = pd.read_csv(IDX_DIR + 'code_dict.csv', dtype='str', index_col=0)
-    dic = dic.loc[dic['source_table'] == tablename, ['code', 'code_type', 'with_value']]
-    code2idx = {i.code:i.code_type + '_' + i.code for i in dic.itertuples(False)}
-    print('code dict size:', len(dic))
-
-    code_with_value = set(dic.loc[dic['with_value'] == '1', 'code'])
+    # index dictionary (itemid is read as integer, see MIMIC.schemas)
+    code2idx, code_with_value = pipeline.load_value_codes(MIMIC, tablename)
+    code2idx = {int(k):v for k,v in code2idx.items()}
+    code_with_value = {int(k) for k in code_with_value}
     
-    # patients dictionary
-    origin_patients = _load_patients()
+    # patients dictionary (subject_id is read as integer)
+    origin_patients = {int(k):v for k,v in pipeline.load_patients(MIMIC).items()}
 
     # a dictionary to normalize units
     with open(UOM_SRC + '{}_uom_dict.json'.format(tablename), 'r', encoding='utf8') as f:
         uom_dict = json.load(f)
-        uom_dict = {k:v for k,v in uom_dict.items()}
+        uom_dict = {int(k):v for k,v in uom_dict.items()}
     
     # load the source table
     src_path = MIMIC_DIR + '{}/{}.csv/{}.csv'.format(filedir, tablename, tablename)
-    setting = {'subject_id':str, 'hadm_id':str, 'charttime':None, 'itemid':str, 'value':str,
+    setting = {'subject_id':str, 'hadm_id':str, 'charttime':str, 'itemid':str, 'value':str,
                value_col:float, 'valueuom':str}
     if value_col == 'valuenum':
         setting['value'] = str
-        
-    with pd.read_csv(src_path, usecols=setting.keys(), index_col=False, parse_dates=['charttime'],
-            chunksize=20000000, dtype=setting) as reader:
-        for i, chunk in enumerate(reader):
+
+    # chunks done by a previous run that failed are skipped (see checkpoint.py)
+    journal = checkpoint.Journal(MIMIC, MIMIC.tuple_dir + tablename + '.journal',
+            [src_path, MIMIC.idx_dir + 'code_dict.csv', UOM_SRC + '{}_uom_dict.json'.format(tablename)],
+            {'chunksize': 20000000, 'value_col': value_col},
+            [(MIMIC.tuple_dir, tablename), (MIMIC.string_tuple_dir, tablename + '_string_')])
+    with pipeline.read_table(MIMIC, src_path, usecols=setting.keys(), index_col=False,
+            chunksize=20000000, dtype=MIMIC.dtypes(tablename, setting),
+            codes=code2idx, code_col='itemid', min_chunksize=pipeline.TUPLE_MIN_CHUNKSIZE) as reader:
+        for i, chunk in journal.chunks(reader):
             patients = {i:[] for i in  origin_patients}
             patients_str = {i:[] for i in  origin_patients}
+            string_counts = collections.Counter()
             
             chunk = chunk.loc[:, ['subject_id', 'hadm_id', 'charttime', 'itemid', 'value', value_col, 'valueuom']]
+            chunk['charttime'] = pipeline.format_time(MIMIC, chunk['charttime'])
+
+            # rows dropped (or with a value replaced by _STRING) in the chunk, by reason and code
+            drops = collections.defaultdict(collections.Counter)
             for pid, hadm, time, itemid, value, valuenum, valueuom in tqdm(chunk.itertuples(False), total=chunk.shape[0]):     
                 
                 # Filter unwanted codes
                 if itemid not in code2idx:
+                    drops['not_in_dictionary'][itemid] += 1
+                    continue
+                if pid not in patients:
+                    drops['patient_not_found'][itemid] += 1
                     continue
 
                 # normalize unit of measurement
-                unit = _normalize_unit(valueuom)
+                unit = pipeline.normalize_unit(valueuom)
                 
                 # create a tuple: [admission_id, time, code, value]
-                tuple = ['', str(time), code2idx[itemid], '']
-                tuple_str = ['', str(time), code2idx[itemid], '']
+                tuple = ['', time, code2idx[itemid], '']
+                tuple_str = ['', time, code2idx[itemid], '']
                 
                 if not pd.isna(hadm):
-                    tuple[0] = hadm
-                    tuple_str[0] = hadm
+                    tuple[0] = str(hadm)
+                    tuple_str[0] = tuple[0]
                 
                 if itemid in code_with_value:   # code with value
                         if pd.isna(valuenum): # the code value is empty
@@ -672,6 +609,7 @@ def generate_value_table(tablename='labevents', filedir='icu', value_col='valuen
                             else:
                                 tuple[3] = '_STRING'
                                 tuple_str[3] = value
+                                drops['string_value'][itemid] += 1
                         elif valuenum == 0:
                             tuple[3] = '0'
                         elif uom_dict[itemid]['<main>'] != unit: # the uom here is not consistent with the main uom of code
@@ -681,6 +619,7 @@ def generate_value_table(tablename='labevents', filedir='icu', value_col='valuen
                             else:   # the code value exists, but it is not valid
                                 tuple[3] = '_STRING'
                                 tuple_str[3] = value + '#' + unit
+                                drops['unit_mismatch'][itemid] += 1
                         else:   # the uom here is consistent with the main uom of code
                             tuple[3] = str(valuenum)
                 
@@ -698,197 +637,59 @@ def generate_value_table(tablename='labevents', filedir='icu', value_col='valuen
                 # add the string item to patients' record
                 if tuple[3] == '_STRING':
                     patients_str[pid].append(tuple_str)
+                    string_counts[tuple_str[2], tuple_str[3]] += 1
 
-            # output tuples
-            _value_table2tuples(patients, TUPLE_DIR + tablename+str(i))
-            _value_table2tuples(patients_str, STRING_TUPLE_DIR + '{}{}{}'.format(tablename, '_string_', i))
+            for reason, codes in drops.items():
+                profiling.count_drops(tablename, reason, codes)
 
-
-def merge_tuples(src_dir, cols, out_path):
-    '''
-    Merge tuples of all tables together.
-    
-    Parameters:
-    ----
-        src_dir: source directory of tuples
-        cols: column names of output file
-        out_path: filepath to output the merged tuples
-            
-    Returns:
-    ----
-        No return
-    '''
-    
-    print("\nMerging tuples in {}".format(src_dir))
-    
-    tuples_out = open(out_path, 'w', encoding='utf8')
-    tuples_out.write(','.join(cols) + '\n')
-    
-    iFiles = os.listdir(src_dir)
-    iFiles = [open(src_dir + i, 'r', encoding='utf8') for i in iFiles if '.tri' in i]
-    
-    while True:
-        p = []
-        data = []
-        for f in iFiles:
-            pp, dd = _get_patient_data(f, 10000)
-            
-            if len(pp) == 0:
-                print('Merging finished.')
-                return
-                
-            p.append(pp)
-            data.append(dd)
-        
-        for i in range(1, len(p)):
-            if not (p[i] == p[i-1]):
-                print('error!')
-                exit(1)
-                
-        for i, p_id in enumerate(p[0]):
-            temp = []
-            
-            for slice in data:
-                temp += slice[i]
-            
-            # if the patient has no tuple, then ignore him/her
-            if len(temp) == 0:
-                continue
-            
-            temp.sort(key=lambda x:x[1])
-            
-            for l in temp:
-                tuples_out.write(p_id + ',' + ','.join(l) + '\n')
-    
-
-
-# functions for data IO
-def _load_code_dict(tablename):
-    '''
-    load the dictionary.
-    '''
-    
-    dic = pd.read_csv(IDX_DIR + 'code_dict.csv', dtype='str', index_col=0)
-    dic = dic.loc[dic['source_table'] == tablename, ['code', 'code_type', 'with_value']]
-    code2idx = {i.code:i.code_type + '_' + i.code for i in dic.itertuples(False)}
-    print('code dict size:', len(dic))
-    return code2idx
-
-
-def _table2tuples(table, oFile):
-    '''
-    Convert a pandas.Dataframe table to a batch of tuples and output
-    
-    Parameters:
-    ----
-        table:
-            The table to output as tuple
-        oFile:
-            file path of the output file
-            
-    Returns:
-    ----
-        No return
-    '''
-    
-    # load all patients
-    patients = _load_patients()
-
-    for p, v, c, t in tqdm(table.itertuples(False), total=table.shape[0]):
-        if p in patients:
-            patients[p].append((v, str(t), c, ''))
-        else:
-            print(f"Patient {p} not found in patients dictionary. Skipping.")
-    
-    with open(oFile + '.tri', 'w', encoding='utf8') as f:
-        for id, info in patients.items():
-            f.write(str(id) + '\n')
-            for l in info:
-                f.write(','.join(l) + '\n')
-            f.write('\n')
-
-
-def _value_table2tuples(patients, oFile):
-    '''
-    Output tuples for a table containing code with value.
-    
-    Parameters:
-    ----
-        patients:
-            tuples to output
-
-        oFile:
-            file path of the output file
-            
-    Returns:
-    ----
-        No return
-    '''
-    
-    with open(oFile + ".tri", 'w', encoding='utf8') as f:
-        for id, info in patients.items():
-            f.write(id + '\n')
-            for l in info:
-                l[3] = l[3].replace(',', '/')
-                f.write(','.join(l) + '\n')
-            f.write('\n')
-
-
-def _load_patients():
-    '''
-    load all patients' ID.
-    '''
-    
-    patients = pd.read_csv(MIMIC_DIR + 'hosp/patients.csv/patients.csv', usecols=['subject_id'], dtype='str')
-    patients = {i:[] for i in patients['subject_id']}
-    return patients
-
-
-def _normalize_unit(unit):
-    '''
-    normalize unit of measurement
-    '''
-    
-    if pd.isna(unit):
-        return 'nan'
-    else:
-        unit = unit.lower().strip()
-        if unit == '' or unit == 'none' or unit == 'nan':
-            return 'nan'
-        else:
-            return unit
-
-
-def _get_patient_data(f, batch_size):
-    '''
-    Read a batch of patients' ID and corresponding tuples
-    '''
-    
-    p = []
-    d = []
-    
-    for i in range(batch_size):
-        patient = f.readline()[:-1]
-        if patient == '':
-            break
-        
-        p.append(patient)
-        data = []
-        
-        while True:
-            line = f.readline()[:-1]
-            if line == '':
-                break
-        
-            line = line.strip().split(',')
-            data.append(line)
-
-        d.append(data)
-        
-    return p, d
+            # output tuples
+            pipeline.patients2tuples(patients, MIMIC.tuple_dir + tablename+str(i), MIMIC.patient_index())
+            pipeline.patients2tuples(patients_str, MIMIC.string_tuple_dir + '{}{}{}'.format(tablename, '_string_', i),
+                                     MIMIC.patient_index())
+            strings.save_store(string_counts, MIMIC.string_tuple_dir + '{}{}{}_strings.json'.format(tablename, '_string_', i))
+            journal.commit(i)
+    journal.finish()
+
+
+# all tables, for sharded execution
+TABLE_JOBS = [
+    (generate_prescriptions_table, ('prescriptions',)),
+    (generate_ccs_table, ('ccs',)),
+    (generate_diagnoses_icd_table, ('diagnoses_icd',)),
+    (generate_drgcodes_table, ('drgcodes',)),
+    (generate_transfers_table, ('transfers',)),
+    (generate_no_value_table, ('procedureevents',)),
+    (generate_no_value_table, ('inputevents',)),
+    (generate_output_table, ('outputevents',)),
+    (generate_diagnoses_ed_icd_table, ('diagnosis',)),
+    (generate_medrecon_table, ('medrecon',)),
+    (generate_pyxis_table, ('pyxis',)),
+    (generate_value_table, ('labevents', 'hosp', 'valuenum')),
+    (generate_value_table, ('chartevents', 'icu', 'valuenum')),
+]
+
+# source tables of TABLE_JOBS, partitioned by shard before the jobs run (see sharding.partition_sources)
+SHARD_SOURCES = [MIMIC.path(MIMIC.tables[t].path) for t in [
+    'prescriptions', 'pyxis', 'medrecon', 'transfers', 'procedureevents', 'inputevents']] + \
+    [MIMIC_DIR + '{}/{}.csv/{}.csv'.format(d, t, t) for d, t in [
+    ('hosp', 'diagnoses_icd'), ('hosp', 'drgcodes'), ('hosp', 'procedures_icd'), ('hosp', 'hcpcsevents'),
+    ('hosp', 'labevents'), ('icu', 'outputevents'), ('icu', 'chartevents'), ('ed', 'diagnosis')]]
 
 
 def main():
+    # delta mode: only the tuples of new or changed patients are generated and spliced into the outputs
+    if DELTA_PATIENTS is not None or len(DELTA_DIFF) > 0:
+        run_delta()
+        split_output()
+        return
+
+    # sharded execution: each worker generates and merges the tuples of its own patients
+    if N_SHARDS > 1:
+        manifest = sharding.run_sharded(MIMIC, TABLE_JOBS, N_SHARDS, N_WORKERS, sources=SHARD_SOURCES)
+        intern_strings([s['string_tuple_dir'] for s in manifest['shards']])
+        split_output()
+        return
+
     # generate a contemporary tuple file for each table
     # generate_prescriptions_table('prescriptions')
     # generate_ccs_table('ccs')
@@ -913,8 +714,52 @@ def main():
 
     #
     cols = ['patient_id', 'admission_id', 'time', 'code', 'value']
-    merge_tuples(TUPLE_DIR, cols, RESULT_ROOT_DIR + 'tuples.csv')
-    merge_tuples(STRING_TUPLE_DIR, cols, RESULT_ROOT_DIR + 'string_tuples.csv')
+    pipeline.merge_tuples(MIMIC, TUPLE_DIR, cols, RESULT_ROOT_DIR + 'tuples.csv', aggregate=True, dedup=True)
+    pipeline.merge_tuples(MIMIC, STRING_TUPLE_DIR, cols, RESULT_ROOT_DIR + 'string_tuples.csv')
+    intern_strings([STRING_TUPLE_DIR])
+    split_output()
+
+
+def run_delta():
+    '''
+    update the outputs for the patients of DELTA_PATIENTS and the patients changed in the tables of DELTA_DIFF
+    '''
+
+    # string tuples are spliced verbatim, they cannot be mixed with interned ones
+    assert not INTERN_STRINGS, 'delta mode does not support INTERN_STRINGS, run the whole generation'
+
+    # imported here: only delta mode needs the post-processing (patients_dict.csv)
+    import post_process
+
+    patient_ids = set()
+    if DELTA_PATIENTS is not None:
+        patient_ids |= load_sample_ids(DELTA_PATIENTS)
+    for old_path, new_path in DELTA_DIFF:
+        patient_ids |= delta.changed_patients(old_path, new_path, 'subject_id')
+
+    delta.run_delta(MIMIC, TABLE_JOBS, patient_ids, RESULT_ROOT_DIR + 'code_dict.csv',
+                    post_process.generate_patient_dict)
+
+
+def intern_strings(store_dirs):
+    '''
+    build the string table and refer to strings by their IDs in string_tuples.csv (if INTERN_STRINGS is set)
+    '''
+
+    if not INTERN_STRINGS:
+        return
+    table, categories = strings.build_string_table(store_dirs, IDX_DIR, STRING_TOP_K)
+    categorical_path = RESULT_ROOT_DIR + 'string_categorical_tuples.csv' if STRING_TOP_K is not None else None
+    strings.encode_string_tuples(MIMIC, RESULT_ROOT_DIR + 'string_tuples.csv', table, categories, categorical_path)
+
+
+def split_output():
+    '''
+    split tuples.csv into shards balanced by events for distributed training (if OUTPUT_SHARDS is set)
+    '''
+
+    if OUTPUT_SHARDS is not None:
+        sharding.split_balanced(RESULT_ROOT_DIR + 'tuples.csv', OUTPUT_SHARDS, RESULT_ROOT_DIR + 'output_shards/')
 
 
 if __name__=='__main__':
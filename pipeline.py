@@ -0,0 +1,1709 @@
+import sys
+import os
+import bisect
+import heapq
+import contextlib
+import collections
+import datetime
+import numpy as np
+import pandas as pd
+from pandas._libs.parsers import STR_NA_VALUES
+from tqdm import tqdm
+import profiling
+import valuestats
+import checkpoint
+import compression
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.compute as pc
+except ImportError:
+    pa = pa_csv = pc = None
+
+
+'''
+Shared engine of the cleaning pipeline.
+Every function takes a DatasetAdapter (see dataset.py) describing the source,
+so MIMIC-IV and eICU build dictionaries, tuples and the merged result the same way.
+'''
+
+
+# rows per chunk when a table is read in chunks only to select patients
+SELECT_CHUNKSIZE = 5000000
+
+# smallest chunk of a memory budget in stages writing tuples: every chunk writes a .tri file
+# listing all patients, and merge_tuples keeps all of them open, reading a batch of patients from each
+TUPLE_MIN_CHUNKSIZE = 1000000
+
+# rows per chunk of tuples.csv when normalizing values
+NORMALIZE_CHUNKSIZE = 5000000
+
+# first line of .tri files whose tuples are sorted by time within every patient,
+# merged without sorting again (files without it are sorted when merged)
+TRI_HEADER = '#sorted:time\n'
+
+# characters of formatted tuples buffered before they are written (see TupleWriter)
+WRITE_BUFFER = 16 * 1024 * 1024
+
+# functions of time-bucketed aggregation, see load_aggregation()
+AGGREGATE_FUNCTIONS = ['last', 'mean', 'min', 'max']
+
+# format of aggregated values (significant digits, without the noise of the full float repr)
+AGGREGATE_FORMAT = '{:.10g}'
+
+V_FREQ = 'value_frequency'
+FREQ = 'total_frequency'
+P_FREQ = 'patient_frequency'
+
+idx_cols = ['code','code_type',V_FREQ,FREQ,'source_table','unit_of_measurement','with_value']
+
+# an entry of the dictionary, identified across runs by the registry of codes
+REGISTRY_KEY = ['source_table', 'code_type', 'code']
+REGISTRY_COLS = ['index'] + REGISTRY_KEY + ['status', 'added', 'retired']
+
+
+# dictionary
+def output_dict(adapter, table:pd.DataFrame, tablename:str):
+    '''
+    Parameters:
+    ----
+        adapter:
+            the dataset of the table
+        table:
+            The dictionary to output
+        tablename:
+            tablename of the input/output file
+
+    Returns:
+    ----
+        No return
+    '''
+
+    # number of distinct patients of a code, if their IDs were read
+    group = table.groupby(['code', 'code_type'])
+    patients = group[adapter.patient_key].nunique() if adapter.patient_key in table.columns else None
+    table = group.count()
+    if patients is not None:
+        table[P_FREQ] = patients
+    print('unknown freq', int(table.loc['<unk>', FREQ].sum()) if '<unk>' in table.index else 0)
+    if '<unk>' in table.index:
+        profiling.count_drops(tablename, 'unknown_rollup', {'<unk>': table.loc['<unk>', FREQ].sum()})
+        table.drop(['<unk>'], inplace=True)
+
+    #table = table.loc[(table[FREQ] >= 1000)]
+
+    table.sort_values(FREQ, inplace=True)
+    profiling.count('rows_out', len(table))
+    table[V_FREQ] = 0
+    table['source_table'] = tablename
+    table['unit_of_measurement'] = ''
+    table['with_value'] = 0
+    columns = idx_cols[2:] + ([P_FREQ] if patients is not None else [])
+    table.to_csv(adapter.idx_dir + tablename + '_dict.dict', columns=columns, index_label=['code', 'code_type'])
+
+    table.reset_index(inplace=True)
+    all_type = table['code_type'].unique()
+    for ctype in all_type:
+        temp_table = table.loc[table['code_type'] == ctype]
+        print('type', 'code_num', 'final', 'mean', 'median','max', 'min', sep='\t')
+        print(ctype, temp_table.shape[0], temp_table[FREQ].sum(), int(temp_table[FREQ].mean()),
+            temp_table[FREQ].median(), temp_table[FREQ].max(), temp_table[FREQ].min(), sep='\t')
+        print('')
+
+
+@profiling.stage
+def generate_code_dict(adapter, tablename):
+    '''
+    Generate a dictionary for a table described by a TableSpec of the adapter
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the table
+        tablename:
+            Indicate the name of table
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('\ngenerating dict of', tablename)
+
+    spec = adapter.tables[tablename]
+
+    table = read_table(adapter, adapter.path(spec.path), usecols=[spec.code_col, adapter.patient_key],
+            dtype={spec.code_col:str, adapter.patient_key:str}, index_col=False)
+    table.rename({spec.code_col:'code'}, axis=1, inplace=True)
+    if spec.code_filter is not None:
+        table = table.loc[spec.code_filter(table['code'])]
+    print('number of code before rolling up:',
+          table['code'].drop_duplicates(keep='first', inplace=False).shape[0])
+
+    # roll up the codes, unknown codes are dropped by output_dict()
+    if spec.rollup is not None:
+        rollup = spec.rollup()
+        table['code'] = table['code'].map(rollup).fillna('<unk>')
+
+    table.loc[:, 'total_frequency'] = 1
+    table.loc[:, 'code_type'] = spec.code_type
+    output_dict(adapter, table, tablename)
+
+
+@profiling.stage
+def merge_dict(adapter, out_path):
+    '''
+    Merge dictionaries of all tables together.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the dictionaries
+        out_path: filepath to output the merged dictionary
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('Merging all dictionaries together...')
+
+    table = pd.DataFrame(columns=idx_cols)
+
+    for tablename in os.listdir(adapter.idx_dir):
+        if '.dict' in tablename:
+            path = adapter.idx_dir + tablename
+            temp = pd.read_csv(path, dtype={'code':'str'}, index_col=False)
+            profiling.count('rows_in', len(temp))
+            table = pd.concat((table, temp), ignore_index=True)
+
+    # sort al entries (statistics of values and numbers of patients are kept as integers, see valuestats.py)
+    table = valuestats.format_columns(table)
+    if P_FREQ in table.columns:
+        table[P_FREQ] = pd.to_numeric(table[P_FREQ]).astype('Int64')
+    table.sort_values(['code_type', 'with_value', 'total_frequency'], inplace=True, ignore_index=True)
+    table.index += 1
+
+    # indices kept across runs, new codes appended (see register_codes())
+    if adapter.stable_index:
+        table.index = register_codes(adapter, table)
+        table.sort_index(inplace=True)
+
+    # statistics
+    value_table = table.loc[table['with_value'] == 1]
+    if not value_table.empty:
+        print('ratio:', value_table[V_FREQ].divide(value_table[FREQ]).mean())
+
+    print('total value:', table[V_FREQ].sum(), 'total freq', table[FREQ].sum())
+
+    print('all:')
+    print('code_num', 'final', 'mean', 'median','max', 'min', sep='\t')
+    print(table.shape[0], table[FREQ].sum(), int(table[FREQ].mean()),
+          table[FREQ].median(), table[FREQ].max(), table[FREQ].min(), sep='\t')
+    print('-'*20)
+
+    if not value_table.empty:
+        print('value:')
+        print('code_num', 'final', 'mean', 'median','max', 'min', sep='\t')
+        print(value_table.shape[0], value_table[V_FREQ].sum(), int(value_table[V_FREQ].mean()),
+              value_table[V_FREQ].median(), value_table[V_FREQ].max(), value_table[V_FREQ].min(), sep='\t')
+        print('-'*20)
+
+    # output dict
+    table.to_csv(out_path, index_label='index')
+    profiling.count('rows_out', len(table))
+
+
+def register_codes(adapter, table):
+    '''
+    Index the entries of a dictionary with the append-only registry of codes (code_registry.csv in adapter.idx_dir),
+    so that indices stay the same when tables are added or dropped:
+    registered entries keep their index, new entries get the next indices (in the order of the table),
+    registered entries missing from the table are retired (and get their index back if they come back).
+    Indices are never reused.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the dictionary
+        table:
+            the dictionary, with the columns of REGISTRY_KEY
+
+    Returns:
+    ----
+        numpy array of the index of every entry
+    '''
+
+    path = adapter.idx_dir + 'code_registry.csv'
+    now = datetime.datetime.now().isoformat(timespec='seconds')
+    if os.path.exists(path):
+        registry = pd.read_csv(path, dtype=str, keep_default_na=False, index_col=False)
+        registry['index'] = registry['index'].astype(np.int64)
+    else:
+        registry = pd.DataFrame({c: pd.Series(dtype=np.int64 if c == 'index' else object) for c in REGISTRY_COLS})
+
+    keys = table[REGISTRY_KEY].astype(str).reset_index(drop=True)
+    index = keys.merge(registry[['index'] + REGISTRY_KEY], on=REGISTRY_KEY, how='left')['index']
+
+    # new entries
+    new = index.isna().values
+    start = int(registry['index'].max()) + 1 if len(registry) > 0 else 1
+    index[new] = np.arange(start, start + new.sum())
+    index = index.astype(np.int64).values
+    added = keys.loc[new].assign(index=index[new], status='active', added=now, retired='')
+
+    # entries of the table are active, the others retired
+    present = registry['index'].isin(index)
+    retire = ~present & (registry['status'] == 'active')
+    registry.loc[present, 'status'] = 'active'
+    registry.loc[present, 'retired'] = ''
+    registry.loc[retire, 'status'] = 'retired'
+    registry.loc[retire, 'retired'] = now
+
+    registry = pd.concat([registry, added[REGISTRY_COLS]], ignore_index=True)
+    tmp_path = path + '.tmp'
+    registry.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+    print('code registry: {} new, {} retired, {} active codes'.format(
+          int(new.sum()), int(retire.sum()), int((registry['status'] == 'active').sum())))
+    return index
+
+
+class PatientCounter:
+    '''
+    Number of distinct patients of every code, counted chunk by chunk:
+    the distinct (code, patient) pairs of chunks are kept and deduplicated as they are added.
+    '''
+
+    # chunks of pairs kept before they are deduplicated together
+    MAX_PARTS = 8
+
+    def __init__(self):
+        self.parts = []
+
+    def update(self, codes, patients):
+        '''
+        add the patients of codes (array-likes of the same length)
+        '''
+
+        self.parts.append(pd.DataFrame({'code': np.asarray(codes), 'patient': np.asarray(patients)}).drop_duplicates())
+        if len(self.parts) > self.MAX_PARTS:
+            self.parts = [pd.concat(self.parts, ignore_index=True).drop_duplicates()]
+
+    def counts(self):
+        '''
+        pandas.Series of codes to their numbers of patients
+        '''
+
+        if len(self.parts) == 0:
+            return pd.Series(dtype='int64')
+        return pd.concat(self.parts, ignore_index=True).drop_duplicates()['code'].value_counts()
+
+
+@profiling.stage
+def prune_dict(adapter, dict_path, rules):
+    '''
+    Prune the vocabulary before tuples are generated:
+    every tuple generator loads its codes from the dictionary (and parses only their rows),
+    so pruned codes are never materialized as tuples.
+    The dictionary before pruning is kept as <name>_full.csv and the pruned entries,
+    with the reason, are written into <name>_pruned.csv. Kept entries are indexed again from 1.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the dictionary
+        dict_path:
+            filepath of the merged dictionary (code_dict.csv)
+        rules:
+            thresholds per code_type ('*' for the other types), any of:
+            'min_frequency' (total frequency), 'min_patients' (number of patients, for dictionaries counting them)
+            and 'top_k' (most frequent codes kept per source_table),
+            e.g. {'*': {'min_frequency': 100}, 'mimic': {'min_patients': 20, 'top_k': 1000}}
+
+    Returns:
+    ----
+        No return
+    '''
+
+    if not rules:
+        return
+    print('\nPruning the vocabulary of', dict_path)
+
+    table = pd.read_csv(dict_path, dtype={'code': str}, index_col=False)
+    table = valuestats.format_columns(table)
+    profiling.count('rows_in', len(table))
+
+    base = os.path.splitext(dict_path)[0]
+    table.to_csv(base + '_full.csv', index=False)
+
+    def threshold(name):
+        default = rules.get('*', {}).get(name)
+        return table['code_type'].map(lambda t: rules.get(t, {}).get(name, default)).astype('float64')
+
+    reason = pd.Series('', index=table.index, dtype=object)
+    min_freq = threshold('min_frequency')
+    reason[reason.eq('') & (table[FREQ] < min_freq)] = 'min_frequency'
+    if P_FREQ in table.columns:
+        min_patients = threshold('min_patients')
+        reason[reason.eq('') & (table[P_FREQ].astype('float64') < min_patients)] = 'min_patients'
+    top_k = threshold('top_k')
+    rank = table.sort_values([FREQ, 'code'], ascending=[False, True], kind='mergesort') \
+                .groupby('source_table', sort=False).cumcount().reindex(table.index)
+    reason[reason.eq('') & (rank >= top_k)] = 'top_k'
+
+    pruned = table.loc[reason != ''].assign(reason=reason[reason != ''])
+    pruned.to_csv(base + '_pruned.csv', index=False)
+    for (source, why), group in pruned.groupby(['source_table', 'reason']):
+        profiling.count_drops(source, 'pruned_' + why, dict(zip(group['code'], group[FREQ])))
+
+    table = table.loc[reason == ''].reset_index(drop=True)
+    if adapter.stable_index:
+        # kept codes keep their indices, pruned codes are retired from the registry
+        register_codes(adapter, table)
+    else:
+        table['index'] = np.arange(1, len(table) + 1)
+    table.to_csv(dict_path, index=False)
+    profiling.count('rows_out', len(table))
+    print('kept {} codes, pruned {} ({} rows)'.format(len(table), len(pruned), int(pruned[FREQ].sum())))
+
+
+def normalize_unit(unit):
+    '''
+    normalize unit of measurement
+    '''
+
+    if pd.isna(unit):
+        return 'nan'
+    else:
+        unit = unit.lower().strip()
+        if unit == '' or unit == 'none' or unit == 'nan':
+            return 'nan'
+        else:
+            return unit
+
+
+# tuples
+@profiling.stage
+def generate_code_tuples(adapter, tablename):
+    '''
+    Generate tuples for a table described by a TableSpec of the adapter
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the table
+        tablename:
+            Indicate the name of table
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('\ngenerating tuples of', tablename)
+
+    spec = adapter.tables[tablename]
+
+    # roll-up dictionary
+    rollup = spec.rollup() if spec.rollup is not None else None
+
+    # index dictionary
+    code2idx = load_code_dict(adapter, tablename)
+
+    # load the table
+    setting = {adapter.patient_key:str, spec.code_col:str}
+    if spec.admission_col is not None:
+        setting[spec.admission_col] = str
+    if spec.value_col is not None:
+        setting[spec.value_col] = str
+    # times are parsed by format_time()
+    setting[spec.time_col] = int if adapter.time_kind == 'offset' else str
+
+    # only the source codes of wanted codes are parsed
+    if rollup is not None:
+        codes = [k for k, v in rollup.items() if v in code2idx]
+    else:
+        codes = code2idx.keys()
+
+    # with a memory budget, every table is read in chunks
+    chunksize = spec.chunksize
+    if chunksize is None and adapter.memory_budget is not None:
+        chunksize = SELECT_CHUNKSIZE
+
+    reader = read_table(adapter, adapter.path(spec.path), usecols=list(setting.keys()),
+            dtype=adapter.dtypes(tablename, setting), index_col=False,
+            chunksize=chunksize, codes=codes, code_col=spec.code_col, min_chunksize=TUPLE_MIN_CHUNKSIZE)
+    # a chunked reader is closed with the stream it parses (a decompressing thread or process), even on an error
+    reader = reader if chunksize is not None else contextlib.nullcontext([reader])
+
+    # chunks done by a previous run that failed are skipped (see checkpoint.py)
+    journal = checkpoint.Journal(adapter, adapter.tuple_dir + tablename + '.journal',
+                                 [adapter.path(spec.path), adapter.idx_dir + 'code_dict.csv'], {'chunksize': chunksize},
+                                 [(adapter.tuple_dir, tablename)])
+    with reader as chunks:
+        for i, chunk in journal.chunks(chunks):
+            # convert all codes to indexes and delete unwanted codes
+            src_code = format_column(chunk[spec.code_col])
+            code = src_code.map(rollup) if rollup is not None else src_code
+            keep = code.isin(code2idx)
+            if not keep.all():
+                unknown = code.isna()
+                profiling.count_drops(tablename, 'unknown_rollup', src_code[~keep & unknown])
+                profiling.count_drops(tablename, 'not_in_dictionary', src_code[~keep & ~unknown])
+            chunk = chunk.loc[keep]
+            code = code.loc[keep]
+
+            table = pd.DataFrame({
+                'subject_id': chunk[adapter.patient_key],
+                'admission_id': format_column(chunk[spec.admission_col]) if spec.admission_col is not None else '',
+                'time': format_time(adapter, chunk[spec.time_col]),
+                'code': code.map(code2idx),
+                'value': format_column(chunk[spec.value_col]) if spec.value_col is not None else adapter.empty_value,
+            })
+
+            # output
+            suffix = str(i) if chunksize is not None else ''
+            frame2tuples(adapter, table, adapter.tuple_dir + tablename + suffix)
+            journal.commit(i)
+    journal.finish()
+
+
+def format_column(col:pd.Series):
+    '''
+    Format a column as if it was read with dtype str, missing values as ""
+    (for columns read with compact dtypes, see DatasetAdapter.dtypes)
+    '''
+
+    if pd.api.types.is_integer_dtype(col.dtype):
+        return col.astype(str).where(col.notna(), '')
+    return col.astype(object).fillna('')
+
+
+def format_time(adapter, time:pd.Series):
+    '''
+    Format the time column of tuples as strings, as written in .tri files:
+    integer offsets as they are, timestamps as seconds since the epoch (see parse_time()).
+    merge_tuples() sorts tuples by these integers and renders them with render_times().
+    '''
+
+    if adapter.time_kind == 'offset':
+        return time.astype(str)
+    return pd.Series(parse_time(time).astype(str), index=time.index)
+
+
+# missing time, sorted after all times (as "NaT" was sorted after all timestamps)
+TIME_NA = np.iinfo(np.int64).max
+
+
+def parse_time(time):
+    '''
+    Parse times in the fixed format of MIMIC ("YYYY-MM-DD HH:MM:SS" or "YYYY-MM-DD")
+    to int64 seconds since the epoch, missing times as TIME_NA.
+    numpy parses this ISO format directly, without inferring the format row by row.
+
+    Parameters:
+    ----
+        time:
+            pandas.Series of time strings (or already parsed timestamps)
+
+    Returns:
+    ----
+        numpy int64 array
+    '''
+
+    if pd.api.types.is_datetime64_any_dtype(time):
+        time = time.values.astype('datetime64[s]')
+    else:
+        time = np.asarray(time.fillna('NaT'), dtype=object).astype('datetime64[s]')
+    na = np.isnat(time)
+    time = time.astype(np.int64)
+    time[na] = TIME_NA
+    return time
+
+
+def render_times(adapter, times):
+    '''
+    Render times of tuples in bulk for the output:
+    seconds since the epoch as "YYYY-MM-DD HH:MM:SS" (TIME_NA as "NaT"), offsets as they are.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the tuples
+        times:
+            list of times as written in .tri files
+
+    Returns:
+    ----
+        list of strings
+    '''
+
+    if adapter.time_kind == 'offset' or len(times) == 0:
+        return times
+
+    times = np.array(times).astype(np.int64)
+    na = times == TIME_NA
+    text = np.datetime_as_string(np.where(na, 0, times).astype('datetime64[s]'), unit='s')
+    if text.dtype.itemsize == 19 * 4:
+        # replace the "T" of ISO format by a space on the bytes directly
+        text = text.astype('S19')
+        text.view(np.uint8).reshape(-1, 19)[:, 10] = ord(' ')
+        text = text.astype('U19')
+    else:
+        text = np.char.replace(text, 'T', ' ')
+    text[na] = 'NaT'
+    return text.tolist()
+
+
+def _read_code_dict(adapter, tablename):
+    '''
+    load the entries of a table in the dictionary.
+    '''
+
+    dic = pd.read_csv(adapter.idx_dir + 'code_dict.csv', dtype='str', index_col=False)
+    dic = dic.loc[dic['source_table'] == tablename, ['index', 'code', 'code_type', 'with_value']]
+    print('code dict size:', len(dic))
+    return dic
+
+
+def load_code_dict(adapter, tablename):
+    '''
+    load the dictionary, mapping codes to their IDs in tuples.
+    '''
+
+    dic = _read_code_dict(adapter, tablename)
+    return dict(zip(dic['code'], adapter.code_ids(dic)))
+
+
+def load_value_codes(adapter, tablename):
+    '''
+    load the dictionary, returning the mapping from codes to their IDs in tuples
+    and the set of codes with value.
+    '''
+
+    dic = _read_code_dict(adapter, tablename)
+    code2idx = dict(zip(dic['code'], adapter.code_ids(dic)))
+    code_with_value = set(dic.loc[dic['with_value'] == '1', 'code'])
+    return code2idx, code_with_value
+
+
+def select_patients(adapter, table, key=None, shard=True):
+    '''
+    keep the rows of the patients processed by the adapter (see DatasetAdapter.select)
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the table
+        table:
+            the table to filter
+        key:
+            the column of patients' ID (adapter.patient_key by default)
+        shard:
+            whether to keep only the patients of the shard (False for a table already partitioned by shard)
+
+    Returns:
+    ----
+        the filtered table
+    '''
+
+    if not (adapter.selecting if shard else adapter.sampling):
+        return table
+    key = adapter.patient_key if key is None else key
+    return table.loc[adapter.select(table[key], shard)]
+
+
+def read_table(adapter, path, key=None, chunksize=None, codes=None, code_col=None, min_chunksize=None, **kwargs):
+    '''
+    pandas.read_csv() of a source table, keeping only the rows of the patients
+    processed by the adapter (a sample and/or a shard, see DatasetAdapter.select)
+    and, if an allow-list is given, the rows of the wanted codes.
+    Rows are filtered chunk by chunk while parsing, so the other rows are never held in memory.
+    With pyarrow installed (and no memory budget), codes are filtered on Arrow record batches,
+    so the excluded rows never even become pandas objects.
+    Compressed tables (e.g. the .csv.gz files MIMIC-IV is distributed as) are read directly,
+    decompressed by another thread or process while parsed (see compression.open_source).
+    In a shard, a table partitioned by shard beforehand is read from its rows of the shard
+    (see sharding.partition_sources).
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the table
+        path:
+            filepath of the table, or of the extracted table whose compressed version is read (see compression.source_path)
+        key:
+            the column of patients' ID (adapter.patient_key by default),
+            read even if not in usecols and dropped after the selection
+        chunksize:
+            as in pandas.read_csv(); with a memory budget (adapter.memory_budget),
+            chunk sizes are picked by a ChunkSizer instead
+        codes:
+            allow-list of codes (compared as strings), None to keep all codes
+        code_col:
+            the column of codes filtered by the allow-list
+        min_chunksize:
+            with a memory budget, the smallest number of rows of a chunk (MIN_CHUNKSIZE by default)
+        kwargs:
+            other arguments of pandas.read_csv()
+
+    Returns:
+    ----
+        a pandas.DataFrame, or a reader of chunks (also a context manager) if chunksize is given
+    '''
+
+    path = compression.source_path(path)
+    part = adapter.shard_sources.get(path)
+    if part is not None:
+        path = part
+    stream = compression.open_source(path)
+    source = path if stream is None else stream
+
+    # the rows of a partitioned table are all in the shard
+    selecting = adapter.selecting if part is None else adapter.sampling
+    budget = adapter.memory_budget
+    if not selecting and codes is None and (chunksize is None or budget is None):
+        if chunksize is not None:
+            reader = pd.read_csv(source, chunksize=chunksize, **kwargs)
+            return _FilteredReader(None, reader, _table_name(path), key, False, None, None, stream)
+        try:
+            table = pd.read_csv(source, **kwargs)
+        finally:
+            if stream is not None:
+                stream.close()
+        profiling.count('rows_in', len(table))
+        return table
+
+    key = adapter.patient_key if key is None else key
+    drop_key = False
+    usecols = kwargs.get('usecols')
+    if selecting and usecols is not None and key not in usecols:
+        kwargs['usecols'] = list(usecols) + [key]
+        drop_key = True
+
+    if codes is not None:
+        codes = set(str(c) for c in codes)
+
+    # the streaming CSV reader of pyarrow reads blocks ahead without bound,
+    # so with a memory budget the rows are parsed by pandas in budgeted chunks
+    sizer = ChunkSizer(budget, chunksize or SELECT_CHUNKSIZE, kwargs.get('dtype'), kwargs.get('usecols'),
+                       min_chunksize or MIN_CHUNKSIZE)
+    if codes is not None and pa_csv is not None and budget is None and set(kwargs) <= _ARROW_KWARGS:
+        reader = _ArrowReader(path, _table_name(path), code_col, codes, sizer, stream, **kwargs)
+        codes = None
+    elif budget is not None:
+        reader = _BudgetReader(source, sizer, **kwargs)
+    else:
+        reader = pd.read_csv(source, chunksize=sizer.size, **kwargs)
+    reader = _FilteredReader(adapter if selecting else None, reader, _table_name(path), key, drop_key, code_col, codes,
+                             stream, part is None)
+    if chunksize is not None:
+        return reader
+
+    with reader:
+        chunks = list(reader)
+    if len(chunks) == 0:
+        chunks = [_read_header(path, **kwargs)]
+        if drop_key:
+            chunks[0] = chunks[0].drop(columns=key)
+    return pd.concat(chunks)
+
+
+def _table_name(path):
+    '''
+    name of a source table in drop counters: the name of its file without extensions
+    '''
+
+    return os.path.basename(path).split('.')[0]
+
+
+def _read_header(path, **kwargs):
+    '''
+    the empty table of the columns of a source table (compressed or not)
+    '''
+
+    with compression.open_file(path, 'rb') as f:
+        return pd.read_csv(f, nrows=0, **kwargs)
+
+
+class _FilteredReader:
+    '''
+    Chunks of a reader restricted to the patients processed by the adapter
+    (adapter is None to keep all patients) and to an allow-list of codes (codes is None to keep all codes).
+    Rows of other codes are counted as dropped ("not_in_dictionary").
+    The decompressed stream the reader parses, if any, is closed with it.
+    shard is False if the rows were already partitioned by shard (only a sample of patients is then selected).
+    '''
+
+    def __init__(self, adapter, reader, name, key, drop_key, code_col, codes, stream=None, shard=True):
+        self.adapter = adapter
+        self.reader = reader
+        self.name = name
+        self.key = key
+        self.drop_key = drop_key
+        self.code_col = code_col
+        self.codes = codes
+        self.stream = stream
+        self.shard = shard
+
+    def __iter__(self):
+        for chunk in self.reader:
+            if self.codes is not None:
+                code = chunk[self.code_col]
+                if code.dtype != object:
+                    code = code.astype(str)
+                keep = code.isin(self.codes)
+                profiling.count_drops(self.name, 'not_in_dictionary', code[~keep])
+                chunk = chunk.loc[keep]
+            if self.adapter is not None:
+                chunk = select_patients(self.adapter, chunk, self.key, self.shard)
+            if self.drop_key:
+                chunk = chunk.drop(columns=self.key)
+            profiling.count('rows_in', len(chunk))
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reader.close()
+        if self.stream is not None:
+            self.stream.close()
+
+
+class ChunkSizer:
+    '''
+    Pick the number of rows of chunks so that processing a chunk stays within a memory budget.
+    The memory of a row is first estimated from the dtypes, then measured on every chunk read,
+    so later chunks adapt to the actual data.
+
+    Parameters:
+    ----
+        budget:
+            memory budget (bytes) of a chunk being processed, None for chunks of a fixed size
+        chunksize:
+            the fixed size of chunks when budget is None
+        dtype, usecols:
+            as in pandas.read_csv(), for the first estimate
+        min_size:
+            the smallest number of rows of a chunk with a budget
+    '''
+
+    def __init__(self, budget, chunksize, dtype=None, usecols=None, min_size=None):
+        self.budget = budget
+        self.chunksize = chunksize
+        self.min_size = MIN_CHUNKSIZE if min_size is None else min_size
+        self.row_bytes = _row_bytes(dtype, usecols)
+
+    @property
+    def size(self):
+        '''
+        number of rows of the next chunk
+        '''
+
+        if self.budget is None:
+            return self.chunksize
+        return max(int(self.budget / (self.row_bytes * CHUNK_OVERHEAD)), self.min_size)
+
+    def update(self, chunk):
+        '''
+        measure the memory of a row on (the first rows of) a chunk read
+        '''
+
+        if self.budget is None or len(chunk) == 0:
+            return
+        sample = chunk.iloc[:SAMPLE_ROWS]
+        self.row_bytes = sample.memory_usage(deep=True).sum() / len(sample)
+
+
+# memory of processing a chunk, as a multiple of the memory of the chunk itself
+# (copies made while filtering and formatting, lists of tuples of the row-wise generators)
+CHUNK_OVERHEAD = 8
+
+# number of rows of the first block read to measure the memory of a row
+SAMPLE_ROWS = 10000
+MIN_CHUNKSIZE = 1000
+
+# estimated bytes of a value of each dtype (a Python string for str and unknown dtypes)
+_DTYPE_BYTES = {'int64': 8, 'Int64': 9, 'int32': 4, 'int8': 1, 'float64': 8, 'float32': 4,
+                'category': 4, int: 8, float: 8, 'int': 8, 'float': 8}
+
+
+def _row_bytes(dtype, usecols):
+    '''
+    estimated bytes of a row of a table read with dtype
+    '''
+
+    if isinstance(dtype, dict):
+        columns = list(usecols) if usecols is not None else list(dtype)
+        return sum(_DTYPE_BYTES.get(dtype.get(c), 64) for c in columns) + 8
+    columns = list(usecols) if usecols is not None else range(10)
+    return len(columns) * _DTYPE_BYTES.get(dtype, 64) + 8
+
+
+class _BudgetReader:
+    '''
+    Chunks of a CSV file read by pandas, sized by a ChunkSizer.
+    A first block of SAMPLE_ROWS rows measures the memory of a row
+    before the rest of the first chunk is read.
+    '''
+
+    def __init__(self, path, sizer, **kwargs):
+        self.reader = pd.read_csv(path, iterator=True, **kwargs)
+        self.sizer = sizer
+
+    def __iter__(self):
+        chunk = self._read(min(SAMPLE_ROWS, self.sizer.size))
+        if chunk is None:
+            return
+        self.sizer.update(chunk)
+        if len(chunk) < self.sizer.size:
+            rest = self._read(self.sizer.size - len(chunk))
+            if rest is not None:
+                chunk = pd.concat((chunk, rest))
+
+        while chunk is not None:
+            yield chunk
+            chunk = self._read(self.sizer.size)
+            if chunk is not None:
+                self.sizer.update(chunk)
+
+    def _read(self, size):
+        try:
+            return self.reader.get_chunk(size)
+        except StopIteration:
+            return None
+
+    def close(self):
+        self.reader.close()
+
+
+# arguments of pandas.read_csv() supported by _ArrowReader
+_ARROW_KWARGS = {'usecols', 'dtype', 'parse_dates', 'infer_datetime_format', 'index_col'}
+
+# dtypes of pandas.read_csv() converted by Arrow
+# (nullable integers and categoricals are converted by pandas afterwards)
+_ARROW_TYPES = {int: 'int64', 'int': 'int64', 'int64': 'int64', 'int32': 'int32', 'int8': 'int8', 'Int64': 'int64',
+                float: 'float64', 'float': 'float64', 'float64': 'float64', 'category': 'string'}
+
+
+class _ArrowReader:
+    '''
+    Chunks of a CSV file parsed by pyarrow, keeping only the rows of an allow-list of codes.
+    The chunks are the same as those of pandas.read_csv() (columns in the order of the file,
+    missing values as NaN, times parsed by pandas), except that chunk sizes count the rows
+    kept by the filtering.
+    '''
+
+    def __init__(self, path, name, code_col, codes, sizer, stream=None, usecols=None, dtype=None,
+                 parse_dates=None, infer_datetime_format=False, index_col=None):
+        columns = list(_read_header(path).columns)
+        if usecols is not None:
+            usecols = set(usecols)
+            columns = [c for c in columns if c in usecols]
+        parse_dates = list(parse_dates) if parse_dates else []
+
+        # columns converted by Arrow, the others are parsed as strings and converted by pandas
+        self.pd_types = {}
+        column_types = {}
+        for c in columns:
+            t = dtype.get(c) if isinstance(dtype, dict) else dtype
+            if c in parse_dates or c == code_col or t in (str, 'str', object, 'object'):
+                column_types[c] = pa.string()
+                if c == code_col and t not in (None, str, 'str', object, 'object'):
+                    self.pd_types[c] = t
+            elif t in _ARROW_TYPES:
+                column_types[c] = pa.type_for_alias(_ARROW_TYPES[t])
+                if t in ('Int64', 'category'):
+                    self.pd_types[c] = t
+            elif t is not None:
+                self.pd_types[c] = t
+
+        self.columns = columns
+        self.parse_dates = parse_dates
+        self.name = name
+        self.sizer = sizer
+        self.code_col = code_col
+        self.codes = pa.array(sorted(codes), type=pa.string())
+        self.reader = pa_csv.open_csv(path if stream is None else stream,
+            read_options=pa_csv.ReadOptions(block_size=64 * 1024 * 1024),
+            convert_options=pa_csv.ConvertOptions(include_columns=columns, column_types=column_types,
+                null_values=list(STR_NA_VALUES), strings_can_be_null=True))
+
+    def __iter__(self):
+        batches = []
+        rows = 0
+        for batch in self.reader:
+            keep = pc.is_in(batch.column(self.code_col), value_set=self.codes)
+            if batch.num_rows > 0 and profiling.running():
+                # codes of the rows dropped, counted by Arrow
+                dropped = pc.value_counts(batch.column(self.code_col).filter(pc.invert(keep)))
+                profiling.count_drops(self.name, 'not_in_dictionary',
+                    dict(zip(dropped.field('values').to_pylist(), dropped.field('counts').to_pylist())))
+            batch = batch.filter(keep)
+            if batch.num_rows == 0:
+                continue
+            batches.append(batch)
+            rows += batch.num_rows
+            while rows >= self.sizer.size:
+                size = self.sizer.size
+                table = pa.Table.from_batches(batches)
+                yield self._to_pandas(table.slice(0, size))
+                batches = table.slice(size).to_batches()
+                rows -= size
+        if rows > 0:
+            yield self._to_pandas(pa.Table.from_batches(batches))
+
+    def _to_pandas(self, table):
+        chunk = table.to_pandas()
+        for c in self.columns:
+            if chunk[c].dtype == object:
+                # missing strings as NaN (not None), like pandas.read_csv()
+                chunk[c] = chunk[c].where(chunk[c].notna(), np.nan)
+        for c, t in self.pd_types.items():
+            chunk[c] = chunk[c].astype(t)
+        for c in self.parse_dates:
+            chunk[c] = pd.to_datetime(chunk[c])
+        return chunk[self.columns]
+
+    def close(self):
+        self.reader.close()
+
+
+def load_patients(adapter):
+    '''
+    load all patients' ID, each with an empty list of tuples.
+    '''
+
+    return {i:[] for i in adapter.patient_index()}
+
+
+class TupleWriter:
+    '''
+    Buffered writer of tuples: blocks of lines formatted at once (see format_tuples and format_rows)
+    are joined and written to the file in large writes instead of line by line.
+
+    Parameters:
+    ----
+        f:
+            the text file to write to
+        buffer_size:
+            characters buffered before they are written
+    '''
+
+    def __init__(self, f, buffer_size=WRITE_BUFFER):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text):
+        '''
+        write formatted text (a header, a patient's ID)
+        '''
+
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def write_lines(self, lines):
+        '''
+        write a block of formatted lines (without line break)
+        '''
+
+        if len(lines) > 0:
+            self.write('\n'.join(lines) + '\n')
+
+    def write_patients(self, patients, lines, bounds):
+        '''
+        write the blocks of patients of a .tri file: the ID of every patient k,
+        its formatted lines lines[bounds[k]:bounds[k+1]] and a blank line
+        '''
+
+        for k, pid in enumerate(patients):
+            if bounds[k] < bounds[k+1]:
+                self.write(pid + '\n' + '\n'.join(lines[bounds[k]:bounds[k+1]]) + '\n\n')
+            else:
+                self.write(pid + '\n\n')
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.f.write(''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.flush()
+
+
+def format_tuples(*columns):
+    '''
+    Format tuples from columns of strings (e.g. of a pandas.DataFrame), column by column:
+    commas in values (the last column) are replaced by '/' so that a value stays a single field,
+    then the fields of every row are joined by commas.
+
+    Parameters:
+    ----
+        columns:
+            the columns of the tuples (arrays or sequences of strings), values last
+
+    Returns:
+    ----
+        list of the lines (without line break)
+    '''
+
+    # joining the zipped columns is faster than adding object arrays column by column,
+    # which builds an intermediate string per column
+    values = [v.replace(',', '/') for v in columns[-1]]
+    return list(map(','.join, zip(*columns[:-1], values)))
+
+
+def format_rows(rows, times=None):
+    '''
+    Format tuples from rows of strings in a single pass (rows of Python lists are slower to split into columns),
+    with values escaped as by format_tuples().
+
+    Parameters:
+    ----
+        rows:
+            rows [admission, time, code, value],
+            or (patient's ID, [admission, time, code, value]) if times is given
+        times:
+            the rendered times of the rows, written in place of their times, with their patients' ID first
+
+    Returns:
+    ----
+        list of the lines (without line break)
+    '''
+
+    if times is None:
+        return [f'{a},{t},{c},{v.replace(",", "/")}' for a, t, c, v in rows]
+    return [f'{p},{a},{t},{c},{v.replace(",", "/")}' for (p, (a, _, c, v)), t in zip(rows, times)]
+
+
+def frame2tuples(adapter, table, oFile):
+    '''
+    Output a pandas.Dataframe table as a batch of tuples.
+    Patients are written in the order of adapter.load_patients(),
+    tuples of a patient sorted by time (rows at the same time keep their order in the table).
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the table
+        table:
+            The table to output, with columns (patient, admission, time, code, value)
+            all formatted as strings
+        oFile:
+            file path of the output file
+
+    Returns:
+    ----
+        No return
+    '''
+
+    # read once per selection of patients, not per chunk
+    patients = adapter.patient_index()
+
+    # patients' ID may be read as integers
+    pids = table.iloc[:, 0]
+    if pd.api.types.is_integer_dtype(pids.dtype):
+        rank = adapter.patient_index(integer=True).get_indexer(pids)
+    else:
+        rank = patients.get_indexer(pids)
+    missing = rank < 0
+    if missing.any():
+        # counted by code, not printed patient by patient
+        name = _tri_order(os.path.basename(oFile) + '.tri')[0]
+        profiling.count_drops(name, 'patient_not_found', table.iloc[:, 3][missing])
+        table = table.loc[~missing]
+        rank = rank[~missing]
+
+    profiling.count('rows_out', len(table))
+
+    # group the rows by patients, sorted by time (stable, so the order of rows at the same time is kept)
+    order = np.lexsort((table.iloc[:, 2].values.astype(np.int64), rank))
+    rank = rank[order]
+    # formatted in the order of the table (sequential in memory), then sorted
+    lines = np.array(format_tuples(*(table.iloc[:, i].values for i in range(1, 5))), dtype=object)[order]
+    bounds = np.searchsorted(rank, np.arange(len(patients) + 1))
+
+    with checkpoint.atomic_open(oFile + '.tri', 'w', compress=True, encoding='utf8') as f, TupleWriter(f) as out:
+        out.write(TRI_HEADER)
+        out.write_patients(patients, lines, bounds)
+
+
+def table2tuples(adapter, table, oFile):
+    '''
+    Convert a pandas.Dataframe table of codes without value to a batch of tuples and output
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the table
+        table:
+            The table to output, with columns (patient, admission, code, time)
+        oFile:
+            file path of the output file
+
+    Returns:
+    ----
+        No return
+    '''
+
+    table = pd.DataFrame({
+        'subject_id': table.iloc[:, 0],
+        'admission_id': format_column(table.iloc[:, 1]),
+        'time': format_time(adapter, table.iloc[:, 3]),
+        'code': table.iloc[:, 2].astype(str),
+        'value': adapter.empty_value,
+    })
+    frame2tuples(adapter, table, oFile)
+
+
+def patients2tuples(patients, oFile, ids=None):
+    '''
+    Output tuples collected per patient, sorted by time
+    (tuples at the same time keep the order they were collected in).
+
+    Parameters:
+    ----
+        patients:
+            tuples to output, as returned by load_patients()
+
+        oFile:
+            file path of the output file
+        ids:
+            the patients' ID as strings in the order of patients (adapter.patient_index()),
+            None to convert the keys of patients for every call
+
+    Returns:
+    ----
+        No return
+    '''
+
+    assert ids is None or len(ids) == len(patients), 'ids are not the IDs of the patients'
+
+    # sort the tuples of all patients at once by (patient, time)
+    sizes = np.fromiter((len(info) for info in patients.values()), dtype=np.int64, count=len(patients))
+    rows = [l for info in patients.values() for l in info]
+    times = np.fromiter((int(l[1]) for l in rows), dtype=np.int64, count=len(rows))
+    order = np.lexsort((times, np.repeat(np.arange(len(sizes)), sizes)))
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+    lines = np.array(format_rows(rows), dtype=object)[order]
+
+    with checkpoint.atomic_open(oFile + ".tri", 'w', compress=True, encoding='utf8') as f, TupleWriter(f) as out:
+        out.write(TRI_HEADER)
+        out.write_patients([str(id) for id in patients] if ids is None else ids, lines, bounds)
+    profiling.count('rows_out', len(rows))
+
+
+@profiling.stage
+def merge_tuples(adapter, src_dir, cols, out_path, aggregate=False, dedup=False):
+    '''
+    Merge tuples of all tables together.
+    Every tuple file lists all patients in the same order, with their tuples sorted by time (see TRI_HEADER),
+    so the tuples of a patient are a k-way merge of the runs of the files.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the tuples
+        src_dir: source directory of tuples
+        cols: column names of output file
+        out_path: filepath to output the merged tuples
+        aggregate: whether to aggregate numeric tuples into time buckets (see load_aggregation())
+        dedup: whether to drop duplicate tuples of a patient, as configured by the adapter (see _dedup_patient())
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print("\nMerging tuples in {}".format(src_dir))
+
+    # files in a fixed order (table, then chunk), so that tuples at the same time
+    # keep the same order however tables are chunked
+    # (files being written by a stage end with .tmp)
+    iFiles = sorted([i for i in os.listdir(src_dir) if i.endswith('.tri')], key=_tri_order)
+    if len(iFiles) == 0:
+        print('No .tri files found in', src_dir)
+        return
+
+    # files written before .tri files were sorted have no header (and are read from their start again)
+    names = iFiles
+    files = []
+    is_sorted = []
+    for i in names:
+        src = compression.open_file(src_dir + i)
+        is_sorted.append(src.readline() == TRI_HEADER)
+        if not is_sorted[-1]:
+            src.close()
+            src = compression.open_file(src_dir + i)
+        files.append(src)
+    iFiles = files
+    if not all(is_sorted):
+        print('{} unsorted .tri files, sorted while merging'.format(is_sorted.count(False)))
+
+    rules = load_aggregation(adapter) if aggregate else None
+    if rules is not None and len(rules) == 0:
+        rules = None
+
+    exact = dedup and adapter.dedup_exact
+    equivalents = adapter.dedup_equivalent_codes if dedup else None
+    tolerance = pd.Timedelta(adapter.dedup_tolerance).total_seconds() / adapter.time_unit if equivalents else 0
+    table = os.path.basename(out_path)
+
+    try:
+        with compression.open_file(out_path, 'w') as f, TupleWriter(f) as tuples_out:
+            tuples_out.write(','.join(cols) + '\n')
+
+            while True:
+                p = []
+                data = []
+                for src in iFiles:
+                    pp, dd = _get_patient_data(src, 10000)
+                    p.append(pp)
+                    data.append(dd)
+
+                _check_patients(src_dir, names, p)
+                if len(p[0]) == 0:
+                    break
+
+                rows = []
+                n = 0
+                drops = collections.defaultdict(collections.Counter)
+                for i, p_id in enumerate(p[0]):
+                    # times are integers in .tri files
+                    runs = []
+                    for slice, sorted_by_time in zip(data, is_sorted):
+                        if len(slice[i]) > 0:
+                            runs.append(slice[i] if sorted_by_time else sorted(slice[i], key=lambda x:int(x[1])))
+
+                    # if the patient has no tuple, then ignore him/her
+                    if len(runs) == 0:
+                        continue
+
+                    if len(runs) == 1:
+                        temp = runs[0]
+                    else:
+                        # stable: tuples at the same time are kept in the order of the files
+                        temp = list(heapq.merge(*runs, key=lambda x:int(x[1])))
+                    n += len(temp)
+                    if exact or equivalents:
+                        temp = _dedup_patient(temp, exact, equivalents, tolerance, drops)
+                    rows.extend((p_id, l) for l in temp)
+
+                profiling.count('rows_in', n)
+                for reason, codes in drops.items():
+                    profiling.count_drops(table, reason, codes)
+                if rules is not None:
+                    n = len(rows)
+                    rows = _aggregate_rows(adapter, rows, rules)
+                    profiling.count('rows_aggregated', n - len(rows))
+                profiling.count('rows_out', len(rows))
+
+                # format the batch at once, with the times rendered in bulk
+                times = render_times(adapter, [l[1] for _, l in rows])
+                tuples_out.write_lines(format_rows(rows, times))
+    finally:
+        for src in iFiles:
+            src.close()
+    print('Merging finished.')
+
+
+def _check_patients(src_dir, names, patients):
+    '''
+    make sure that the .tri files list the same patients in a batch, in the same order
+    '''
+
+    for name, other in zip(names[1:], patients[1:]):
+        if other == patients[0]:
+            continue
+        k = 0
+        while k < min(len(other), len(patients[0])) and other[k] == patients[0][k]:
+            k += 1
+        first = [p[k] if k < len(p) else 'none' for p in (patients[0], other)]
+        raise ValueError('{} and {} list other patients: {} and {} after {} same patients in a batch'.format(
+                         src_dir + names[0], src_dir + name, first[0], first[1], k))
+
+
+def _dedup_patient(tuples, exact, equivalents, tolerance, drops):
+    '''
+    Drop duplicates among the time-sorted tuples of a patient, hashing them as they come:
+    tuples identical to a previous one (if exact), and tuples of a code in equivalents
+    with the same value as a tuple of the equivalent code within tolerance (in units of time of the tuples).
+    Dropped tuples are counted in drops (reason -> Counter of codes).
+    '''
+
+    if exact:
+        seen = set()
+        kept = []
+        for l in tuples:
+            key = tuple(l)
+            if key in seen:
+                drops['duplicate'][l[2]] += 1
+                continue
+            seen.add(key)
+            kept.append(l)
+        tuples = kept
+
+    if equivalents:
+        # sorted times of the tuples of every (code, value) copied by another code
+        targets = set(equivalents.values())
+        times = {}
+        for l in tuples:
+            if l[2] in targets and int(l[1]) != TIME_NA:
+                times.setdefault((l[2], _value_key(l[3])), []).append(int(l[1]))
+
+        if len(times) > 0:
+            kept = []
+            for l in tuples:
+                same = times.get((equivalents.get(l[2]), _value_key(l[3])))
+                if same is not None and int(l[1]) != TIME_NA:
+                    time = int(l[1])
+                    j = bisect.bisect_left(same, time - tolerance)
+                    if j < len(same) and same[j] <= time + tolerance:
+                        drops['near_duplicate'][l[2]] += 1
+                        continue
+                kept.append(l)
+            tuples = kept
+
+    return tuples
+
+
+def _value_key(value):
+    '''
+    a value compared as a number if it is one (e.g. "7" and "7.0"), as text otherwise
+    '''
+
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def load_aggregation(adapter):
+    '''
+    Rules of time-bucketed aggregation of the codes with value: the rule of the source table of a code
+    (adapter.aggregate_tables, see settings.AGGREGATE_TABLES), overridden by the columns
+    aggregate_window and aggregate_function of code_dict.csv where they are filled.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the tuples
+
+    Returns:
+    ----
+        pandas.DataFrame indexed by the IDs of codes in tuples,
+        with the window (in units of time of the tuples) and the function of every aggregated code
+    '''
+
+    tables = adapter.aggregate_tables
+    dic = pd.read_csv(adapter.idx_dir + 'code_dict.csv', dtype=str, keep_default_na=False, index_col=False)
+    dic = dic.loc[dic['with_value'] == '1']
+
+    window = dic['source_table'].map(lambda t: tables[t][0] if t in tables else '')
+    function = dic['source_table'].map(lambda t: tables[t][1] if t in tables else '')
+    for col, rule in [('aggregate_window', window), ('aggregate_function', function)]:
+        if col in dic.columns:
+            own = dic[col] != ''
+            rule[own] = dic.loc[own, col]
+
+    keep = (window != '') & (window.str.lower() != 'none')
+    seconds = np.array([pd.Timedelta(w).total_seconds() for w in window[keep]], dtype=np.float64)
+    rules = pd.DataFrame({'window': np.maximum(np.ceil(seconds / adapter.time_unit), 1).astype(np.int64),
+                          'function': function[keep].str.lower().values},
+                         index=adapter.code_ids(dic.loc[keep]).values)
+    rules = rules.loc[~rules.index.duplicated()]
+
+    unknown = set(rules['function']) - set(AGGREGATE_FUNCTIONS)
+    assert len(unknown) == 0, 'unknown aggregation functions: {}'.format(unknown)
+    if len(rules) > 0:
+        print('Aggregating the values of {} codes into time buckets'.format(len(rules)))
+    return rules
+
+
+def _aggregate_rows(adapter, rows, rules):
+    '''
+    Aggregate the numeric tuples of a batch of merged rows into time buckets
+    (floor(time / window) per patient, admission and code, see load_aggregation()).
+    A bucket is kept as its last tuple, with the value aggregated by the function of the code,
+    so that a value is never dated before the tuples it summarizes.
+    Tuples without time or numeric value are kept as they are.
+    Aggregated values are formatted by AGGREGATE_FORMAT, with a comma as decimal separator
+    for the codes whose values have one (escaped as '/' by format_rows(), as in the other tuples of the code).
+    '''
+
+    k = pd.Index(rules.index).get_indexer([l[2] for _, l in rows])
+    cand = np.flatnonzero(k >= 0)
+    if len(cand) == 0:
+        return rows
+
+    time = np.array([rows[i][1][1] for i in cand]).astype(np.int64)
+    value = pd.Series([rows[i][1][3] for i in cand], dtype=object)
+    escaped = np.zeros(len(cand), dtype=bool)
+    if adapter.comma_decimal:
+        escaped = value.str.contains('/', regex=False).values
+        value = value.str.replace('/', '.', regex=False)
+    value = pd.to_numeric(value, errors='coerce').values
+    ok = np.isfinite(value) & (time != TIME_NA)
+    cand, time, value, k, escaped = cand[ok], time[ok], value[ok], k[cand][ok], escaped[ok]
+    if len(cand) == 0:
+        return rows
+
+    # codes with a comma as decimal separator
+    comma = np.zeros(len(rules), dtype=bool)
+    comma[k[escaped]] = True
+
+    frame = pd.DataFrame({'patient': [rows[i][0] for i in cand], 'admission': [rows[i][1][0] for i in cand],
+                          'code': k, 'bucket': time // rules['window'].values[k], 'value': value, 'row': cand})
+    group = frame.groupby(['patient', 'admission', 'code', 'bucket'], sort=False)
+
+    # rows are sorted by time within a patient, the last tuple of a bucket is its last row
+    last = group['row'].transform('max').values
+    keep = np.ones(len(rows), dtype=bool)
+    keep[cand[cand != last]] = False
+
+    agg = group.agg(row=('row', 'max'), n=('row', 'size'), mean=('value', 'mean'),
+                    min=('value', 'min'), max=('value', 'max'))
+    agg = agg.loc[agg['n'] > 1]
+    code = agg.index.get_level_values('code')
+    function = rules['function'].values[code]
+    for func in ['mean', 'min', 'max']:
+        part = agg.loc[function == func]
+        values = [AGGREGATE_FORMAT.format(v) for v in part[func].values]
+        for row, v, c in zip(part['row'].values, values, comma[code[function == func]]):
+            rows[row][1][3] = v.replace('.', ',') if c else v
+
+    return [r for r, kept in zip(rows, keep) if kept]
+
+
+def _tri_order(filename):
+    '''
+    sort key of a .tri file: the table name, then the chunk number
+    '''
+
+    name = filename[:filename.index('.tri')]
+    stem = name.rstrip('0123456789')
+    return stem, int(name[len(stem):] or -1)
+
+
+def _get_patient_data(f, batch_size):
+    '''
+    Read a batch of patients' ID and corresponding tuples
+    '''
+
+    p = []
+    d = []
+
+    for i in range(batch_size):
+        patient = f.readline()[:-1]
+        if patient == '':
+            break
+
+        p.append(patient)
+        data = []
+
+        while True:
+            line = f.readline()[:-1]
+            if line == '':
+                break
+
+            line = line.strip().split(',')
+            data.append(line)
+
+        d.append(data)
+
+    return p, d
+
+
+# post process
+def get_patients_with_records(tuple_path):
+    '''
+    Find Patients with records in tuples.csv
+    and return IDs of these patients.
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of tuples.csv
+
+    Returns:
+    ----
+        IDs of Patients with records
+    '''
+
+    print('===================================')
+    print('Find patients with health record (tuples).')
+
+    patients = set()
+
+    with compression.open_file(tuple_path) as f, pd.read_csv(f, index_col=False, usecols=[0],
+            chunksize=30000000, dtype='str') as reader:
+        for i, chunk in enumerate(reader):
+            profiling.count('rows_in', len(chunk))
+            patients.update(chunk.iloc[:, 0].unique())
+
+    print('total patients', len(patients))
+    print('===================================')
+
+    return patients
+
+
+@profiling.stage
+def revise_code_dict(adapter, input_dict_path, tuple_path):
+    '''
+    Revise the frequencies in dictionary according to
+    the tuples.csv (namely re-count the frequencies of all codes).
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the tuples
+        input_dict_path:
+            filepath of original dictionary
+        tuple_path:
+            filepath of tuples.csv
+
+    Returns:
+    ----
+        the updated dictionary
+    '''
+
+    print("Revising the dictionary...")
+
+    # count the frequency of codes
+    value_freq = pd.Series(dtype='int64')
+    total_freq = pd.Series(dtype='int64')
+
+    with compression.open_file(tuple_path) as f, pd.read_csv(f, index_col=False, usecols=[3, 4],
+            chunksize=30000000, dtype='str') as reader:
+        for i, chunk in enumerate(reader):
+            profiling.count('rows_in', len(chunk))
+            code = chunk.iloc[:, 0]
+            value = chunk.iloc[:, 1]
+            if adapter.comma_decimal:
+                value = value.str.replace('/', '.', regex=False)
+
+            is_value = pd.to_numeric(value, errors='coerce').notna()
+            total_freq = total_freq.add(code.value_counts(), fill_value=0)
+            value_freq = value_freq.add(code[is_value].value_counts(), fill_value=0)
+
+    new_dict = valuestats.format_columns(pd.read_csv(input_dict_path, index_col=False))
+    ids = adapter.code_ids(pd.read_csv(input_dict_path, dtype='str', index_col=False))
+
+    new_value_freq = ids.map(value_freq).fillna(0).astype('int64')
+    new_total_freq = ids.map(total_freq).fillna(0).astype('int64')
+
+    # print updated codes
+    print('checking freq...')
+    for k, old, new in zip(ids, new_dict[V_FREQ], new_value_freq):
+        if old != new:
+            print('[Value freq changed] index:', k, ' freq:', old, '->', new)
+    for k, old, new in zip(ids, new_dict[FREQ], new_total_freq):
+        if old != new:
+            print('[Total freq changed] index:', k, ' freq:', old, '->', new)
+
+    new_dict[V_FREQ] = new_value_freq.values
+    new_dict[FREQ] = new_total_freq.values
+
+    return new_dict
+
+
+@profiling.stage
+def normalize_tuples(adapter, dict_path, tuple_path, out_path, method='zscore', clip=('value_p01', 'value_p99')):
+    '''
+    Export the tuples with normalized values, from the statistics of values in the dictionary
+    (see valuestats.py). Numeric values of codes with value are clipped and normalized with NumPy
+    chunk by chunk, the other values (_MISSING, _STRING, ...) are kept as they are.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the tuples
+        dict_path:
+            filepath of the dictionary with the statistics of values (e.g. the revised code_dict.csv)
+        tuple_path:
+            filepath of tuples.csv
+        out_path:
+            filepath to output the normalized tuples
+        method:
+            'zscore' for (value - mean) / std,
+            'minmax' for (value - lower) / (upper - lower), bounded by clip (by min and max if not clipped),
+            'quantile' for the index of the quantile bin of the value (0 to len(valuestats.QUANTILES))
+        clip:
+            columns of the dictionary with the lower and upper bounds of values
+            (quantiles, or bounds configured per code), None not to clip
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('\nNormalizing the values of {} ({})'.format(tuple_path, method))
+    assert method in ['zscore', 'minmax', 'quantile']
+
+    # statistics of codes (a code listed by several tables has the statistics of the table with its values)
+    dic = pd.read_csv(dict_path, dtype=str, index_col=False)
+    cols = list(dict.fromkeys(valuestats.STAT_COLS + (list(clip) if clip is not None else [])))
+    stats = dic.reindex(columns=cols).apply(pd.to_numeric, errors='coerce')
+    known = (dic['with_value'] == '1') & (stats['value_count'] > 0)
+    order = np.argsort(~known.values, kind='mergesort')
+    ids = adapter.code_ids(dic).iloc[order]
+    first = ~ids.duplicated().values
+    ids = pd.Index(ids[first])
+    stats = stats.iloc[order[first]]
+    known = known.values[order[first]]
+    mean = stats['value_mean'].values
+    std = stats['value_std'].values
+    std = np.where(np.isfinite(std) & (std > 0), std, 1.0)
+    lower = stats[clip[0]].values if clip is not None else stats['value_min'].values
+    upper = stats[clip[1]].values if clip is not None else stats['value_max'].values
+    lower = np.where(np.isfinite(lower), lower, stats['value_min'].values)
+    upper = np.where(np.isfinite(upper), upper, stats['value_max'].values)
+    edges = stats[['value_p{:02d}'.format(int(q * 100)) for q in valuestats.QUANTILES]].values
+
+    with compression.open_file(out_path, 'w', newline='') as out, compression.open_file(tuple_path) as f, \
+            pd.read_csv(f, dtype=str, keep_default_na=False, index_col=False,
+                        chunksize=NORMALIZE_CHUNKSIZE) as reader:
+        for i, chunk in enumerate(reader):
+            profiling.count('rows_in', len(chunk))
+
+            # numeric values of codes with statistics
+            value = chunk['value']
+            if adapter.comma_decimal:
+                value = value.str.replace('/', '.', regex=False)
+            x = pd.to_numeric(value, errors='coerce').values
+            k = ids.get_indexer(chunk['code'])
+            ok = (k >= 0) & np.isfinite(x)
+            ok[ok] = known[k[ok]]
+            k = k[ok]
+            x = x[ok]
+
+            if clip is not None:
+                x = np.fmin(np.fmax(x, lower[k]), upper[k])
+            if method == 'zscore':
+                x = ((x - mean[k]) / std[k]).astype(str)
+            elif method == 'minmax':
+                span = upper[k] - lower[k]
+                x = np.where(span > 0, (x - lower[k]) / np.where(span > 0, span, 1), 0.0).astype(str)
+            else:
+                x = (x[:, None] > edges[k]).sum(axis=1).astype(str)
+
+            value = chunk['value'].values.copy()
+            value[ok] = x
+            chunk['value'] = value
+            chunk.to_csv(out, index=False, header=(i == 0))
+            profiling.count('rows_out', len(chunk))
+
+    print('Normalized tuples written to', out_path)
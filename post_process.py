@@ -4,9 +4,15 @@ import numpy as np
 import pandas as pd
 import json
 from tqdm import tqdm
-from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR
+import pipeline
+import sequences
+import profiling
+import compression
+from dataset import MIMIC
+from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR, NORMALIZE_METHOD, NORMALIZE_CLIP, EXPORT_SEQUENCES
 
 
+@profiling.stage
 def generate_patient_dict(tuple_path, out_path):
     '''
     Generate a patients' dictionary which contains 
@@ -23,11 +29,11 @@ def generate_patient_dict(tuple_path, out_path):
     '''
     
     # load core/patients.csv
-    patients = pd.read_csv(MIMIC_DIR + 'hosp/patients.csv/patients.csv', dtype={'subject_id':'str'}, index_col=False)
+    patients = pipeline.read_table(MIMIC, MIMIC_DIR + 'hosp/patients.csv/patients.csv', dtype={'subject_id':'str'}, index_col=False)
     print('patients', patients.shape)
     
     # load hosp/admission.csv
-    admissions = pd.read_csv(MIMIC_DIR + 'hosp/admissions.csv/admissions.csv', dtype={'subject_id':'str'},
+    admissions = pipeline.read_table(MIMIC, MIMIC_DIR + 'hosp/admissions.csv/admissions.csv', dtype={'subject_id':'str'},
                 parse_dates=['admittime', 'dischtime'], infer_datetime_format=True, index_col=False)
     
     # add patients' first check-in time and last check-out time
@@ -59,7 +65,7 @@ def generate_patient_dict(tuple_path, out_path):
     """
     
     # eliminate patients whose health record is void
-    recorded_patients = _get_patients_with_records(tuple_path)
+    recorded_patients = pipeline.get_patients_with_records(tuple_path)
     patients = patients.loc[patients['subject_id'].isin(recorded_patients), :]
     
     patients = patients.loc[:, ['subject_id','gender','age','race','marital_status',
@@ -70,41 +76,10 @@ def generate_patient_dict(tuple_path, out_path):
 
     print('patients_dict.csv shape', patients.shape)
     patients.to_csv(out_path, index=False)
+    profiling.count('rows_out', len(patients))
 
 
-def _get_patients_with_records(tuple_path):
-    '''
-    Find Patients with records in tuples.csv
-    and return IDs of these patients.
-    
-    Parameters:
-    ----
-        tuple_path:
-            filepath of tuples.txt
-            
-    Returns:
-    ----
-        IDs of Patients with records
-    '''
-    
-    print('===================================')
-    print('Find patients with health record (tuples).')
-    
-    patients = set()
-    
-    with pd.read_csv(tuple_path, index_col=False, usecols=[0],
-            chunksize=30000000, dtype='str') as reader:
-        for i, chunk in enumerate(reader):
-            for pid in tqdm(chunk.itertuples(False), total=chunk.shape[0]):     
-                patients.add(pid[0])
-        
-    
-    print('total patients', len(patients))
-    print('===================================')
-
-    return patients
-
-
+@profiling.stage
 def revise_code_dict(input_dict_path, tuple_path, output_dict_path, add_label=False):
     '''
     Revise the frequencies in dictionary according to
@@ -126,48 +101,7 @@ def revise_code_dict(input_dict_path, tuple_path, output_dict_path, add_label=Fa
         None
     '''
     
-    print("Revising the dictionary...")
-    
-    # load the original dictionary
-    original_dict = pd.read_csv(input_dict_path, 
-        usecols=['code', 'code_type', 'value_frequency', 'total_frequency'], index_col=False)
-
-    original_dict = {i[1]+'_'+i[0]:(i[2], i[3]) for i in original_dict.itertuples(False)}
-    value_freq_dict = {i:0 for i in original_dict}
-    total_freq_dict = {i:0 for i in original_dict}
-
-    # count the frequency of codes
-    with pd.read_csv(tuple_path, index_col=False,
-            chunksize=30000000, dtype='str') as reader:
-        for i, chunk in enumerate(reader):
-            for pid, hadm, time, code, value in tqdm(chunk.itertuples(False), total=chunk.shape[0]):     
-    
-                total_freq_dict[code] += 1
-                
-                def isFloatNum(str):
-                    try:
-                        float(str)
-                    except:
-                        return False
-                    else:
-                        return True
-
-                if not pd.isna(value) and isFloatNum(value):
-                    value_freq_dict[code] += 1
-
-
-    # print updated codes
-    print('checking freq...')
-    for k,v in original_dict.items():
-        if v[0] != value_freq_dict[k]:
-            print('[Value freq changed] index:', k, ' freq:', v[0], '->', value_freq_dict[k])
-        if v[1] != total_freq_dict[k]:
-            print('[Total freq changed] index:', k, ' freq:', v[1], '->', total_freq_dict[k])
-        
-    new_dict = pd.read_csv(input_dict_path, index_col=False)
-
-    new_dict['value_frequency'] = new_dict[['code_type', 'code']].apply(lambda x:value_freq_dict[x[0]+'_'+x[1]], axis=1)
-    new_dict['total_frequency'] = new_dict[['code_type', 'code']].apply(lambda x:total_freq_dict[x[0]+'_'+x[1]], axis=1)
+    new_dict = pipeline.revise_code_dict(MIMIC, input_dict_path, tuple_path)
 
     # add labels to the codes in new dictionary
     if add_label:
@@ -175,6 +109,7 @@ def revise_code_dict(input_dict_path, tuple_path, output_dict_path, add_label=Fa
     
     # output dictionary
     new_dict.to_csv(output_dict_path, index=False)
+    profiling.count('rows_out', len(new_dict))
 
 
 def _add_label(dic):
@@ -187,7 +122,7 @@ def _add_label(dic):
     path = MIMIC_DIR + 'hosp/' + 'drgcodes.csv/' + 'drgcodes.csv'
     cols = ['subject_id', 'hadm_id', 'drg_type', 'drg_code', 'description', 'drg_severity', 'drg_mortality']
     setting = {'drg_code': 'str', 'drg_type': 'str', 'description':'str'}
-    drg_table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    drg_table = pd.read_csv(compression.source_path(path), usecols=setting.keys(), dtype=setting, index_col=False)
     
     # for line in drg_table[['drg_code', 'description']].itertuples(False):
     #     drg_dict[line[0]] = line[1]
@@ -335,7 +270,7 @@ def _get_label_dict(code_set:set):
     path = 'mimic/hosp/d_labitems.csv/d_labitems.csv'
     cols = ['itemid','label','fluid','category','loinc_code']
     setting = {'itemid':str,'label':str,'fluid':str,'category':str}
-    table = pd.read_csv(path, usecols=setting.keys(), 
+    table = pd.read_csv(compression.source_path(path), usecols=setting.keys(), 
                 dtype=setting, index_col=False)
     
     table = table.loc[(table['itemid'].isin(code_set))]
@@ -347,7 +282,7 @@ def _get_label_dict(code_set:set):
     cols = ['itemid','label','abbreviation','linksto','category','unitname','param_type',
             'lownormalvalue','highnormalvalue']
     setting = {'itemid':str,'label':str,'category':str}
-    table = pd.read_csv(path, usecols=setting.keys(), 
+    table = pd.read_csv(compression.source_path(path), usecols=setting.keys(), 
                 dtype=setting, index_col=False)
     
     table = table.loc[(table['itemid'].isin(code_set))]
@@ -377,7 +312,7 @@ def _add_icu_info(patients: pd.DataFrame):
     
     print('================================')
     print('Add ICU stay info to patients.csv')
-    icu_stay = pd.read_csv(MIMIC_DIR + 'icu/icustays.csv/icustays.csv', dtype={'subject_id':'str'}, index_col=False)
+    icu_stay = pipeline.read_table(MIMIC, MIMIC_DIR + 'icu/icustays.csv/icustays.csv', dtype={'subject_id':'str'}, index_col=False)
     
     print('icustays.csv shape', icu_stay.shape)
     
@@ -394,6 +329,7 @@ def _add_icu_info(patients: pd.DataFrame):
     return patients
 
 
+@profiling.stage
 def add_dict_category(input_dict_path, output_dict_path):
     '''
     Add the category column for the dictionary. 
@@ -433,6 +369,7 @@ def add_dict_category(input_dict_path, output_dict_path):
     
     # output dictionary
     dictionary.to_csv(output_dict_path, index=False)
+    profiling.count('rows_out', len(dictionary))
     
 
 def _get_category_dict(code_set:set):
@@ -446,7 +383,7 @@ def _get_category_dict(code_set:set):
     path = 'mimic/hosp/d_labitems.csv/d_labitems.csv'
     cols = ['itemid','label','fluid','category','loinc_code']
     setting = {'itemid':str,'loinc_code':str}
-    table = pd.read_csv(path, usecols=setting.keys(), 
+    table = pd.read_csv(compression.source_path(path), usecols=setting.keys(), 
                 dtype='str', index_col=False)
     
     table = table.loc[(table['itemid'].isin(code_set))]
@@ -495,6 +432,16 @@ def main(add_label=True, add_category=True):
    #if args.add_category:
     if add_category:
          add_dict_category(RESULT_ROOT_DIR + 'code_dict.csv', RESULT_ROOT_DIR + 'code_dict_cat.csv')
+
+    # normalized values for training, from the statistics of values in the revised dictionary
+    if NORMALIZE_METHOD is not None:
+        pipeline.normalize_tuples(MIMIC, RESULT_ROOT_DIR + 'code_dict.csv', RESULT_ROOT_DIR + 'tuples.csv',
+                                  RESULT_ROOT_DIR + 'tuples_normalized.csv', NORMALIZE_METHOD, NORMALIZE_CLIP)
+
+    # per-patient sequences as memory-mapped arrays for training
+    if EXPORT_SEQUENCES:
+        sequences.export_sequences(MIMIC, RESULT_ROOT_DIR + 'tuples.csv', RESULT_ROOT_DIR + 'code_dict.csv',
+                                   RESULT_ROOT_DIR + 'patients_dict.csv', RESULT_ROOT_DIR + 'sequences/')
     
 
 if __name__=='__main__':
@@ -0,0 +1,321 @@
+import sys
+import os
+import re
+import json
+import time
+import datetime
+import functools
+import tracemalloc
+import cProfile
+import pandas as pd
+from settings import RUN_REPORT, PROFILE_MEMORY, PROFILE_CPROFILE, RESULT_ROOT_DIR
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+'''
+Stage-level profiling.
+Every stage of the pipeline (a function decorated with @stage) records its wall and CPU time,
+rows read and written, bytes read and written and peak memory into a JSON run report,
+so that the stages dominating a run, and regressions between runs, are visible.
+Rows dropped on the way (unknown codes, missing patients or times, invalid units)
+are counted by table, reason and code into the same report, see count_drops().
+Top allocations (tracemalloc) and a cProfile dump of every stage are opt-in, see settings.py.
+'''
+
+
+report_path = RUN_REPORT    # None to disable the report
+profile_dir = RESULT_ROOT_DIR + 'profile/'
+
+# codes listed per table and reason in the report, the most dropped first
+DROP_TOP_CODES = 100
+
+# stages being run, the innermost last
+_active = []
+
+
+def stage(func):
+    '''
+    Decorator recording every call of a function as a stage of the run report.
+    The stage is named after the function and its string arguments,
+    e.g. "generate_value_table(labevents, hosp, valuenum)".
+    '''
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if report_path is None:
+            return func(*args, **kwargs)
+        with Stage(_stage_name(func, args, kwargs)):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def count(key, n=1):
+    '''
+    Add n to a counter of the running stages (e.g. "rows_in", "rows_out").
+    Outer stages count the rows of the stages they run.
+    '''
+
+    for s in _active:
+        s.counters[key] = s.counters.get(key, 0) + int(n)
+
+
+def running():
+    '''
+    whether a stage is running, i.e. counters are recorded
+    '''
+
+    return len(_active) > 0
+
+
+def count_drops(table, reason, codes):
+    '''
+    Count rows dropped (or degraded, e.g. values replaced by _STRING) in the running stages.
+    Counting is aggregated, so a whole chunk is counted in a single call.
+
+    Parameters:
+    ----
+        table:
+            name of the source table
+        reason:
+            why the rows were dropped, e.g. "not_in_dictionary", "patient_not_found"
+        codes:
+            codes of the dropped rows (array-like), or a dict of codes to numbers of rows
+
+    Returns:
+    ----
+        No return
+    '''
+
+    if not _active or len(codes) == 0:
+        return
+    if not isinstance(codes, dict):
+        codes = pd.Series(codes, dtype=object).value_counts(dropna=False).to_dict()
+
+    for s in _active:
+        counts = s.drops.setdefault(table, {}).setdefault(reason, {})
+        for code, n in codes.items():
+            code = str(code)
+            counts[code] = counts.get(code, 0) + int(n)
+
+
+class Stage:
+    '''
+    A stage being profiled (a context manager), recorded in the run report when it exits.
+
+    Parameters:
+    ----
+        name:
+            name of the stage in the report
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.counters = {'rows_in': 0, 'rows_out': 0}
+        self.drops = {}
+        self.peak_rss = 0
+        self.peak_traced = 0
+        self.profiler = None
+        self.snapshot = None
+
+    def __enter__(self):
+        # peaks are reset for this stage, the running stages keep the peaks reached so far
+        rss = _peak_rss()
+        traced = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+        for s in _active:
+            s.peak_rss = max(s.peak_rss, rss)
+            s.peak_traced = max(s.peak_traced, traced)
+        _reset_peak_rss()
+
+        self.parent = _active[-1].name if _active else None
+        _active.append(self)
+
+        if PROFILE_MEMORY:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.snapshot = tracemalloc.take_snapshot()
+        if PROFILE_CPROFILE and not any(s.profiler is not None for s in _active[:-1]):
+            # only one profiler can run at a time: the outermost stage is profiled
+            self.profiler = cProfile.Profile()
+
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+        self.io = _io_counters()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *args):
+        if self.profiler is not None:
+            self.profiler.disable()
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        io = _io_counters()
+        _active.remove(self)
+
+        entry = {
+            'parent': self.parent,
+            'started': self.started,
+            'status': 'failed' if args[0] is not None else 'ok',
+            'wall_s': round(wall, 3),
+            'cpu_s': round(cpu, 3),
+            'rows_in': self.counters.pop('rows_in'),
+            'rows_out': self.counters.pop('rows_out'),
+            'read_bytes': io[0] - self.io[0] if io is not None and self.io is not None else None,
+            'write_bytes': io[1] - self.io[1] if io is not None and self.io is not None else None,
+            'peak_rss': max(self.peak_rss, _peak_rss()) or None,
+        }
+        if self.counters:
+            entry['counters'] = self.counters
+        entry['rows_dropped'] = 0
+        if self.drops:
+            entry['drops'] = _drop_report(self.drops)
+            entry['rows_dropped'] = sum(r['rows'] for d in entry['drops'].values() for r in d.values())
+
+        if self.snapshot is not None:
+            traced = tracemalloc.get_traced_memory()[1]
+            entry['peak_traced'] = max(self.peak_traced, traced)
+            entry['top_allocations'] = _top_allocations(self.snapshot, tracemalloc.take_snapshot())
+            for s in _active:
+                s.peak_traced = max(s.peak_traced, traced)
+            self.snapshot = None
+            if not _active:
+                tracemalloc.stop()
+
+        if self.profiler is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+            path = profile_dir + re.sub(r'[^\w.-]+', '_', self.name).strip('_') + '.prof'
+            self.profiler.dump_stats(path)
+            entry['profile'] = path
+
+        print('[stage] {}: {:.1f}s wall, {:.1f}s cpu, {} rows in, {} rows out, {} rows dropped'.format(
+              self.name, wall, cpu, entry['rows_in'], entry['rows_out'], entry['rows_dropped']))
+        save_stage(self.name, entry)
+
+
+def save_stage(name, entry):
+    '''
+    Record a stage in the run report (report_path).
+    The report keeps the last run of every stage, with the times and peak memory of the run before it.
+    '''
+
+    if report_path is None:
+        return
+
+    report = load_report()
+    old = report['stages'].pop(name, None)
+    if old is not None:
+        entry['previous'] = {k: old.get(k) for k in ['started', 'wall_s', 'cpu_s', 'peak_rss']}
+    report['stages'][name] = entry
+    report['updated'] = datetime.datetime.now().isoformat(timespec='seconds')
+
+    directory = os.path.dirname(report_path)
+    if directory != '':
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = report_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, report_path)
+
+
+def load_report(path=None):
+    '''
+    load the run report ({"stages": {name: entry}}), empty if it does not exist yet
+    '''
+
+    path = report_path if path is None else path
+    if path is None or not os.path.exists(path):
+        return {'stages': {}}
+    with open(path, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def _drop_report(drops):
+    '''
+    drop counters of a stage as reported: {table: {reason: {"rows", "codes", "other_codes"}}}
+    '''
+
+    report = {}
+    for table, reasons in drops.items():
+        for reason, counts in reasons.items():
+            codes = sorted(counts.items(), key=lambda x: -x[1])
+            r = {'rows': sum(counts.values()), 'codes': dict(codes[:DROP_TOP_CODES])}
+            if len(codes) > DROP_TOP_CODES:
+                r['other_codes'] = len(codes) - DROP_TOP_CODES
+            report.setdefault(table, {})[reason] = r
+    return report
+
+
+def _stage_name(func, args, kwargs):
+    '''
+    name of a stage: the function and its arguments which are strings (or the name of an adapter)
+    '''
+
+    names = []
+    for a in list(args) + list(kwargs.values()):
+        if isinstance(a, str):
+            names.append(a)
+        elif hasattr(a, 'tables') and hasattr(a, 'name'):
+            names.append(a.name)
+    return '{}({})'.format(func.__name__, ', '.join(names))
+
+
+def _io_counters():
+    '''
+    (bytes read, bytes written) by the process so far, None where not available
+    '''
+
+    try:
+        with open('/proc/self/io', 'r') as f:
+            io = dict(l.split(':') for l in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _peak_rss():
+    '''
+    peak resident memory (bytes) since the last reset, or of the whole process where it cannot be reset
+    '''
+
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for l in f:
+                if l.startswith('VmHWM:'):
+                    return int(l.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _reset_peak_rss():
+    '''
+    reset the peak resident memory of the process (Linux only)
+    '''
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _top_allocations(before, after, limit=10):
+    '''
+    lines which allocated the most memory still held between two tracemalloc snapshots
+    '''
+
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    stats = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'lineno')
+    return [{'line': '{}:{}'.format(s.traceback[0].filename, s.traceback[0].lineno),
+             'size_diff': s.size_diff, 'count_diff': s.count_diff}
+            for s in stats[:limit]]
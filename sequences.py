@@ -0,0 +1,308 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import pipeline
+import profiling
+import compression
+
+
+'''
+Training-ready export of the merged tuples.
+The tuples of every patient are stored as consecutive events of large memory-mapped NumPy arrays
+(one .npy file per field, the events of patient i are events[offsets[i]:offsets[i+1]]),
+with the attributes of patients_dict.csv in an array parallel to the patients,
+so that a model reads its batches without parsing any text (see SequenceDataset).
+'''
+
+
+# rows of tuples.csv per chunk when exporting sequences
+SEQUENCE_CHUNKSIZE = 5000000
+
+# types of values: a number, a placeholder of the tuples, another text, or no value
+VALUE_TYPES = ['none', 'numeric', '_MISSING', '_STRING', '_EMPTY', 'text']
+
+# arrays of events: (file name, dtype, padding value)
+EVENT_FIELDS = [('codes', np.int32, -1), ('deltas', np.int64, 0),
+                ('values', np.float32, np.nan), ('value_types', np.int8, 0)]
+
+
+@profiling.stage
+def export_sequences(adapter, tuple_path, dict_path, patient_path, out_dir):
+    '''
+    Export the merged tuples as per-patient sequences of memory-mapped arrays:
+
+        codes.npy        int32, index of the code in the dictionary (-1 if not in it)
+        deltas.npy       int64, time since the previous event of the patient
+                         (seconds for timestamps, the unit of offsets otherwise; 0 for the first event,
+                         -1 for events without time)
+        values.npy       float32, numeric value (NaN if the value is not a number)
+        value_types.npy  int8, index of the type of value in VALUE_TYPES
+        offsets.npy      int64, events of patient i are [offsets[i], offsets[i+1])
+        patient_ids.npy  the ID of every patient
+        patients.npy     structured array of the attributes in patients_dict.csv, parallel to patient_ids
+        meta.json        description of the arrays
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the tuples
+        tuple_path:
+            filepath of the merged tuples.csv
+        dict_path:
+            filepath of the dictionary (code_dict.csv)
+        patient_path:
+            filepath of patients_dict.csv
+        out_dir:
+            directory to output the arrays
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('\nExporting sequences of {} into {}'.format(tuple_path, out_dir))
+    os.makedirs(out_dir, exist_ok=True)
+
+    # index of every code in the dictionary
+    dic = pd.read_csv(dict_path, dtype=str, index_col=False)
+    ids = adapter.code_ids(dic)
+    first = ~ids.duplicated().values
+    code_index = pd.Series(dic['index'].astype(np.int32).values[first], index=ids.values[first])
+
+    # the arrays are allocated once the number of events is known
+    n_events = _count_lines(tuple_path) - 1
+    events = {name: np.lib.format.open_memmap(out_dir + name + '.npy', mode='w+', dtype=dtype, shape=(n_events,))
+              for name, dtype, _ in EVENT_FIELDS}
+
+    patient_ids = []
+    starts = []
+    last_pid = None
+    last_time = None
+    pos = 0
+
+    with compression.open_file(tuple_path) as f, pd.read_csv(f, dtype=str, keep_default_na=False, index_col=False,
+                                                             chunksize=SEQUENCE_CHUNKSIZE) as reader:
+        for chunk in reader:
+            n = len(chunk)
+            profiling.count('rows_in', n)
+            pids = chunk['patient_id'].values
+
+            # first event of every patient (patients are contiguous in the merged tuples)
+            new = np.empty(n, dtype=bool)
+            new[0] = pids[0] != last_pid
+            new[1:] = pids[1:] != pids[:-1]
+            starts.append(np.flatnonzero(new) + pos)
+            patient_ids.extend(pids[new])
+
+            # time since the previous event of the patient
+            if adapter.time_kind == 'offset':
+                time = pd.to_numeric(chunk['time'], errors='coerce').fillna(pipeline.TIME_NA).values.astype(np.int64)
+            else:
+                time = pipeline.parse_time(chunk['time'])
+            prev = np.empty(n, dtype=np.int64)
+            prev[0] = last_time if last_time is not None else 0
+            prev[1:] = time[:-1]
+            delta = time - prev
+            delta[new] = 0
+            delta[(time == pipeline.TIME_NA) | ((prev == pipeline.TIME_NA) & ~new)] = -1
+            events['deltas'][pos:pos+n] = delta
+
+            events['codes'][pos:pos+n] = code_index.reindex(chunk['code'].values).fillna(-1).values
+
+            # values and their types
+            value = chunk['value']
+            number = value.str.replace('/', '.', regex=False) if adapter.comma_decimal else value
+            number = pd.to_numeric(number, errors='coerce').values
+            numeric = np.isfinite(number)
+            types = np.full(n, VALUE_TYPES.index('text'), dtype=np.int8)
+            types[(value == '').values | (value == 'NaN').values] = VALUE_TYPES.index('none')
+            for t in ['_MISSING', '_STRING', '_EMPTY']:
+                types[(value == t).values] = VALUE_TYPES.index(t)
+            types[numeric] = VALUE_TYPES.index('numeric')
+            events['values'][pos:pos+n] = np.where(numeric, number, np.nan)
+            events['value_types'][pos:pos+n] = types
+
+            last_pid = pids[-1]
+            last_time = time[-1]
+            pos += n
+
+    for a in events.values():
+        a.flush()
+    del events
+
+    offsets = np.append(np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64), pos).astype(np.int64)
+    np.save(out_dir + 'offsets.npy', offsets)
+    np.save(out_dir + 'patient_ids.npy', np.array(patient_ids, dtype=str))
+
+    # attributes of patients, parallel to patient_ids
+    patients = pd.read_csv(patient_path, dtype=str, keep_default_na=False, index_col=False)
+    patients = patients.drop_duplicates(patients.columns[0]).set_index(patients.columns[0])
+    patients = patients.reindex(patient_ids).fillna('')
+    attributes = _to_records(patients)
+    np.save(out_dir + 'patients.npy', attributes)
+
+    meta = {
+        'n_patients': len(patient_ids),
+        'n_events': int(pos),
+        'time_unit': 'offset' if adapter.time_kind == 'offset' else 'second',
+        'value_types': VALUE_TYPES,
+        'fields': [name for name, _, _ in EVENT_FIELDS],
+        'patient_attributes': list(attributes.dtype.names),
+        'code_dict': dict_path,
+    }
+    with open(out_dir + 'meta.json', 'w', encoding='utf8') as f:
+        json.dump(meta, f, indent=2)
+    profiling.count('rows_out', pos)
+    print('Exported {} events of {} patients'.format(pos, len(patient_ids)))
+
+
+def _count_lines(path):
+    '''
+    number of lines of a (possibly compressed) file, counted on blocks of bytes
+    '''
+
+    n = 0
+    with compression.open_file(path, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            n += block.count(b'\n')
+    return n
+
+
+def _to_records(table):
+    '''
+    a table as a structured array: numeric columns as float64 (NaN if missing), the others as strings
+    '''
+
+    columns = []
+    for col in table.columns:
+        values = table[col]
+        number = pd.to_numeric(values.replace('', np.nan), errors='coerce')
+        if number.notna().sum() == (values != '').sum():
+            columns.append((col, number.to_numpy(dtype=np.float64)))
+        else:
+            # to_numpy: .values of a string column of pandas is an extension array, not a NumPy array
+            columns.append((col, values.to_numpy(dtype=str)))
+    dtype = [(col, v.dtype) for col, v in columns]
+    records = np.empty(len(table), dtype=dtype)
+    for col, v in columns:
+        records[col] = v
+    return records
+
+
+class SequenceDataset:
+    '''
+    Sequences exported by export_sequences(), memory-mapped.
+
+    Parameters:
+    ----
+        path:
+            directory of the exported arrays
+
+    Attributes:
+    ----
+        codes, deltas, values, value_types:
+            arrays of all events
+        offsets:
+            events of patient i are [offsets[i], offsets[i+1])
+        lengths:
+            number of events of every patient
+        patient_ids, patients:
+            ID and attributes (structured array) of every patient
+    '''
+
+    def __init__(self, path):
+        for name, _, _ in EVENT_FIELDS:
+            setattr(self, name, np.load(path + name + '.npy', mmap_mode='r'))
+        self.offsets = np.load(path + 'offsets.npy')
+        self.lengths = np.diff(self.offsets)
+        self.patient_ids = np.load(path + 'patient_ids.npy')
+        self.patients = np.load(path + 'patients.npy')
+        with open(path + 'meta.json', 'r', encoding='utf8') as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        '''
+        events of the i-th patient
+        '''
+
+        start, end = self.offsets[i], self.offsets[i+1]
+        return {name: getattr(self, name)[start:end] for name, _, _ in EVENT_FIELDS}
+
+    def batches(self, batch_size, max_len=None, bucket_size=100, shuffle=True, seed=None, patients=None):
+        '''
+        Yield padded batches of patients of similar lengths.
+        Patients are shuffled, grouped by bucket_size batches and sorted by length within a group,
+        so batches are padded little while their order stays random.
+        Every batch is gathered with array indexing only.
+
+        Parameters:
+        ----
+            batch_size:
+                number of patients per batch
+            max_len:
+                keep at most the last max_len events of a patient (None to keep all);
+                the first event kept becomes the first event of the patient (its delta is 0)
+            bucket_size:
+                number of batches sorted by length together
+            shuffle:
+                whether to shuffle the patients and the batches
+            seed:
+                seed of the shuffling
+            patients:
+                indexes of the patients to iterate (all by default)
+
+        Returns:
+        ----
+            generator of dicts with, for every field, an array (batch, length) padded after the events,
+            "mask" (True for events), "lengths" and "patients" (indexes of the patients)
+        '''
+
+        rng = np.random.default_rng(seed)
+        index = np.arange(len(self)) if patients is None else np.asarray(patients)
+        if shuffle:
+            index = rng.permutation(index)
+
+        batches = []
+        group = batch_size * bucket_size
+        for g in range(0, len(index), group):
+            part = index[g:g+group]
+            part = part[np.argsort(self.lengths[part], kind='mergesort')]
+            batches.extend(part[b:b+batch_size] for b in range(0, len(part), batch_size))
+        if shuffle:
+            batches = [batches[b] for b in rng.permutation(len(batches))]
+
+        for batch in batches:
+            yield self._pad(batch, max_len)
+
+    def _pad(self, batch, max_len):
+        '''
+        gather the events of a batch of patients into padded arrays
+        '''
+
+        lengths = self.lengths[batch]
+        truncated = np.zeros(len(batch), dtype=bool)
+        if max_len is not None:
+            truncated = lengths > max_len
+            lengths = np.minimum(lengths, max_len)
+        starts = self.offsets[batch + 1] - lengths
+        width = int(lengths.max()) if len(batch) > 0 else 0
+
+        mask = np.arange(width)[None, :] < lengths[:, None]
+        positions = (starts[:, None] + np.arange(width)[None, :])[mask]
+
+        out = {'mask': mask, 'lengths': lengths, 'patients': batch}
+        for name, dtype, pad in EVENT_FIELDS:
+            padded = np.full(mask.shape, pad, dtype=dtype)
+            padded[mask] = getattr(self, name)[positions]
+            out[name] = padded
+
+        # the delta of the first event kept was measured from an event cut off
+        # (deltas of events without time stay -1)
+        if width > 0:
+            first = out['deltas'][:, 0]
+            first[truncated & (first != -1)] = 0
+        return out
@@ -2,7 +2,8 @@
 Settings of cleaning
 '''
 
-MIMIC_DIR = 'mimic/'    # original files of MIMIC-IV v1.0
+MIMIC_DIR = 'mimic/'    # original files of MIMIC-IV v1.0 (extracted, or the .csv.gz files as distributed)
+EICU_DIR = 'eicu/'    # original files of eICU (.csv or .csv.gz)
 ROLL_UP_SRC = 'rollup_tables/'   # files of roll-up tables
 #UOM_SRC  = 'records/tools/'   # files of roll-up tables
 UOM_SRC = "uom_dependency/"
@@ -12,3 +13,76 @@ RESULT_ROOT_DIR = 'records/'    # the directory to output the result
 TUPLE_DIR = RESULT_ROOT_DIR + 'tuple/'
 STRING_TUPLE_DIR = RESULT_ROOT_DIR + 'string_tuple/'
 IDX_DIR = RESULT_ROOT_DIR + 'index/'
+
+# sharded execution: patients are hashed into N_SHARDS shards processed by N_WORKERS processes
+N_SHARDS = 1    # 1 to disable sharding
+N_WORKERS = None    # None to use min(N_SHARDS, cpu_count)
+
+# development mode: every stage only reads the rows of a deterministic sample of patients
+SAMPLE_RATE = None    # e.g. 0.01 to keep 1% of patients (by a hash of the ID), None to keep all
+SAMPLE_IDS = None    # list of patients' ID or filepath of a file with an ID per line, None to keep all
+
+# memory budget (bytes) of a chunk of a source table being processed:
+# chunk sizes are picked from the dtypes and adapted to the rows read, e.g. 4 * 1024**3
+# (stages writing tuples keep chunks of at least pipeline.TUPLE_MIN_CHUNKSIZE rows: every chunk is a .tri file
+# listing all patients, all open at once when merged)
+MEMORY_BUDGET = None    # None to use the fixed chunk sizes of each stage
+
+# checkpoints of chunked stages: every chunk done is recorded in a journal next to the outputs (see checkpoint.py),
+# a stage run again after a failure resumes from its first incomplete chunk
+CHECKPOINT = True
+
+# compression of the tuple files: .tri files, tuples.csv, string_tuples.csv and the tuples derived from them
+# (see compression.py), file names are kept and readers detect the codec, code dictionaries stay plain csv
+COMPRESSION = None    # 'gzip', 'bz2', 'lzma', or 'zstd' / 'lz4' if installed, None to write plain text
+COMPRESSION_LEVEL = None    # level of the codec, None for its default
+COMPRESSION_THREADS = None    # threads compressing blocks in parallel, None for the number of CPUs
+
+# run report: wall/CPU time, rows, bytes read/written and peak memory of every stage (see profiling.py)
+RUN_REPORT = RESULT_ROOT_DIR + 'run_report.json'    # None to disable
+PROFILE_MEMORY = False    # True to record the top allocations of every stage with tracemalloc (slow)
+PROFILE_CPROFILE = False    # True to dump a cProfile of every stage into RESULT_ROOT_DIR/profile/
+
+# normalized export of tuples.csv (after revising the dictionary, from the statistics of values in it)
+NORMALIZE_METHOD = None    # 'zscore', 'minmax' or 'quantile' (bin index) to write tuples_normalized.csv, None to skip
+NORMALIZE_CLIP = ('value_p01', 'value_p99')    # columns of code_dict.csv bounding values (e.g. configured bounds), None not to clip
+
+# training-ready export of tuples.csv: per-patient sequences of memory-mapped arrays in RESULT_ROOT_DIR/sequences/
+EXPORT_SEQUENCES = False
+
+# output shards of tuples.csv balanced by number of events, for distributed training (RESULT_ROOT_DIR/output_shards/)
+OUTPUT_SHARDS = None    # number of shards, None not to split
+
+# time-bucketed aggregation of numeric tuples when merging tuples.csv, per source table: {table: (window, function)},
+# window as a pandas Timedelta (e.g. '1h'), function 'last', 'mean', 'min' or 'max' of the values in a bucket.
+# Codes override the rule of their table with the columns aggregate_window and aggregate_function
+# of IDX_DIR/code_dict.csv where they are filled ('none' as window not to aggregate a code).
+# Tuples are only aggregated when merged (also in sharded and delta runs, see pipeline.merge_tuples):
+# the .tri files of tables keep every tuple, so that a bucket spanning chunks of a table is aggregated whole
+AGGREGATE_TABLES = {}    # e.g. {'chartevents': ('1h', 'mean')}, empty not to aggregate
+
+# deduplication of tuples when merging tuples.csv
+DEDUP_EXACT = False    # True to drop tuples identical to another tuple of the patient (admission, time, code and value)
+# near-duplicates: {ID of a code: ID of the code it copies}, e.g. chartevents "Labs" items and their labevents items,
+# a tuple of the first code is dropped when the patient has a tuple of the second one
+# with the same value within DEDUP_TOLERANCE (a pandas Timedelta)
+DEDUP_EQUIVALENT_CODES = {}    # e.g. {'mimic_220645': 'mimic_50983'}
+DEDUP_TOLERANCE = '1h'
+
+# stable indices of code_dict.csv: codes keep their index across runs in the append-only IDX_DIR/code_registry.csv,
+# new codes get new indices and missing ones are retired, so adding a table only needs the tuples of that table
+STABLE_INDEX = False
+
+# vocabulary pruning of code_dict.csv before generating tuples, thresholds per code_type ('*' for the other types):
+# 'min_frequency', 'min_patients' and 'top_k' (most frequent codes per source_table), see pipeline.prune_dict
+PRUNE_RULES = {}    # e.g. {'*': {'min_frequency': 100}, 'mimic': {'min_patients': 20, 'top_k': 1000}}, empty not to prune
+
+# interned strings: values of string_tuples.csv replaced by the IDs of IDX_DIR/string_dict.csv (see strings.py)
+INTERN_STRINGS = False
+STRING_TOP_K = None    # K to also write string_categorical_tuples.csv, the K most frequent strings of every code as codes
+
+# delta mode: regenerate the tuples of new or changed patients only and splice them into tuples.csv,
+# string_tuples.csv, patients_dict.csv and the frequencies of the revised code_dict.csv (see delta.py)
+DELTA_PATIENTS = None    # list of patients' ID or filepath of a file with an ID per line, None for no delta run
+# pairs of (previous, new) versions of source tables, the patients whose rows differ are updated too
+DELTA_DIFF = []    # e.g. [(MIMIC_DIR + 'hosp/labevents_old.csv', MIMIC_DIR + 'hosp/labevents.csv')]
@@ -0,0 +1,337 @@
+import sys
+import os
+import json
+import shutil
+import heapq
+import multiprocessing
+import numpy as np
+import pandas as pd
+import pipeline
+import profiling
+import compression
+from dataset import ADAPTERS, patient_shard
+
+
+'''
+Patient-hash sharded execution.
+Patients are hashed into N shards up front (see dataset.patient_shard).
+Every worker generates the tuples of all tables for the patients of its shard
+and merges them into a time-sorted shard, so no global merge is needed:
+the shards are listed in a manifest and optionally concatenated into tuples.csv.
+A worker reading a whole source table parses the rows of every other shard only to drop them,
+so N shards parse every table N times. The source tables given to run_sharded() are therefore
+partitioned by shard first, in a single pass over each table (see partition_sources),
+and every worker parses only the rows of its own shard.
+The merged tuples can also be split into output shards balanced by number of events
+(see split_balanced), for data loaders of distributed training.
+'''
+
+
+TUPLE_COLS = ['patient_id', 'admission_id', 'time', 'code', 'value']
+
+# rows of tuples.csv per chunk when splitting it into output shards
+SPLIT_CHUNKSIZE = 5000000
+
+# rows of a source table per chunk when partitioning it by shard (all columns are read as text)
+PARTITION_CHUNKSIZE = 1000000
+
+
+@profiling.stage
+def run_sharded(adapter, jobs, n_shards, n_workers=None, concat=True, sources=None):
+    '''
+    Generate and merge the tuples of every shard in parallel.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset to process
+        jobs:
+            list of (function, args) generating the tuples of a table,
+            e.g. [(generate_value_table, ('labevents', 'hosp', 'valuenum'))].
+            The functions must write tuples through the module-level adapter
+            (dataset.MIMIC / dataset.EICU), which is restricted to the shard.
+        n_shards:
+            number of shards
+        n_workers:
+            number of worker processes (min(n_shards, cpu_count) by default)
+        concat:
+            whether to concatenate the shards into tuples.csv and string_tuples.csv
+        sources:
+            filepaths of the source tables read by the jobs, partitioned by shard before the jobs run
+            so that each row is parsed once rather than by every worker (see partition_sources).
+            Tables not listed are read whole by every worker.
+
+    Returns:
+    ----
+        the manifest of shards
+    '''
+
+    print('\nGenerating tuples in {} shards'.format(n_shards))
+
+    if n_workers is None:
+        n_workers = min(n_shards, multiprocessing.cpu_count())
+
+    with multiprocessing.Pool(n_workers) as pool:
+        parts = partition_sources(adapter, sources or [], n_shards, pool)
+
+    # a new process for every shard, so that the adapter is restricted to a single shard
+    tasks = [(adapter.name, jobs, k, n_shards, parts[k]) for k in range(n_shards)]
+    with multiprocessing.Pool(n_workers, maxtasksperchild=1) as pool:
+        shards = pool.starmap(_run_shard, tasks, chunksize=1)
+
+    manifest = {'n_shards': n_shards, 'columns': TUPLE_COLS, 'shards': shards}
+    with open(adapter.result_dir + 'tuples_manifest.json', 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=2)
+
+    if concat:
+        concat_shards(manifest, 'tuples', adapter.result_dir + 'tuples.csv')
+        concat_shards(manifest, 'string_tuples', adapter.result_dir + 'string_tuples.csv')
+
+    return manifest
+
+
+def _run_shard(name, jobs, shard, n_shards, sources):
+    '''
+    Generate and merge the tuples of a shard (run in a worker process)
+    '''
+
+    adapter = ADAPTERS[name]
+    adapter.set_shard(shard, n_shards, sources)
+
+    # every worker writes the run report of its shard
+    if profiling.report_path is not None:
+        profiling.report_path = adapter.shard_dir + 'run_report.json'
+        profiling.profile_dir = adapter.shard_dir + 'profile/'
+
+    for func, args in jobs:
+        func(*args)
+    for path in sources.values():
+        os.remove(path)
+
+    info = {'shard': shard, 'patients': len(adapter.load_patients()), 'string_tuple_dir': adapter.string_tuple_dir}
+    if profiling.report_path is not None:
+        info['run_report'] = profiling.report_path
+    for key, src_dir in [('tuples', adapter.tuple_dir), ('string_tuples', adapter.string_tuple_dir)]:
+        out_path = adapter.shard_dir + key + '.csv'
+        pipeline.merge_tuples(adapter, src_dir, TUPLE_COLS, out_path, aggregate=(key == 'tuples'),
+                               dedup=(key == 'tuples'))
+        if os.path.exists(out_path):
+            info[key] = out_path
+
+    return info
+
+
+def partition_sources(adapter, paths, n_shards, pool=None):
+    '''
+    Split source tables into the rows of every shard, in a single pass over each table
+    (tables are partitioned in parallel by the pool if given).
+    Rows are parsed as text and written back unchanged, so a worker reads its part as it would the table;
+    parts are written under result_dir/shards/<shard>/source/ (compressed as the tuple files).
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the tables
+        paths:
+            filepaths of the source tables (see compression.source_path)
+        n_shards:
+            number of shards
+        pool:
+            multiprocessing.Pool to partition the tables with, None to partition them in this process
+
+    Returns:
+    ----
+        list of dicts, for every shard, of the filepaths of the tables to the filepaths of their parts
+    '''
+
+    tasks = []
+    for path in paths:
+        path = compression.source_path(path)
+        if not os.path.isfile(path):
+            print('{} not found, not partitioned'.format(path))
+            continue
+        name = os.path.basename(path).split('.')[0]
+        if any(name == t[2] for t in tasks):
+            raise ValueError('two source tables named {} cannot be partitioned'.format(name))
+        tasks.append((adapter.name, path, name, n_shards))
+    if len(tasks) == 0:
+        return [{} for _ in range(n_shards)]
+
+    print('Partitioning {} source tables into {} shards'.format(len(tasks), n_shards))
+    if pool is None:
+        outs = [_partition_source(*t) for t in tasks]
+    else:
+        outs = pool.starmap(_partition_source, tasks, chunksize=1)
+    return [{t[1]: out[k] for t, out in zip(tasks, outs)} for k in range(n_shards)]
+
+
+def _partition_source(name, path, table, n_shards):
+    '''
+    Partition a source table by shard (run in a worker process)
+    '''
+
+    adapter = ADAPTERS[name]
+    out_paths = []
+    for k in range(n_shards):
+        out_dir = adapter.result_dir + 'shards/{}/source/'.format(k)
+        os.makedirs(out_dir, exist_ok=True)
+        out_paths.append(out_dir + table + '.csv')
+
+    files = [compression.open_file(p, 'w', newline='') for p in out_paths]
+    try:
+        with compression.open_file(path, 'rb') as f:
+            header = pd.read_csv(f, nrows=0, dtype=str)
+        for out in files:
+            header.to_csv(out, index=False)
+
+        stream = compression.open_source(path)
+        try:
+            with pd.read_csv(path if stream is None else stream, dtype=str, na_filter=False, index_col=False,
+                             chunksize=PARTITION_CHUNKSIZE) as reader:
+                for chunk in reader:
+                    shard = patient_shard(chunk[adapter.patient_key], n_shards)
+                    for k in np.unique(shard):
+                        chunk.loc[shard == k].to_csv(files[k], header=False, index=False)
+        finally:
+            if stream is not None:
+                stream.close()
+    finally:
+        for out in files:
+            out.close()
+    return out_paths
+
+
+def concat_shards(manifest, key, out_path):
+    '''
+    Concatenate the merged shards into a single file (the header is written once)
+
+    Parameters:
+    ----
+        manifest:
+            the manifest returned by run_sharded()
+        key:
+            'tuples' or 'string_tuples'
+        out_path:
+            filepath of the output file
+
+    Returns:
+    ----
+        No return
+    '''
+
+    paths = [s[key] for s in manifest['shards'] if key in s]
+    if len(paths) == 0:
+        return
+
+    print('Concatenating {} shards into {}'.format(len(paths), out_path))
+    with compression.open_file(out_path, 'wb') as out:
+        out.write((','.join(manifest['columns']) + '\n').encode('utf8'))
+        for path in paths:
+            with compression.open_file(path, 'rb') as f:
+                f.readline()
+                shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+
+
+@profiling.stage
+def split_balanced(tuple_path, n_shards, out_dir):
+    '''
+    Split merged tuples into shards balanced by number of events (not of patients),
+    so that workers reading a shard each have the same throughput.
+    Patients are assigned whole, largest first, to the shard with the fewest events so far;
+    every shard keeps the order of patients of the merged file.
+
+    Written into out_dir:
+        tuples_<k>.csv          tuples of shard k (with the header)
+        tuples_<k>.index.csv    patient_id, offset (byte of the first tuple) and events of every patient
+        manifest.json           shards with their files, numbers of patients, events and bytes
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of the merged tuples.csv
+        n_shards:
+            number of shards
+        out_dir:
+            directory to output the shards
+
+    Returns:
+    ----
+        the manifest of shards (see also concat_shards())
+    '''
+
+    print('\nSplitting {} into {} shards balanced by events'.format(tuple_path, n_shards))
+    os.makedirs(out_dir, exist_ok=True)
+
+    # events of every patient
+    events = pd.Series(dtype='int64')
+    with compression.open_file(tuple_path) as f, pd.read_csv(f, usecols=[0], dtype=str, keep_default_na=False,
+                                                             index_col=False, chunksize=SPLIT_CHUNKSIZE) as reader:
+        for chunk in reader:
+            events = events.add(chunk.iloc[:, 0].value_counts(sort=False), fill_value=0)
+
+    # largest patients first, each to the least loaded shard
+    heap = [(0, k) for k in range(n_shards)]
+    assign = {}
+    for pid, n in events.sort_values(ascending=False, kind='mergesort').items():
+        load, k = heapq.heappop(heap)
+        assign[pid] = k
+        heapq.heappush(heap, (load + int(n), k))
+
+    shards = [{'shard': k, 'tuples': out_dir + 'tuples_{}.csv'.format(k),
+               'index': out_dir + 'tuples_{}.index.csv'.format(k)} for k in range(n_shards)]
+    header = ','.join(TUPLE_COLS) + '\n'
+    files = [open(s['tuples'], 'w', encoding='utf8', newline='') for s in shards]
+    indexes = [open(s['index'], 'w', encoding='utf8', newline='') for s in shards]
+    offsets = [len(header.encode('utf8'))] * n_shards
+    for f, idx in zip(files, indexes):
+        f.write(header)
+        idx.write('patient_id,offset,events\n')
+
+    with compression.open_file(tuple_path) as f, pd.read_csv(f, dtype=str, keep_default_na=False, index_col=False,
+                                                             chunksize=SPLIT_CHUNKSIZE) as reader:
+        for chunk in reader:
+            profiling.count('rows_in', len(chunk))
+            pids = chunk.iloc[:, 0]
+            shard = pids.map(assign).values
+            lines = pids + ',' + chunk.iloc[:, 1] + ',' + chunk.iloc[:, 2] + ',' + chunk.iloc[:, 3] + ',' + \
+                    chunk.iloc[:, 4] + '\n'
+            size = lines.str.encode('utf8').str.len().values
+
+            for k in np.unique(shard):
+                rows = shard == k
+                part = lines.values[rows]
+                part_pids = pids.values[rows]
+                part_size = size[rows]
+
+                # a patient split between chunks is listed in the index of both chunks, merged below
+                first = np.empty(len(part), dtype=bool)
+                first[0] = True
+                first[1:] = part_pids[1:] != part_pids[:-1]
+                starts = np.flatnonzero(first)
+                offset = offsets[k] + np.concatenate(([0], np.cumsum(part_size)[:-1]))
+                n_events = np.diff(np.append(starts, len(part)))
+                index = pd.DataFrame({'patient_id': part_pids[starts], 'offset': offset[starts], 'events': n_events})
+                index.to_csv(indexes[k], header=False, index=False)
+
+                files[k].write(''.join(part))
+                offsets[k] += int(part_size.sum())
+                profiling.count('rows_out', len(part))
+
+    for f in files + indexes:
+        f.close()
+
+    # merge the entries of patients split between chunks
+    for s in shards:
+        index = pd.read_csv(s['index'], dtype={'patient_id': str}, keep_default_na=False)
+        index = index.groupby('patient_id', sort=False).agg({'offset': 'min', 'events': 'sum'}).reset_index()
+        index.to_csv(s['index'], index=False)
+        s['patients'] = len(index)
+        s['events'] = int(index['events'].sum())
+        s['bytes'] = os.path.getsize(s['tuples'])
+
+    manifest = {'n_shards': n_shards, 'columns': TUPLE_COLS, 'source': tuple_path, 'shards': shards}
+    with open(out_dir + 'manifest.json', 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=2)
+
+    print('Events per shard:', [s['events'] for s in shards])
+    return manifest
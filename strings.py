@@ -0,0 +1,182 @@
+import os
+import csv
+import json
+import collections
+import numpy as np
+import pandas as pd
+import profiling
+import checkpoint
+import compression
+
+
+'''
+Interned strings of the string tuples.
+Tuple generation counts every _STRING payload (free-text values, "value#unit" mismatches) per code
+into a store next to the string .tri files (see save_store), instead of keeping them only verbatim.
+The stores of all tables (and shards) are merged into a global string table with an ID per string,
+ordered by frequency, then string_tuples.csv refers to strings by their IDs, and the most frequent
+strings of every code can be written as categorical codes for models to consume directly.
+'''
+
+
+# rows of string_tuples.csv per chunk when encoding it
+STRING_CHUNKSIZE = 5000000
+
+# code of the strings of a code outside its top-K, in the categorical tuples
+OTHER_SUFFIX = '_s_other'
+
+
+def save_store(counts, path):
+    '''
+    Save the numbers of occurrences of strings per code counted while generating tuples
+
+    Parameters:
+    ----
+        counts:
+            dict of (code, string) to number of occurrences
+        path:
+            filepath of the store (.json)
+
+    Returns:
+    ----
+        No return
+    '''
+
+    # strings as merged into string_tuples.csv: commas escaped (see pipeline.patients2tuples)
+    # and trailing spaces stripped with the line
+    merged = collections.Counter()
+    for (code, string), n in counts.items():
+        merged[str(code), string.replace(',', '/').rstrip()] += n
+    with checkpoint.atomic_open(path, 'w', encoding='utf8') as f:
+        json.dump([[code, string, n] for (code, string), n in merged.items()], f)
+
+
+def load_stores(store_dirs):
+    '''
+    load and add up the stores (*_strings.json) of directories, as a DataFrame (code, string, frequency)
+    '''
+
+    frames = []
+    for d in store_dirs:
+        for name in sorted(os.listdir(d)):
+            if name.endswith('_strings.json'):
+                with open(d + name, 'r', encoding='utf8') as f:
+                    frames.append(pd.DataFrame(json.load(f), columns=['code', 'string', 'frequency']))
+    if len(frames) == 0:
+        return pd.DataFrame({'code': [], 'string': [], 'frequency': []})
+    table = pd.concat(frames, ignore_index=True)
+    return table.groupby(['code', 'string'], as_index=False)['frequency'].sum()
+
+
+@profiling.stage
+def build_string_table(store_dirs, out_dir, top_k=None):
+    '''
+    Merge the stores of strings into the global string table.
+    IDs are given by descending frequency (then by string), so they do not depend on
+    how tables were chunked or patients sharded.
+
+    Written into out_dir:
+        string_dict.csv       string_id, string, frequency and number of codes of every string
+        string_code_freq.csv  code, string_id, frequency, with the categorical code of the top-K strings of a code
+
+    Parameters:
+    ----
+        store_dirs:
+            directories of the stores (the string tuple directories of the run or of its shards)
+        out_dir:
+            directory to output the tables
+        top_k:
+            number of the most frequent strings of every code given a categorical code, None for none
+
+    Returns:
+    ----
+        (strings, categories): pandas.Series of strings to IDs,
+        and pandas.Series of (code, string_id) to categorical codes (empty if top_k is None)
+    '''
+
+    print('\nBuilding the string table')
+    counts = load_stores(store_dirs)
+    profiling.count('rows_in', len(counts))
+
+    total = counts.groupby('string')['frequency'].agg(['sum', 'size'])
+    total = total.reset_index().sort_values(['sum', 'string'], ascending=[False, True], kind='mergesort')
+    strings = pd.Series(np.arange(len(total)), index=total['string'].values)
+    string_dict = pd.DataFrame({'string_id': strings.values, 'string': total['string'].values,
+                                'frequency': total['sum'].values, 'codes': total['size'].values})
+    string_dict.to_csv(out_dir + 'string_dict.csv', index=False)
+
+    freq = pd.DataFrame({'code': counts['code'], 'string_id': strings.reindex(counts['string']).values,
+                         'frequency': counts['frequency']})
+    freq = freq.sort_values(['code', 'frequency', 'string_id'], ascending=[True, False, True], kind='mergesort')
+    freq['category'] = ''
+    if top_k is not None:
+        top = freq.groupby('code', sort=False).cumcount() < top_k
+        freq.loc[top, 'category'] = freq.loc[top, 'code'] + '_s' + freq.loc[top, 'string_id'].astype(str)
+    freq.to_csv(out_dir + 'string_code_freq.csv', index=False)
+
+    top = freq.loc[freq['category'] != '']
+    categories = pd.Series(top['category'].values,
+                           index=pd.MultiIndex.from_arrays([top['code'].values, top['string_id'].values]))
+    profiling.count('rows_out', len(string_dict))
+    print('{} strings of {} codes'.format(len(string_dict), freq['code'].nunique()))
+    return strings, categories
+
+
+@profiling.stage
+def encode_string_tuples(adapter, tuple_path, strings, categories=None, categorical_path=None):
+    '''
+    Replace the strings of string_tuples.csv by their IDs in the string table (in place),
+    and optionally write the string tuples as categorical codes without value:
+    the categorical code of the string if it is in the top-K of its code, <code>_s_other otherwise.
+
+    Parameters:
+    ----
+        adapter:
+            the dataset of the tuples
+        tuple_path:
+            filepath of string_tuples.csv
+        strings, categories:
+            as returned by build_string_table()
+        categorical_path:
+            filepath to output the categorical tuples, None to skip
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('\nEncoding the strings of', tuple_path)
+    with compression.open_file(tuple_path) as f:
+        header = f.readline()
+    tmp_path = tuple_path + '.tmp'
+    out = compression.open_file(tmp_path, 'w', newline='')
+    out.write(header)
+    cat = None
+    if categorical_path is not None:
+        cat = compression.open_file(categorical_path, 'w', newline='')
+        cat.write(header)
+
+    # strings are written verbatim, quotes included
+    with compression.open_file(tuple_path) as f, pd.read_csv(f, dtype=str, keep_default_na=False, index_col=False,
+                                                             quoting=csv.QUOTE_NONE, chunksize=STRING_CHUNKSIZE) as reader:
+        for i, chunk in enumerate(reader):
+            profiling.count('rows_in', len(chunk))
+            ids = strings.reindex(chunk['value'].values)
+            assert ids.notna().all(), 'strings missing from the string table'
+            ids = ids.values.astype(np.int64)
+
+            if cat is not None:
+                code = categories.reindex(pd.MultiIndex.from_arrays([chunk['code'].values, ids])).values
+                other = pd.isna(code)
+                code[other] = chunk['code'].values[other] + OTHER_SUFFIX
+                categorical = chunk.assign(code=code, value=adapter.empty_value)
+                categorical.to_csv(cat, index=False, header=False)
+
+            chunk['value'] = ids
+            chunk.to_csv(out, index=False, header=False)
+            profiling.count('rows_out', len(chunk))
+
+    out.close()
+    if cat is not None:
+        cat.close()
+    os.replace(tmp_path, tuple_path)
@@ -0,0 +1,47 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import checkpoint
+from dataset import MIMIC
+
+
+def _touch(path):
+    with open(path, 'w', encoding='utf8') as f:
+        f.write('x\n')
+
+
+def test_journal_resumes_and_starts_over(tmp_path, monkeypatch):
+    monkeypatch.setattr(MIMIC, 'checkpoint', True)
+    root = str(tmp_path) + '/'
+    _touch(root + 'labevents.csv')
+    path = root + 'labevents.journal'
+    outputs = [(root, 'labevents')]
+
+    # a run failing after 2 of 3 chunks
+    journal = checkpoint.Journal(MIMIC, path, [root + 'labevents.csv'], {'chunksize': 10}, outputs)
+    assert journal.load_state({}) == {}
+    for i, chunk in journal.chunks(['a', 'b', 'c']):
+        if i == 2:
+            break
+        _touch(root + 'labevents{}.tri'.format(i))
+        journal.commit(i, {'count': i + 1})
+
+    # the next run only gets the third chunk, with the aggregates after the second one
+    journal = checkpoint.Journal(MIMIC, path, [root + 'labevents.csv'], {'chunksize': 10}, outputs)
+    assert list(journal.chunks(['a', 'b', 'c'])) == [(2, 'c')]
+    assert journal.load_state({}) == {'count': 2}
+    assert os.path.exists(root + 'labevents0.tri') and os.path.exists(root + 'labevents1.tri')
+
+    # other settings: start over, the chunks of the earlier run are removed, not the files of other tables
+    _touch(root + 'labevents_string_0.tri')
+    journal = checkpoint.Journal(MIMIC, path, [root + 'labevents.csv'], {'chunksize': 20}, outputs)
+    assert list(journal.chunks(['a', 'b', 'c'])) == [(0, 'a'), (1, 'b'), (2, 'c')]
+    assert journal.load_state({}) == {}
+    assert not os.path.exists(path)
+    assert sorted(os.listdir(root)) == ['labevents.csv', 'labevents_string_0.tri']
+
+    journal.commit(0)
+    journal.finish()
+    assert not os.path.exists(path)
@@ -0,0 +1,40 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import checkpoint
+import compression
+
+
+LINES = ''.join('{},10,{},mimic_50001,{}\n'.format(i % 97, i * 60, i / 7) for i in range(5000))
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'bz2', 'lzma'])
+def test_round_trip(tmp_path, codec):
+    path = str(tmp_path) + '/tuples0.tri'
+    with checkpoint.atomic_open(path, 'w', compress=True, codec=codec, encoding='utf8') as f:
+        f.write(LINES)
+    assert not os.path.exists(path + '.tmp')
+    assert compression.detect(path) == codec
+    with compression.open_file(path) as f:
+        assert f.read() == LINES
+
+    # blocks are independent members / streams, read back as a single file
+    path = str(tmp_path) + '/blocks.tri'
+    with compression.BlockWriter(path, codec, threads=3, block_size=1000) as f:
+        f.write(LINES.encode('utf8'))
+    with compression.open_file(path, 'rb') as f:
+        assert f.read() == LINES.encode('utf8')
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'bz2', 'lzma'])
+def test_round_trip_empty(tmp_path, codec):
+    path = str(tmp_path) + '/empty.tri'
+    with checkpoint.atomic_open(path, 'wb', compress=True, codec=codec):
+        pass
+    with compression.open_file(path) as f:
+        assert f.read() == ''
+    with compression.open_file(path, 'rb') as f:
+        assert f.read() == b''
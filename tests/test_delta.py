@@ -0,0 +1,55 @@
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import delta
+import profiling
+from dataset import MIMIC
+
+
+HEADER = 'patient_id,admission_id,time,code,value\n'
+
+
+def _write(path, text):
+    with open(path, 'w', encoding='utf8', newline='') as f:
+        f.write(text)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_splice_changed_and_new_patients(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'report_path', None)
+    root = str(tmp_path) + '/'
+
+    # patients in the order of a sharded run, not of the patient table
+    block3 = '3,30,2150-01-01 00:00:00,mimic_50001,1.5\n3,30,2150-01-01 01:00:00,mimic_50001,2.5\n'
+    block1 = '1,10,2150-01-01 00:00:00,mimic_50001,7\n1,10,2150-01-02 00:00:00,mimic_220001,\n'
+    block2 = '2,20,2151-01-01 00:00:00,mimic_220001,\n'
+    _write(root + 'tuples.csv', HEADER + block3 + block1 + block2)
+
+    # patient 1 changed, patient 4 is new
+    new1 = '1,10,2150-01-01 00:00:00,mimic_50001,8\n'
+    new4 = '4,40,2152-01-01 00:00:00,mimic_50001,3\n4,40,2152-01-01 00:10:00,mimic_220001,\n'
+    _write(root + 'delta.csv', HEADER + new4 + new1)
+
+    _write(root + 'code_dict.csv',
+           'index,code,code_type,value_frequency,total_frequency,source_table,unit_of_measurement,with_value\n'
+           '1,50001,mimic,3,3,labevents,mg/dl,1\n'
+           '2,220001,mimic,0,2,chartevents,none,0\n')
+
+    rank = {'1': 0, '2': 1, '3': 2, '4': 3}
+    removed, added = delta.splice_tuples(MIMIC, root + 'tuples.csv', root + 'delta.csv', {'1', '4'}, rank)
+    delta.update_frequencies(MIMIC, root + 'code_dict.csv', removed, added)
+
+    # untouched patients keep their bytes and position, patient 1 is replaced in place, patient 4 appended
+    assert _read(root + 'tuples.csv') == (HEADER + block3 + new1 + block2 + new4).encode('utf8')
+
+    dic = pd.read_csv(root + 'code_dict.csv', dtype={'code': str})
+    freq = dic.set_index('code')[['value_frequency', 'total_frequency']].to_dict('index')
+    assert freq == {'50001': {'value_frequency': 4, 'total_frequency': 4},
+                    '220001': {'value_frequency': 0, 'total_frequency': 2}}
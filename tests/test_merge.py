@@ -0,0 +1,80 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+import profiling
+from dataset import MIMIC
+
+
+COLS = ['patient_id', 'admission_id', 'time', 'code', 'value']
+
+
+def _write_tri(path, patients):
+    with open(path, 'w', encoding='utf8') as f:
+        f.write(pipeline.TRI_HEADER)
+        for pid, lines in patients:
+            f.write(pid + '\n' + ''.join(l + '\n' for l in lines) + '\n')
+
+
+def _read(path):
+    with open(path, 'r', encoding='utf8') as f:
+        return [l.rstrip('\n').split(',') for l in f][1:]
+
+
+def test_merge_drops_duplicates(tmp_path, monkeypatch):
+    src = str(tmp_path) + '/tuple/'
+    os.makedirs(src)
+    _write_tri(src + 'chartevents0.tri', [
+        ('1', ['10,0,mimic_220645,140', '10,0,mimic_220645,140', '10,18000,mimic_220645,141']),
+        ('2', ['20,100,mimic_220645,99']),
+    ])
+    _write_tri(src + 'labevents0.tri', [
+        ('1', ['10,600,mimic_50983,140', '10,10000,mimic_50983,141.0']),
+        ('2', []),
+    ])
+
+    drops = []
+    monkeypatch.setattr(profiling, 'report_path', None)
+    monkeypatch.setattr(profiling, 'count_drops', lambda table, reason, codes: drops.append((reason, dict(codes))))
+    monkeypatch.setattr(MIMIC, 'dedup_exact', True)
+    monkeypatch.setattr(MIMIC, 'dedup_equivalent_codes', {'mimic_220645': 'mimic_50983'})
+    monkeypatch.setattr(MIMIC, 'dedup_tolerance', '1h')
+
+    out = str(tmp_path) + '/tuples.csv'
+    pipeline.merge_tuples(MIMIC, src, COLS, out, dedup=True)
+
+    # the copy within an hour of the lab value is dropped, the one 8000 seconds away is kept
+    times = pipeline.render_times(MIMIC, [600, 10000, 18000, 100])
+    assert _read(out) == [
+        ['1', '10', times[0], 'mimic_50983', '140'],
+        ['1', '10', times[1], 'mimic_50983', '141.0'],
+        ['1', '10', times[2], 'mimic_220645', '141'],
+        ['2', '20', times[3], 'mimic_220645', '99'],
+    ]
+    assert sorted(drops) == [('duplicate', {'mimic_220645': 1}), ('near_duplicate', {'mimic_220645': 1})]
+
+
+def test_merge_keeps_all_tuples_without_dedup(tmp_path, monkeypatch):
+    src = str(tmp_path) + '/tuple/'
+    os.makedirs(src)
+    _write_tri(src + 'chartevents0.tri', [('1', ['10,0,mimic_220645,140', '10,0,mimic_220645,140'])])
+    monkeypatch.setattr(profiling, 'report_path', None)
+    monkeypatch.setattr(MIMIC, 'dedup_exact', True)
+
+    out = str(tmp_path) + '/tuples.csv'
+    pipeline.merge_tuples(MIMIC, src, COLS, out)
+    assert len(_read(out)) == 2
+
+
+def test_merge_rejects_files_of_other_patients(tmp_path, monkeypatch):
+    src = str(tmp_path) + '/tuple/'
+    os.makedirs(src)
+    _write_tri(src + 'chartevents0.tri', [('1', ['10,0,mimic_220645,140']), ('2', [])])
+    _write_tri(src + 'labevents0.tri', [('1', []), ('3', ['30,0,mimic_50983,1'])])
+    monkeypatch.setattr(profiling, 'report_path', None)
+
+    with pytest.raises(ValueError, match='chartevents0.tri and .*labevents0.tri list other patients: 2 and 3'):
+        pipeline.merge_tuples(MIMIC, src, COLS, str(tmp_path) + '/tuples.csv')
@@ -0,0 +1,47 @@
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+from dataset import MIMIC
+
+
+def _dict(entries):
+    return pd.DataFrame(entries, columns=pipeline.REGISTRY_KEY)
+
+
+def test_register_codes_keeps_indices(tmp_path, monkeypatch):
+    monkeypatch.setattr(MIMIC, 'idx_dir', str(tmp_path) + '/')
+
+    first = pipeline.register_codes(MIMIC, _dict([
+        ('labevents', 'mimic', '50001'),
+        ('labevents', 'mimic', '50002'),
+        ('chartevents', 'mimic', '220001'),
+    ]))
+    assert list(first) == [1, 2, 3]
+
+    # chartevents dropped, outputevents added, entries in another order
+    second = pipeline.register_codes(MIMIC, _dict([
+        ('outputevents', 'mimic', '226559'),
+        ('labevents', 'mimic', '50002'),
+        ('labevents', 'mimic', '50001'),
+    ]))
+    assert list(second) == [4, 2, 1]
+
+    registry = pd.read_csv(str(tmp_path) + '/code_registry.csv', dtype=str, keep_default_na=False)
+    status = dict(zip(registry['code'], registry['status']))
+    assert status == {'50001': 'active', '50002': 'active', '220001': 'retired', '226559': 'active'}
+
+    # a retired entry coming back gets its index back, indices are never reused
+    third = pipeline.register_codes(MIMIC, _dict([
+        ('chartevents', 'mimic', '220001'),
+        ('labevents', 'mimic', '50001'),
+        ('chartevents', 'mimic', '220002'),
+    ]))
+    assert list(third) == [3, 1, 5]
+
+    registry = pd.read_csv(str(tmp_path) + '/code_registry.csv', dtype=str, keep_default_na=False)
+    assert list(registry['index']) == ['1', '2', '3', '4', '5']
+    assert dict(zip(registry['code'], registry['status']))['220001'] == 'active'
@@ -0,0 +1,52 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sequences
+from dataset import MIMIC
+
+
+def _write(path, lines):
+    with open(path, 'w', encoding='utf8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def test_export_sequences_with_text_attributes(tmp_path):
+    root = str(tmp_path) + '/'
+    _write(root + 'tuples.csv', [
+        'patient_id,admission_id,time,code,value',
+        '1,10,2150-01-01 00:00:00,lab_5,1.5',
+        '1,10,2150-01-01 00:01:00,lab_5,high',
+        '1,10,2150-01-01 00:03:00,ccs_3,',
+        '2,20,2151-01-01 00:00:00,ccs_3,',
+    ])
+    _write(root + 'code_dict.csv', [
+        'index,code,code_type,source_table',
+        '1,3,ccs,ccs',
+        '2,5,lab,labevents',
+    ])
+    _write(root + 'patients_dict.csv', [
+        'subject_id,gender,age,los',
+        '1,M,> 89,0.5',
+        '2,F,40,',
+        '3,F,50,1.0',
+    ])
+
+    sequences.export_sequences(MIMIC, root + 'tuples.csv', root + 'code_dict.csv',
+                               root + 'patients_dict.csv', root + 'seq/')
+    data = sequences.SequenceDataset(root + 'seq/')
+
+    assert list(data.patient_ids) == ['1', '2']
+    assert list(data.patients['gender']) == ['M', 'F']
+    assert list(data.patients['age']) == ['> 89', '40']
+    assert data.patients['los'][0] == 0.5 and np.isnan(data.patients['los'][1])
+    assert list(data.codes) == [2, 2, 1, 1]
+    assert list(data.deltas) == [0, 60, 120, 0]
+
+    # the first event kept after truncation starts the sequence
+    batch = next(data.batches(2, max_len=2, shuffle=False))
+    first = list(batch['patients']).index(0)
+    assert batch['lengths'][first] == 2
+    assert list(batch['deltas'][first]) == [0, 120]
@@ -0,0 +1,252 @@
+import json
+import math
+import numpy as np
+import pandas as pd
+
+
+'''
+Streaming statistics of the values of codes, built while generating the value dictionaries
+and written as extra columns of code_dict.csv, so that values can be normalized without another pass.
+Values are added chunk by chunk, vectorized per code, in bounded memory:
+count, mean and M2 (merged with Chan's formulas), min, max,
+and a log-bucket quantile sketch (as DDSketch) with a relative accuracy of RELATIVE_ACCURACY.
+Statistics of chunks, tables or shards merge exactly (quantiles up to the accuracy of the sketch).
+'''
+
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+# buckets kept per sign, the buckets of the smallest magnitudes are collapsed beyond it
+MAX_BUCKETS = 2048
+
+# magnitudes below it are counted as zeros
+MIN_MAGNITUDE = 1e-9
+
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+# columns added to the dictionary
+STAT_COLS = ['value_count', 'value_mean', 'value_std', 'value_m2', 'value_min', 'value_max'] + \
+            ['value_p{:02d}'.format(int(q * 100)) for q in QUANTILES]
+
+
+class ValueStats:
+    '''
+    Mergeable statistics of the values of a code.
+
+    Attributes:
+    ----
+        count, mean, m2, min, max:
+            number of values, their mean, sum of squared deviations from the mean, min and max
+        zeros:
+            number of values counted as zeros
+        pos, neg:
+            bucket index -> number of positive (negative) values whose magnitude is in the bucket,
+            bucket k covers (GAMMA ** (k-1), GAMMA ** k]
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.zeros = 0
+        self.pos = {}
+        self.neg = {}
+
+    def merge(self, other):
+        '''
+        add the values summarized by another ValueStats
+        '''
+
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.zeros += other.zeros
+        for store, other_store in [(self.pos, other.pos), (self.neg, other.neg)]:
+            for k, n in other_store.items():
+                store[k] = store.get(k, 0) + n
+            _collapse(store)
+
+    @property
+    def std(self):
+        '''
+        standard deviation of the values (with one degree of freedom, as pandas)
+        '''
+
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+    def quantile(self, q):
+        '''
+        estimated q-quantile of the values, within RELATIVE_ACCURACY of a value of the data
+        '''
+
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1)
+
+        # from the most negative values to the largest ones
+        seen = 0
+        for k in sorted(self.neg, reverse=True):
+            seen += self.neg[k]
+            if seen > rank:
+                return _clip(-_bucket_value(k), self.min, self.max)
+        seen += self.zeros
+        if seen > rank:
+            return _clip(0.0, self.min, self.max)
+        for k in sorted(self.pos):
+            seen += self.pos[k]
+            if seen > rank:
+                return _clip(_bucket_value(k), self.min, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2, 'min': self.min, 'max': self.max,
+                'zeros': self.zeros, 'pos': self.pos, 'neg': self.neg}
+
+    @staticmethod
+    def from_dict(d):
+        stats = ValueStats()
+        stats.count, stats.mean, stats.m2 = d['count'], d['mean'], d['m2']
+        stats.min, stats.max, stats.zeros = d['min'], d['max'], d['zeros']
+        stats.pos = {int(k): n for k, n in d['pos'].items()}
+        stats.neg = {int(k): n for k, n in d['neg'].items()}
+        return stats
+
+
+def update(stats, codes, values):
+    '''
+    Add the values of a chunk to the statistics of their codes (vectorized per code).
+
+    Parameters:
+    ----
+        stats:
+            dict of codes to ValueStats, updated in place
+        codes:
+            code of each value (array-like)
+        values:
+            values (array-like of numbers), missing and infinite values are ignored
+
+    Returns:
+    ----
+        No return
+    '''
+
+    values = np.asarray(values, dtype=np.float64)
+    keep = np.isfinite(values)
+    if not keep.any():
+        return
+    frame = pd.DataFrame({'code': np.asarray(codes)[keep], 'value': values[keep]})
+
+    group = frame.groupby('code', sort=False)['value']
+    agg = group.agg(['count', 'mean', 'min', 'max'])
+    deviation = frame['value'] - frame['code'].map(agg['mean'])
+    agg['m2'] = (deviation * deviation).groupby(frame['code'], sort=False).sum()
+
+    # bucket of the magnitude of every value (0 for zeros), signed by the value
+    magnitude = frame['value'].abs().values
+    zero = magnitude < MIN_MAGNITUDE
+    bucket = np.ceil(np.log(np.where(zero, 1, magnitude)) / math.log(GAMMA)).astype(np.int64)
+    sign = np.where(zero, 0, np.sign(frame['value'].values)).astype(np.int8)
+    buckets = pd.DataFrame({'code': frame['code'], 'sign': sign, 'bucket': bucket}) \
+                .groupby(['code', 'sign', 'bucket'], sort=False).size()
+
+    chunk_stats = {}
+    for code, count, mean, vmin, vmax, m2 in agg.itertuples():
+        s = ValueStats()
+        s.count, s.mean, s.m2, s.min, s.max = int(count), float(mean), float(m2), float(vmin), float(vmax)
+        chunk_stats[code] = s
+    for (code, sgn, k), n in buckets.items():
+        s = chunk_stats[code]
+        if sgn == 0:
+            s.zeros += int(n)
+        else:
+            store = s.pos if sgn > 0 else s.neg
+            store[int(k)] = int(n)
+
+    for code, s in chunk_stats.items():
+        if code not in stats:
+            stats[code] = ValueStats()
+        stats[code].merge(s)
+
+
+def stats_table(stats):
+    '''
+    Statistics as columns of the dictionary (STAT_COLS), indexed by code
+    '''
+
+    rows = []
+    for code, s in stats.items():
+        rows.append([code, s.count, s.mean, s.std, s.m2, s.min, s.max] + [s.quantile(q) for q in QUANTILES])
+    table = pd.DataFrame(rows, columns=['code'] + STAT_COLS).set_index('code')
+    table['value_count'] = table['value_count'].astype('Int64')
+    return table
+
+
+def add_columns(table, stats):
+    '''
+    Add the statistics of codes to a dictionary table (empty for codes without values)
+    '''
+
+    table = table.join(stats_table(stats), on='code')
+    table['value_count'] = table['value_count'].astype('Int64')
+    return table
+
+
+def format_columns(table):
+    '''
+    Keep the counts of a dictionary read back from csv as integers (missing for codes without statistics)
+    '''
+
+    if 'value_count' in table.columns:
+        table['value_count'] = pd.to_numeric(table['value_count']).astype('Int64')
+    return table
+
+
+def save_stats(stats, path):
+    '''
+    Save the statistics (with their sketches), so that they can be merged with later ones
+    '''
+
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump({str(code): s.to_dict() for code, s in stats.items()}, f)
+
+
+def load_stats(path):
+    '''
+    load the statistics saved by save_stats(), codes as strings
+    '''
+
+    with open(path, 'r', encoding='utf8') as f:
+        return {code: ValueStats.from_dict(d) for code, d in json.load(f).items()}
+
+
+def _bucket_value(k):
+    '''
+    representative magnitude of bucket k, within RELATIVE_ACCURACY of every magnitude in it
+    '''
+
+    return 2 * GAMMA ** k / (GAMMA + 1)
+
+
+def _clip(value, vmin, vmax):
+    return min(max(value, vmin), vmax)
+
+
+def _collapse(store):
+    '''
+    keep at most MAX_BUCKETS buckets, merging those of the smallest magnitudes
+    '''
+
+    if len(store) <= MAX_BUCKETS:
+        return
+    keys = sorted(store)
+    low = keys[:len(keys) - MAX_BUCKETS + 1]
+    store[low[-1]] = sum(store.pop(k) for k in low[:-1]) + store[low[-1]]